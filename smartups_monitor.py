@@ -5,90 +5,525 @@
 # Rest of the code and all changes are under the GPLv3
 # Author Noel Kuntze <noel.kuntze+github@thermi.consulting>
 
-import argparse
-import ctypes
+import array
+import bisect
+import collections
+import errno
+import fcntl
+import functools
+import heapq
 import logging
+import marshal
+import math
+import mmap
 import os
+import random
 import select
 import signal
-import socket
+import stat
+import struct
 import sys
 import threading
 import time
+import zlib
 
-import yaml
+# Modules that are only needed by some of the modes (argparse, asyncio, concurrent.futures, json,
+# queue, random, socket, yaml) are imported where they are used, so a one-shot query doesn't pay
+# for importing them.
 
-import smbus
+# Precompiled converters between unsigned register values and their signed interpretation
+_UINT16 = struct.Struct("<H")
+_INT16 = struct.Struct("<h")
+_UINT32 = struct.Struct("<I")
+_INT32 = struct.Struct("<i")
 
-##  Implements the thread that wakes up the main thread every duration seconds.
-class WaiterThread():
-    def __init__(self, duration, event, sock):
-        self.__duration = duration
-        self.__socket = sock
-        self.__event = event
+## A timer of the EventLoop. Returned by EventLoop.call_at() and EventLoop.call_periodic().
+class Timer():
+    __slots__ = ("deadline", "period", "callback", "cancelled", "sequence")
 
-    ## Send data over the socket every self.__duration seconds
-    # @param self Pointer to object.
-    def run(self):
-        while True:
-            # thread exits when sendall fails, because the socket was closed by the main thread.
-            # That happens when it exits because of the signalhandler. That is fine.
-            logging.debug("Start of a loop in the waiter thread.")
-            logging.debug("duration: %s", self.__duration)
-            try:
-                self.__socket.sendall(b'a')
-                self.__event.wait(self.__duration)
-                if self.__event.is_set():
-                    logging.debug("Waiter thread was told to exit.")
-                    return
-            except Exception as e:
-                logging.debug("Encountered an exception: %s", e)
-                return
-            logging.debug("End of a loop in the waiter thread.")
-        logging.debug("Reached end WaiterThread.run().")
+    def __init__(self, deadline, period, callback):
+        self.deadline = deadline
+        self.period = period
+        self.callback = callback
+        self.cancelled = False
+        self.sequence = 0
 
-## Implements the signal handler for SIGINT and SIGTERM.
-class SignalHandler():
-    ## Initialize the signal handler
-    # @param self Pointer to object.
-    # @param event An object of type threading.Event that is notified when a signal is received
-    # @param sock An object of type socket over which data is sent when a signal is received
-    def __init__(self, event, sock):
-        self.__event = event
-        self.__sock = sock
-        signal.signal(signal.SIGINT, self.exit_gracefully)
-        signal.signal(signal.SIGTERM, self.exit_gracefully)
-    
-    ## The signal handler method. It sends data over the socket when a signal is received.
-    # @param self Pointer to Object.
+    ## Cancel the timer. It won't run again.
+    # @param self The object pointer.
+    def cancel(self):
+        self.cancelled = True
+
+## The clock of the EventLoop and of the snapshots. By default it is the system clock. Replays
+# run on a virtual clock that starts at the time of the recording and runs speed times faster
+# than the system clock. With speed 0 it jumps from deadline to deadline, which replays as fast
+# as possible and independent of the load of the host.
+class Clock():
+    ## Initialize the clock
+    # @param self The object pointer.
+    # @param speed How much faster than the system clock the clock runs, 0 to step. None uses
+    # the system clock.
+    # @param start The time.time() the virtual clock starts at.
+    def __init__(self, speed=None, start=None):
+        self.speed = speed
+        self.virtual = speed is not None
+        self.stepped = speed == 0
+        self.__origin = time.monotonic()
+        self.__start = time.time() if start is None else start
+        self.__elapsed = 0.0
+
+    def __now(self):
+        if self.stepped:
+            return self.__elapsed
+        return (time.monotonic() - self.__origin)*self.speed
+
+    ## The time on the monotonic clock
+    # @param self The object pointer.
+    def monotonic(self):
+        if not self.virtual:
+            return time.monotonic()
+        return self.__origin + self.__now()
+
+    ## The wall clock time
+    # @param self The object pointer.
+    def time(self):
+        if not self.virtual:
+            return time.time()
+        return self.__start + self.__now()
+
+    ## How long to wait in real seconds until the monotonic clock reaches a deadline. A stepped
+    # clock jumps to the deadline instead.
+    # @param self The object pointer.
+    # @param deadline The deadline on the monotonic clock.
+    # @return The time in seconds.
+    def wait(self, deadline):
+        remaining = deadline - self.monotonic()
+        if self.stepped:
+            self.__elapsed = max(self.__elapsed, deadline - self.__origin)
+            return 0
+        if self.virtual:
+            return remaining/self.speed
+        return remaining
+
+## Single-threaded event loop. It runs timers at absolute deadlines on the monotonic clock,
+# callbacks for readable file descriptors and signal handlers, all from one select.poll() call.
+# Signals are delivered over a pipe registered with signal.set_wakeup_fd(), so they interrupt
+# the poll and are handled in the loop instead of in an asynchronous signal handler.
+class EventLoop():
+    ## Initialize the event loop. It must be created in the main thread.
+    # @param self The object pointer.
+    # @param clock The Clock of the timers. Defaults to the system clock.
+    def __init__(self, clock=None):
+        self.clock = Clock() if clock is None else clock
+        self.__timers = []
+        self.__sequence = 0
+        self.__readers = {}
+        self.__signal_handlers = {}
+        self.__running = False
+        self.__poll = select.poll()
+        self.__wakeup_read, self.__wakeup_write = os.pipe()
+        os.set_blocking(self.__wakeup_read, False)
+        os.set_blocking(self.__wakeup_write, False)
+        self.__poll.register(self.__wakeup_read, select.POLLIN)
+        self.__previous_wakeup_fd = signal.set_wakeup_fd(self.__wakeup_write,
+                                                         warn_on_full_buffer=False)
+
+    ## Run callback once at the given deadline
+    # @param self The object pointer.
+    # @param deadline The deadline on the monotonic clock of the Clock.
+    # @param callback The callable to run. It gets no arguments.
+    # @return The Timer.
+    def call_at(self, deadline, callback):
+        timer = Timer(deadline, None, callback)
+        self.__push(timer)
+        return timer
+
+    ## Run callback every period seconds at the absolute deadlines first, first + period, ...
+    # The deadlines don't drift by the run time of the callback. If the loop falls behind,
+    # the missed deadlines are skipped.
+    # @param self The object pointer.
+    # @param period The period in seconds. It can be changed through Timer.period and is
+    # applied when the next deadline is computed.
+    # @param callback The callable to run. It gets no arguments.
+    # @param first The first deadline. Defaults to now.
+    # @return The Timer.
+    def call_periodic(self, period, callback, first=None):
+        if first is None:
+            first = self.clock.monotonic()
+        timer = Timer(first, period, callback)
+        self.__push(timer)
+        return timer
+
+    ## Move the next deadline of a timer
+    # @param self The object pointer.
+    # @param timer The Timer.
+    # @param deadline The new deadline on the monotonic clock of the Clock.
+    def reschedule(self, timer, deadline):
+        timer.deadline = deadline
+        timer.cancelled = False
+        self.__push(timer)
+
+    def __push(self, timer):
+        self.__sequence += 1
+        timer.sequence = self.__sequence
+        heapq.heappush(self.__timers, (timer.deadline, self.__sequence, timer))
+
+    ## Run callback(fd, events) when fd becomes readable
+    # @param self The object pointer.
+    # @param fd The file descriptor or an object with a fileno() method.
+    # @param callback The callable to run.
+    # @param events The poll events to wait for.
+    def add_reader(self, fd, callback, events=select.POLLIN):
+        if not isinstance(fd, int):
+            fd = fd.fileno()
+        self.__readers[fd] = callback
+        self.__poll.register(fd, events)
+
+    ## Change the poll events a file descriptor added with add_reader() waits for
+    # @param self The object pointer.
+    # @param fd The file descriptor or an object with a fileno() method.
+    # @param events The poll events to wait for.
+    def modify_reader(self, fd, events):
+        if not isinstance(fd, int):
+            fd = fd.fileno()
+        self.__poll.modify(fd, events)
+
+    ## Stop watching a file descriptor
+    # @param self The object pointer.
+    # @param fd The file descriptor or an object with a fileno() method.
+    def remove_reader(self, fd):
+        if not isinstance(fd, int):
+            fd = fd.fileno()
+        if self.__readers.pop(fd, None) is not None:
+            self.__poll.unregister(fd)
+
+    ## Run callback(signum) in the loop when the signal is received
+    # @param self The object pointer.
     # @param signum The signal number.
-    # @param frame The stack frame.
-    def exit_gracefully(self, signum, frame):
-        self.__sock.sendall(b'a')
-        self.__event.set()
+    # @param callback The callable to run.
+    def add_signal_handler(self, signum, callback):
+        self.__signal_handlers[signum] = callback
+        # The handler itself does nothing, the signal number is written to the wakeup fd
+        signal.signal(signum, lambda signum, frame: None)
+
+    ## Make run() return after the current iteration
+    # @param self The object pointer.
+    def stop(self):
+        self.__running = False
+
+    ## Restore the signal handlers and release the wakeup pipe
+    # @param self The object pointer.
+    def close(self):
+        for signum in self.__signal_handlers:
+            signal.signal(signum, signal.SIG_DFL)
+        self.__signal_handlers.clear()
+        signal.set_wakeup_fd(self.__previous_wakeup_fd)
+        os.close(self.__wakeup_read)
+        os.close(self.__wakeup_write)
+
+    def __run_callback(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception:
+            logging.exception("Unhandled exception in %s", callback)
+
+    def __dispatch_signals(self):
+        try:
+            data = os.read(self.__wakeup_read, 512)
+        except BlockingIOError:
+            return
+        for signum in data:
+            handler = self.__signal_handlers.get(signum)
+            if signum == signal.SIGPROF:
+                # the SamplingProfiler handles it outside of the loop
+                continue
+            if handler is None:
+                logging.debug("Ignoring signal %s without handler", signum)
+            else:
+                self.__run_callback(handler, signum)
+
+    # Runs the timers that were due when it was called, once each. Timers that become due
+    # meanwhile wait for the next pass, so the loop polls and handles signals in between.
+    def __run_timers(self):
+        now = self.clock.monotonic()
+        due = []
+        while self.__timers and self.__timers[0][0] <= now:
+            due.append(heapq.heappop(self.__timers))
+        for deadline, sequence, timer in due:
+            # a callback of this pass may have cancelled or rescheduled it
+            if timer.cancelled or sequence != timer.sequence:
+                continue
+            if timer.period is not None:
+                # schedule the next run before the callback so it can change the deadline
+                missed = math.floor((now - deadline) / timer.period)
+                if missed > 0:
+                    logging.debug("Timer %s missed %s deadlines", timer.callback, missed)
+                timer.deadline = deadline + (missed + 1) * timer.period
+                self.__push(timer)
+            self.__run_callback(timer.callback)
+
+    ## Run the loop until stop() is called
+    # @param self The object pointer.
+    def run(self):
+        self.__running = True
+        while self.__running:
+            timeout = None
+            while self.__timers and (self.__timers[0][2].cancelled or
+                                     self.__timers[0][1] != self.__timers[0][2].sequence):
+                heapq.heappop(self.__timers)
+            if self.__timers:
+                timeout = max(0, math.ceil(self.clock.wait(self.__timers[0][0]) * 1000))
+            for fd, events in self.__poll.poll(timeout):
+                if fd == self.__wakeup_read:
+                    self.__dispatch_signals()
+                elif fd in self.__readers:
+                    self.__run_callback(self.__readers[fd], fd, events)
+                else:
+                    logging.warning("Received event for unknown fd %s", fd)
+            if self.__running:
+                self.__run_timers()
+
+# One lock per I2C bus, so transactions of devices on the same bus never interleave
+_BUS_LOCKS = {}
+# One worker thread per I2C bus for the blocking calls of AsyncSmartUPS, by bus_key
+_BUS_EXECUTORS = {}
+_BUS_EXECUTORS_LOCK = threading.Lock()
+# ioctls of /dev/i2c-N that set the number of retries and the timeout (in 10 ms) of the adapter
+_I2C_RETRIES = 0x0701
+_I2C_TIMEOUT = 0x0702
+
+## Base class of the errors of the I2C transaction layer
+class TransactionError(IOError):
+    pass
+
+## The bus was not free within the timeout of the transaction
+class TransactionTimeout(TransactionError):
+    pass
+
+## The deadline of the cycle doesn't leave enough time for another transaction
+class DeadlineExceeded(TransactionError):
+    pass
+
+## The circuit breaker of the device is open, so the bus is not touched until the cooldown ends
+class CircuitOpenError(TransactionError):
+    pass
+
+## A histogram of durations with fixed buckets that grow exponentially. Adding a duration costs a
+# binary search, so the histograms stay enabled on the hot paths.
+class LatencyHistogram():
+    # the upper bounds of the buckets in seconds, 10 µs * 2^k up to about 10 s. The last bucket
+    # takes everything above.
+    BOUNDS = tuple(0.00001 * 2**k for k in range(21))
+    __slots__ = ("counts", "count", "sum", "max")
+
+    ## Initialize the histogram
+    # @param self The object pointer.
+    def __init__(self):
+        self.counts = [0]*(len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    ## Add a duration
+    # @param self The object pointer.
+    # @param seconds The duration in seconds.
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    ## Estimate a quantile
+    # @param self The object pointer.
+    # @param quantile The quantile, e.g. 0.99.
+    # @return The upper bound of the bucket holding the quantile in seconds, at most the maximum.
+    def quantile(self, quantile):
+        rank = quantile*self.count
+        total = 0
+        for index, count in enumerate(self.counts):
+            total += count
+            if count and total >= rank:
+                return min(self.BOUNDS[index], self.max) if index < len(self.BOUNDS) else self.max
+        return self.max
+
+    ## Describe the histogram in one line
+    # @param self The object pointer.
+    def summary(self):
+        if not self.count:
+            return "no samples"
+        return "%d samples, mean %.3f ms, p50 %.3f ms, p99 %.3f ms, max %.3f ms" % (
+            self.count, self.sum*1000/self.count, self.quantile(0.5)*1000,
+            self.quantile(0.99)*1000, self.max*1000)
 
 ## Implements the methods to communicate over I2C to a specific address over a specific bus.
 class OpenElectronsI2cFixed():
     ## Initialize the object
     ## @param self Pointer to object.
     # @param i2c_address The address of the I2C device.
-    # @param bus The number of the bus over which the I2C device can be reached.
+    # @param bus The number of the bus over which the I2C device can be reached, or a bus backend
+    # object implementing the smbus.SMBus interface (e.g. SimulatedSMBus).
     def __init__(self, i2c_address, bus=0):
         self.address = i2c_address
-        self.bus = smbus.SMBus(bus)
+        if isinstance(bus, int):
+            import smbus
+            self.bus = smbus.SMBus(bus)
+            self.bus_key = bus
+            self.bus_number = bus
+        else:
+            self.bus = bus
+            self.bus_key = id(bus)
+            self.bus_number = None
+        self.lock = _BUS_LOCKS.setdefault(self.bus_key, threading.Lock())
+        # number of I2C transactions issued by this object, how many of them failed and how many
+        # of them were retries
+        self.transactions = 0
+        self.errors = 0
+        self.retries_total = 0
+        # how long the transactions waited for the bus lock and how long the transfers took in
+        # the driver and on the bus, and the failed attempts by register
+        self.bus_wait = LatencyHistogram()
+        self.latency = LatencyHistogram()
+        self.register_errors = collections.Counter()
+        # the monotonic time by which the current cycle has to be done, None for no deadline
+        self.deadline = None
+        self.__failures = 0
+        self.__open_until = None
+        # the BlockRecorder the reads are recorded with and the bus they are recorded for
+        self.recorder = None
+        self.recorder_bus = 0
+        # the timeout set on the adapter, see configure_transactions()
+        self.__adapter_timeout = None
+        self.configure_transactions()
+
+    ## Configure the transaction layer. A transaction waits at most timeout for the bus.
+    # Failed transactions are retried with a random backoff of up to backoff*2^attempt seconds.
+    # After breaker_threshold failed transactions in a row the circuit breaker opens: the bus
+    # isn't touched for breaker_cooldown seconds, then a single transaction probes whether the
+    # device is back.
+    # With adapter_tuning, the kernel also aborts a transfer after timeout and doesn't retry it,
+    # if the bus is a number. These settings apply to the whole adapter, so they change the
+    # behaviour of every other driver and process on the bus as well.
+    # @param self The object pointer.
+    # @param timeout The timeout of an attempt in seconds.
+    # @param retries The number of retries of a failed transaction.
+    # @param backoff The base of the backoff between retries in seconds.
+    # @param breaker_threshold The number of failed transactions that opens the breaker.
+    # @param breaker_cooldown How long the breaker stays open in seconds.
+    # @param adapter_tuning Whether to set the timeout and the retries of the I2C adapter.
+    def configure_transactions(self, timeout=0.1, retries=2, backoff=0.01, breaker_threshold=5,
+                               breaker_cooldown=30.0, adapter_tuning=False):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        if (adapter_tuning and self.bus_number is not None and
+                self.__adapter_timeout != timeout):
+            self.__adapter_timeout = timeout
+            logging.info("Setting the timeout of I2C bus %s to %s s and its retries to 0 for "
+                         "all of its devices", self.bus_number, timeout)
+            try:
+                with open("/dev/i2c-%s" % self.bus_number, "rb", buffering=0) as device:
+                    fcntl.ioctl(device, _I2C_TIMEOUT, max(1, math.ceil(timeout*100)))
+                    fcntl.ioctl(device, _I2C_RETRIES, 0)
+            except OSError as exception:
+                logging.warning("Could not set the timeout of I2C bus %s: %s", self.bus_number,
+                                exception)
+
+    ## The longest time a transaction can take without a deadline: every attempt waits up to
+    # timeout for the bus and up to timeout for the transfer, plus the backoff between them.
+    # @param self The object pointer.
+    # @return The time in seconds.
+    def worst_case_latency(self):
+        return ((self.retries + 1)*2*self.timeout +
+                sum(self.backoff*2**attempt for attempt in range(self.retries)))
+
+    ## Whether the circuit breaker is open and the data of the device is stale
+    # @param self The object pointer.
+    @property
+    def degraded(self):
+        return self.__open_until is not None
+
+    ## Run one transaction on the bus while holding the lock of the bus. It is retried and
+    # accounted in the circuit breaker as described in configure_transactions().
+    # @param self The object pointer.
+    # @param function The method of the bus to call.
+    # @param args The arguments of the method.
+    # @return The result of the method.
+    def __transaction(self, function, *args):
+        if self.__open_until is not None and time.monotonic() < self.__open_until:
+            raise CircuitOpenError("The circuit breaker of 0x%x is open" % self.address)
+        attempt = 0
+        while True:
+            self.transactions += 1
+            try:
+                result = self.__attempt(function, args)
+            except DeadlineExceeded:
+                self.transactions -= 1
+                raise
+            except Exception as exception:
+                self.errors += 1
+                self.register_errors[args[1]] += 1
+                if attempt >= self.retries:
+                    self.__failed()
+                    raise
+                delay = random.uniform(0, self.backoff*2**attempt)
+                if (self.deadline is not None and
+                        time.monotonic() + delay + self.timeout > self.deadline):
+                    self.__failed()
+                    raise DeadlineExceeded("No time left to retry: %s" % exception) from exception
+                attempt += 1
+                self.retries_total += 1
+                time.sleep(delay)
+                continue
+            if self.__open_until is not None:
+                logging.info("I2C device 0x%x responds again, closing the circuit breaker",
+                             self.address)
+            self.__failures = 0
+            self.__open_until = None
+            return result
+
+    def __attempt(self, function, args):
+        wait = self.timeout
+        if self.deadline is not None:
+            # leave the time of the transfer itself before the deadline
+            wait = min(wait, self.deadline - time.monotonic() - self.timeout)
+            if wait < 0:
+                raise DeadlineExceeded("The deadline of the cycle passed")
+        start = time.perf_counter()
+        if not self.lock.acquire(timeout=wait):
+            raise TransactionTimeout("I2C bus %s was busy for %s s" % (self.bus_key, wait))
+        acquired = time.perf_counter()
+        self.bus_wait.add(acquired - start)
+        try:
+            return function(*args)
+        finally:
+            self.lock.release()
+            self.latency.add(time.perf_counter() - acquired)
+
+    def __failed(self):
+        self.__failures += 1
+        if self.__open_until is not None or self.__failures >= self.breaker_threshold:
+            if self.__open_until is None:
+                logging.warning("I2C device 0x%x failed %s times in a row, opening the circuit "
+                                "breaker for %s s", self.address, self.__failures,
+                                self.breaker_cooldown)
+            self.__open_until = time.monotonic() + self.breaker_cooldown
 
     ## Write a byte to your I2C device at a given location
     #  @param self The object pointer.
     #  @param reg the register to write value at.
     #  @param value value to write.
     def write_byte(self, reg, value):
-        self.bus.write_byte_data(self.address, reg, value)
+        self.__transaction(self.bus.write_byte_data, self.address, reg, value)
 
     ## Read byte from the register of the I2C device
     # @param self The object pointer.
     # @param reg The register to read from.
     def read_byte(self, reg):
-        result = self.bus.read_byte_data(self.address, reg)
+        result = self.__transaction(self.bus.read_byte_data, self.address, reg)
+        if self.recorder is not None:
+            self.recorder.record(self.recorder_bus, self.address, reg, bytes((result,)))
         return (result)
      
     # for read_i2c_block_data and write_i2c_block_data to work correctly,
@@ -103,14 +538,16 @@ class OpenElectronsI2cFixed():
     # @param reg The register to read from.
     # @param length The length of the array to read from.
     def read_array(self, reg, length):
-        results = self.bus.read_i2c_block_data(self.address, reg, length)
+        results = self.__transaction(self.bus.read_i2c_block_data, self.address, reg, length)
+        if self.recorder is not None:
+            self.recorder.record(self.recorder_bus, self.address, reg, bytes(results))
         return results
 
     ## Write the given array to the given register. It uses smbus.write_i2c_block_data.
     # @param reg The register at which to start writing the array to
     # @param arr The array that is to be written
     def write_array(self, reg, arr):
-        self.bus.write_i2c_block_data(self.address, reg, arr)
+        self.__transaction(self.bus.write_i2c_block_data, self.address, reg, arr)
 
     ## Write the given array to the given register. It uses smbus.write_byte_data
     # to write one byte at a time.
@@ -149,7 +586,7 @@ class OpenElectronsI2cFixed():
 
     def read_integer_signed(self, reg):
         a = self.read_integer(reg)
-        signed_a = ctypes.c_int(a).value
+        signed_a = _INT16.unpack(_UINT16.pack(a))[0]
         return signed_a
 
     def read_long(self, reg):
@@ -162,7 +599,7 @@ class OpenElectronsI2cFixed():
 
     def read_long_signed(self, reg):
         a = self.read_long(reg)
-        signed_a = ctypes.c_long(a).value
+        signed_a = _INT32.unpack(_UINT32.pack(a))[0]
         return signed_a
 
     ##  Read the firmware version of the i2c device
@@ -209,24 +646,185 @@ class SmartUPS(OpenElectronsI2cFixed):
     SMARTUPS_MAX_CAPACITY = 0x56
     SMARTUPS_SECONDS = 0x58
 
+    # Layout of the telemetry block as (name, register, width in bytes, signed, scale).
+    # scale converts the raw value into its base unit (V, A, mAh, s, °C, %).
+    # The entries must be in ascending register order without overlaps.
+    REGISTER_LAYOUT = (
+        ("command", SMARTUPS_COMMAND, 1, False, 1),
+        ("restart_option", SMARTUPS_RESTART_OPTION, 1, False, 1),
+        ("button_click", SMARTUPS_BUTTON_CLICK, 1, False, 1),
+        ("restart_time", SMARTUPS_RESTART_TIME, 1, False, 1),
+        ("state", SMARTUPS_STATE, 1, False, 1),
+        ("batt_current", SMARTUPS_BAT_CURRENT, 2, True, 0.001),
+        ("batt_voltage", SMARTUPS_BAT_VOLTAGE, 2, False, 0.001),
+        ("batt_capacity", SMARTUPS_BAT_CAPACITY, 2, False, 1),
+        ("time", SMARTUPS_TIME, 2, False, 1),
+        ("batt_temperature", SMARTUPS_BAT_TEMPERATURE, 1, False, 1),
+        ("batt_health", SMARTUPS_BAT_HEALTH, 1, False, 1),
+        ("out_voltage", SMARTUPS_OUT_VOLTAGE, 2, False, 0.001),
+        ("out_current", SMARTUPS_OUT_CURRENT, 2, True, 0.001),
+        ("max_capacity", SMARTUPS_MAX_CAPACITY, 2, False, 1),
+        ("seconds", SMARTUPS_SECONDS, 4, False, 1),
+    )
+
+    # The telemetry block that read_snapshot() fetches in one transaction (0x41 - 0x5B)
+    SNAPSHOT_START = REGISTER_LAYOUT[0][1]
+    SNAPSHOT_LENGTH = REGISTER_LAYOUT[-1][1] + REGISTER_LAYOUT[-1][2] - SNAPSHOT_START
+
+    BATTERY_STATES = ["IDLE", "PRECHARG", "CHARGING", "TOPUP", "CHARGED", "DISCHARGING",
+                      "CRITICAL", "DISCHARGED", "FAULT", "SHUTDOWN"]
+
+    # How long the read_* methods cache a register, in seconds. None pins the value after the
+    # first read. Registers that are not listed are only cached within a cycle (see begin_cycle).
+    CACHE_TTL = {
+        SMARTUPS_VERSION: None,
+        SMARTUPS_VENDOR: None,
+        SMARTUPS_WHO_AM_I: None,
+        SMARTUPS_MAX_CAPACITY: 60,
+        SMARTUPS_BAT_HEALTH: 60,
+    }
+
     ## Initialize the class with the i2c address of the SmartUPS
     #  @param self The object pointer.
     #  @param i2c_address Address of your SmartUPS.
     def __init__(self, address=I2C_ADDRESS, bus=1):
         OpenElectronsI2cFixed.__init__(self, address, bus)
+        self.__cache = {}
+        self.__cycle = None
+        self.__cycles = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
         try:
-            ret = self.get_device_id()
+            # the device id is pinned in the cache, so probing it is free for later reads
+            ret = self.__cached(self.SMARTUPS_WHO_AM_I, self.__read_identity)
             if not ret:
                 logging.error("Could not connect to UPS!")
         except Exception as e:
             logging.error("Could not connect to UPS!")
             raise e
 
+    ## Read all telemetry registers with a single I2C block transaction.
+    # The returned snapshot can be passed to all read_* methods, so they don't touch the bus.
+    # @param self The object pointer.
+    # @return A SmartUPSSnapshot or None, if the registers could not be read.
+    def read_snapshot(self):
+        try:
+            raw = bytes(self.read_array(self.SNAPSHOT_START, self.SNAPSHOT_LENGTH))
+            if len(raw) != self.SNAPSHOT_LENGTH:
+                logging.error("Short read of register snapshot (%s of %s bytes)",
+                              len(raw), self.SNAPSHOT_LENGTH)
+                return None
+            snapshot = self.decode_snapshot(raw, time.time())
+        except:
+            logging.error("Could not read register snapshot")
+            return None
+        self.__cache_snapshot(snapshot)
+        return snapshot
+
+    ## Start a cycle. Until end_cycle() is called, every register is read from the bus at most
+    # once, so repeated reads of the same register within one check are coalesced.
+    # @param self The object pointer.
+    def begin_cycle(self):
+        self.__cycles += 1
+        self.__cycle = self.__cycles
+
+    ## End the cycle started with begin_cycle()
+    # @param self The object pointer.
+    def end_cycle(self):
+        self.__cycle = None
+
+    ## Drop cached registers
+    # @param self The object pointer.
+    # @param reg The register to drop. None drops all registers that are not pinned.
+    def invalidate_cache(self, reg=None):
+        if reg is not None:
+            self.__cache.pop(reg, None)
+            return
+        for key in list(self.__cache):
+            if self.CACHE_TTL.get(key, 0) is not None:
+                del self.__cache[key]
+
+    ## Get the cache counters
+    # @param self The object pointer.
+    # @return A dict with the hits, misses and the number of cached registers.
+    def cache_stats(self):
+        return {"hits": self.cache_hits, "misses": self.cache_misses, "size": len(self.__cache)}
+
+    ## Read a register through the cache
+    # @param self The object pointer.
+    # @param reg The register.
+    # @param read The method that reads the register from the bus, called as read(reg).
+    def __cached(self, reg, read):
+        entry = self.__cache.get(reg)
+        if entry is not None:
+            value, expires, cycle = entry
+            if (expires is None or time.monotonic() < expires or
+                    (cycle is not None and cycle == self.__cycle)):
+                self.cache_hits += 1
+                return value
+        self.cache_misses += 1
+        value = read(reg)
+        self.__store(reg, value, time.monotonic())
+        return value
+
+    def __store(self, reg, value, now):
+        ttl = self.CACHE_TTL.get(reg, 0)
+        if ttl is None:
+            self.__cache[reg] = (value, None, None)
+        elif ttl > 0 or self.__cycle is not None:
+            self.__cache[reg] = (value, now + ttl, self.__cycle)
+
+    def __cache_snapshot(self, snapshot):
+        now = time.monotonic()
+        for index, entry in enumerate(self.REGISTER_LAYOUT):
+            self.__store(entry[1], snapshot[index + 1], now)
+
+    def __read_identity(self, reg):
+        return self.read_string(reg, 8)
+
+    ## Write a byte and drop the cached registers the write affects. A command can change any
+    # register, so writing SMARTUPS_COMMAND drops everything that is not pinned.
+    #  @param self The object pointer.
+    #  @param reg the register to write value at.
+    #  @param value value to write.
+    def write_byte(self, reg, value):
+        if reg == self.SMARTUPS_COMMAND:
+            self.invalidate_cache()
+        else:
+            self.invalidate_cache(reg)
+        OpenElectronsI2cFixed.write_byte(self, reg, value)
+
+    ## Write an array and drop the cached registers the write affects.
+    # @param self The object pointer.
+    # @param reg The register at which to start writing the array to
+    # @param arr The array that is to be written
+    def write_array(self, reg, arr):
+        if reg <= self.SMARTUPS_COMMAND < reg + len(arr):
+            self.invalidate_cache()
+        else:
+            for offset in range(len(arr)):
+                self.invalidate_cache(reg + offset)
+        OpenElectronsI2cFixed.write_array(self, reg, arr)
+
+    ## Decode a raw telemetry block into a SmartUPSSnapshot with a single struct.unpack_from call.
+    # @param raw A bytes-like object holding the registers SNAPSHOT_START to
+    # SNAPSHOT_START + SNAPSHOT_LENGTH, starting at offset.
+    # @param timestamp The time at which the block was read.
+    # @param offset The offset of SNAPSHOT_START in raw.
+    @classmethod
+    def decode_snapshot(cls, raw, timestamp, offset=0):
+        view = memoryview(raw)
+        values = _SNAPSHOT_STRUCT.unpack_from(view, offset)
+        return _make_snapshot((timestamp,) + values + (bytes(view[offset:offset+cls.SNAPSHOT_LENGTH]),))
+
     ## Reads the SmartUPS battery voltage values
     #  @param self The object pointer.
-    def read_batt_voltage(self):
+    #  @param snapshot An optional SmartUPSSnapshot to read the value from instead of the bus.
+    def read_batt_voltage(self, snapshot=None):
         try:
-            value = self.read_integer(self.SMARTUPS_BAT_VOLTAGE)
+            if snapshot is not None:
+                return snapshot.batt_voltage
+            value = self.__cached(self.SMARTUPS_BAT_VOLTAGE, self.read_integer)
             return value   
         except:
             logging.error("Could not read battery voltage")
@@ -234,9 +832,12 @@ class SmartUPS(OpenElectronsI2cFixed):
 
     ## Reads the SmartUPS battery current values
     #  @param self The object pointer.
-    def read_batt_current(self):
+    #  @param snapshot An optional SmartUPSSnapshot to read the value from instead of the bus.
+    def read_batt_current(self, snapshot=None):
         try:
-            value = self.read_integer_signed(self.SMARTUPS_BAT_CURRENT)
+            if snapshot is not None:
+                return snapshot.batt_current
+            value = self.__cached(self.SMARTUPS_BAT_CURRENT, self.read_integer_signed)
             return value
         except:
             logging.error("Could not read battery current")
@@ -245,9 +846,12 @@ class SmartUPS(OpenElectronsI2cFixed):
     ## Reads the SmartUPS battery temperature values in Celsius.
     ## The temperature is an integer like 41.
     #  @param self The object pointer.
-    def read_batt_temperature(self):
+    #  @param snapshot An optional SmartUPSSnapshot to read the value from instead of the bus.
+    def read_batt_temperature(self, snapshot=None):
         try:
-            value = self.read_byte(self.SMARTUPS_BAT_TEMPERATURE)
+            if snapshot is not None:
+                return snapshot.batt_temperature
+            value = self.__cached(self.SMARTUPS_BAT_TEMPERATURE, self.read_byte)
             return value
         except:
             logging.error("Could not read battery temperature")
@@ -255,9 +859,12 @@ class SmartUPS(OpenElectronsI2cFixed):
 
     ## Reads the SmartUPS battery capacity values
     #  @param self The object pointer.
-    def read_batt_capacity(self):
+    #  @param snapshot An optional SmartUPSSnapshot to read the value from instead of the bus.
+    def read_batt_capacity(self, snapshot=None):
         try:
-            value = self.read_integer(self.SMARTUPS_BAT_CAPACITY)
+            if snapshot is not None:
+                return snapshot.batt_capacity
+            value = self.__cached(self.SMARTUPS_BAT_CAPACITY, self.read_integer)
             return value
         except:
             logging.error("Could not read battery capacity")
@@ -265,9 +872,12 @@ class SmartUPS(OpenElectronsI2cFixed):
 
     ## Reads the SmartUPS battery estimated time values
     #  @param self The object pointer.
-    def read_batt_estimated_time(self):
+    #  @param snapshot An optional SmartUPSSnapshot to read the value from instead of the bus.
+    def read_batt_estimated_time(self, snapshot=None):
         try:
-            value = self.read_integer(self.SMARTUPS_TIME)
+            if snapshot is not None:
+                return snapshot.time
+            value = self.__cached(self.SMARTUPS_TIME, self.read_integer)
             return value
         except:
             logging.error("Could not read battery estimated time")
@@ -275,9 +885,12 @@ class SmartUPS(OpenElectronsI2cFixed):
 
     ## Reads the SmartUPS battery health values
     #  @param self The object pointer.
-    def read_batt_health(self):
+    #  @param snapshot An optional SmartUPSSnapshot to read the value from instead of the bus.
+    def read_batt_health(self, snapshot=None):
         try:
-            value = self.read_byte(self.SMARTUPS_BAT_HEALTH)
+            if snapshot is not None:
+                return snapshot.batt_health
+            value = self.__cached(self.SMARTUPS_BAT_HEALTH, self.read_byte)
             return value
         except:
             logging.error("Could not read battery health")
@@ -285,12 +898,14 @@ class SmartUPS(OpenElectronsI2cFixed):
 
     ## Reads the SmartUPS battery state
     #  @param self The object pointer.
-    def read_batt_state(self):
+    #  @param snapshot An optional SmartUPSSnapshot to read the value from instead of the bus.
+    def read_batt_state(self, snapshot=None):
         try:
-            state = ["IDLE", "PRECHARG", "CHARGING", "TOPUP", "CHARGED", "DISCHARGING",
-                     "CRITICAL", "DISCHARGED", "FAULT", "SHUTDOWN"]
-            value = self.read_byte(self.SMARTUPS_STATE)
-            return state[value]
+            if snapshot is not None:
+                value = snapshot.state
+            else:
+                value = self.__cached(self.SMARTUPS_STATE, self.read_byte)
+            return self.BATTERY_STATES[value]
         except:
             logging.error("Could not read battery state")
             return "FAULT"
@@ -298,9 +913,12 @@ class SmartUPS(OpenElectronsI2cFixed):
     ## Reads the SmartUPS button click status values
     ## 1 is a short button click, 10 is a long one
     #  @param self The object pointer.
-    def read_button_click(self):
+    #  @param snapshot An optional SmartUPSSnapshot to read the value from instead of the bus.
+    def read_button_click(self, snapshot=None):
         try:
-            value = self.read_byte(self.SMARTUPS_BUTTON_CLICK)
+            if snapshot is not None:
+                return snapshot.button_click
+            value = self.__cached(self.SMARTUPS_BUTTON_CLICK, self.read_byte)
             return value
         except:
             logging.error("Could not read button click")
@@ -308,9 +926,12 @@ class SmartUPS(OpenElectronsI2cFixed):
 
     ## Reads the SmartUPS output voltage values
     #  @param self The object pointer.
-    def read_output_voltage(self):
+    #  @param snapshot An optional SmartUPSSnapshot to read the value from instead of the bus.
+    def read_output_voltage(self, snapshot=None):
         try:
-            value = self.read_integer(self.SMARTUPS_OUT_VOLTAGE)
+            if snapshot is not None:
+                return snapshot.out_voltage
+            value = self.__cached(self.SMARTUPS_OUT_VOLTAGE, self.read_integer)
             return value
         except:
             logging.error("Could not read output voltage")
@@ -318,9 +939,12 @@ class SmartUPS(OpenElectronsI2cFixed):
 
     ## Reads the SmartUPS output current values
     #  @param self The object pointer.
-    def read_output_current(self):
+    #  @param snapshot An optional SmartUPSSnapshot to read the value from instead of the bus.
+    def read_output_current(self, snapshot=None):
         try:
-            value = self.read_integer_signed(self.SMARTUPS_OUT_CURRENT)
+            if snapshot is not None:
+                return snapshot.out_current
+            value = self.__cached(self.SMARTUPS_OUT_CURRENT, self.read_integer_signed)
             return value
         except:
             logging.error("Could not read output current")
@@ -328,9 +952,12 @@ class SmartUPS(OpenElectronsI2cFixed):
 
     ## Reads the SmartUPS battery maximum capacity values
     #  @param self The object pointer.
-    def read_max_capacity(self):
+    #  @param snapshot An optional SmartUPSSnapshot to read the value from instead of the bus.
+    def read_max_capacity(self, snapshot=None):
         try:
-            value = self.read_integer(self.SMARTUPS_MAX_CAPACITY)
+            if snapshot is not None:
+                return snapshot.max_capacity
+            value = self.__cached(self.SMARTUPS_MAX_CAPACITY, self.read_integer)
             return value
         except:
             logging.error("Could not read maximum capacity")
@@ -338,9 +965,12 @@ class SmartUPS(OpenElectronsI2cFixed):
 
     ## Reads the SmartUPS time in seconds
     #  @param self The object pointer.
-    def read_seconds(self):
+    #  @param snapshot An optional SmartUPSSnapshot to read the value from instead of the bus.
+    def read_seconds(self, snapshot=None):
         try:
-            value = self.read_long(self.SMARTUPS_SECONDS)
+            if snapshot is not None:
+                return snapshot.seconds
+            value = self.__cached(self.SMARTUPS_SECONDS, self.read_long)
             return value
         except:
             logging.error("Could not read seconds")
@@ -348,9 +978,13 @@ class SmartUPS(OpenElectronsI2cFixed):
 
     ## Reads the SmartUPS charged values
     #  @param self The object pointer.
-    def read_charge(self):
+    #  @param snapshot An optional SmartUPSSnapshot to read the value from instead of the bus.
+    def read_charge(self, snapshot=None):
         try:
-            value = self.read_integer(self.SMARTUPS_BAT_CAPACITY)*100/(1+self.read_integer(self.SMARTUPS_MAX_CAPACITY))
+            if snapshot is not None:
+                return snapshot.batt_capacity*100/(1+snapshot.max_capacity)
+            value = (self.__cached(self.SMARTUPS_BAT_CAPACITY, self.read_integer)*100/
+                     (1+self.__cached(self.SMARTUPS_MAX_CAPACITY, self.read_integer)))
             return value
         except:
             logging.error("Could not read battery charged value")
@@ -360,7 +994,7 @@ class SmartUPS(OpenElectronsI2cFixed):
     # @param self The object pointer.
     def read_version(self):
         try:
-            value = self.get_firmware_version()
+            value = self.__cached(self.SMARTUPS_VERSION, self.__read_identity)
             return value
         except:
             print("Error: Could not read version")
@@ -370,7 +1004,7 @@ class SmartUPS(OpenElectronsI2cFixed):
     # @param self The object pointer.
     def read_vendor(self):
         try:
-            value = self.get_vendor_name()
+            value = self.__cached(self.SMARTUPS_VENDOR, self.__read_identity)
             return value
         except:
             print("Error: Could not read vendor")
@@ -380,7 +1014,7 @@ class SmartUPS(OpenElectronsI2cFixed):
     # @param self The object pointer.
     def read_device_id(self):
         try:
-            value = self.get_device_id()
+            value = self.__cached(self.SMARTUPS_WHO_AM_I, self.__read_identity)
             return value
         except:
             print("Error: Could not read device ID")
@@ -404,275 +1038,4205 @@ class SmartUPS(OpenElectronsI2cFixed):
         except:
             print("Error: Could not write restart option")
 
+    ## Read the last command that was written to the UPS
+    # @param self The object pointer.
+    # @param snapshot An optional SmartUPSSnapshot to read the value from instead of the bus.
+    def read_command(self, snapshot=None):
+        try:
+            if snapshot is not None:
+                return snapshot.command
+            value = self.__cached(self.SMARTUPS_COMMAND, self.read_byte)
+            return value
+        except:
+            print("Error: Could not read command")
+            return ""
+
+    ## Read the restart option
+    # @param self The object pointer.
+    # @param snapshot An optional SmartUPSSnapshot to read the value from instead of the bus.
+    def read_restart_option(self, snapshot=None):
+        try:
+            if snapshot is not None:
+                return snapshot.restart_option
+            value = self.__cached(self.SMARTUPS_RESTART_OPTION, self.read_byte)
+            return value
+        except:
+            print("Error: Could not read restart option")
+            return ""
+
     ## Read the restart time (time until the UPS shuts down)
     # @param self The object pointer.
-    def read_restart_time(self):
+    # @param snapshot An optional SmartUPSSnapshot to read the value from instead of the bus.
+    def read_restart_time(self, snapshot=None):
         try:
-            value = self.read_byte(self.SMARTUPS_RESTART_TIME)
+            if snapshot is not None:
+                return snapshot.restart_time
+            value = self.__cached(self.SMARTUPS_RESTART_TIME, self.read_byte)
             return value
         except:
             print("Error: Could not read button status")
             return ""
 
-## SmartUpsMonitor implements a monitor class for FreeElectron's smart UPS
-class SmartUpsMonitor():
-    def __init__(self):
-        self.__sleep = 5
-        self.__bus = 0
-        self.__address = 0x12
-        self.__debug = False
-        self.__verbose = False
-        self.__test = False
-        self.__config = "/etc/upsmon.yml"
-        self.__ups = None
-        self.__inhibited = False
-        # broken in the FW
-        self.__battery_threshold = 0
-        self.__battery_temperature_threshold = 60
-        self.__input_voltage_threshold = 3.3
-        self.__restart_option = 1
-        self.__print_values = False
-        self.__parse_config()
+## Compile a register layout table into a struct.Struct decoding the whole block at once.
+# Gaps between registers become pad bytes.
+# @param layout The layout table, see SmartUPS.REGISTER_LAYOUT.
+# @param start The first register of the block.
+# @param length The length of the block.
+def compile_register_layout(layout, start, length):
+    codes = {(1, False): "B", (1, True): "b", (2, False): "H", (2, True): "h",
+             (4, False): "I", (4, True): "i"}
+    fmt = ["<"]
+    offset = start
+    for name, reg, width, signed, scale in layout:
+        if reg < offset:
+            raise ValueError("Register %s at 0x%x overlaps the previous register" % (name, reg))
+        fmt.append("%dx" % (reg - offset) if reg > offset else "")
+        fmt.append(codes[(width, signed)])
+        offset = reg + width
+    if offset > start + length:
+        raise ValueError("Register layout exceeds the block length %s" % length)
+    fmt.append("%dx" % (start + length - offset) if start + length > offset else "")
+    return struct.Struct("".join(fmt))
 
-    def __parse_config(self):
-        config_file = None
-        try:
-            with open(self.__config, "r") as f:
-                config_file = yaml.safe_load(f)
-        except FileNotFoundError:
-            logging.warning("No config file found at %s. Continuing without reading configuration.", self.__config)
-            return True
-        except Exception:
-            logging.critical("Exception occured while trying to read config: %s", Exception)
-            return False
+_SNAPSHOT_STRUCT = compile_register_layout(SmartUPS.REGISTER_LAYOUT, SmartUPS.SNAPSHOT_START,
+                                           SmartUPS.SNAPSHOT_LENGTH)
 
-        occured = {}
-        exit_with_error = False
-        for key, value in config_file.values():
-            if key not in occured:
-                occured[key] = None
-            else:
-                logging.error("Duplicate key %s in config file!", key)
-                exit_with_error = True
-            if key == "sleep":
-                self.sleep = value
-            elif key in ["bus", "address", "debug", "verbose", "test",
-                "batteryThreshold", "battery_temperatureThreshold", "input_voltageThreshold",
-                "restartOption"]:
-                self.__dict__["__%s" % key] = value
-            else:
-                logging.error("Unknown key %s found", key)
-                exit_with_error = True
-        if exit_with_error:
-            sys.exit(1)
+## Immutable snapshot of the SmartUPS telemetry registers, decoded from a single block read by
+# SmartUPS.read_snapshot(). It has one field per entry of SmartUPS.REGISTER_LAYOUT, holding the
+# raw (unscaled) register value. timestamp is the time.time() at which the block was read,
+# raw the undecoded register bytes.
+SmartUPSSnapshot = collections.namedtuple(
+    "SmartUPSSnapshot",
+    ["timestamp"] + [entry[0] for entry in SmartUPS.REGISTER_LAYOUT] + ["raw"])
+_make_snapshot = SmartUPSSnapshot._make
 
-        return True
+## Simulated SMBus backend that models the register map of a SmartUPS in memory.
+# It implements the part of the smbus.SMBus interface that OpenElectronsI2cFixed uses, so it can
+# be passed as the bus to SmartUPS to run the monitor without hardware.
+class SimulatedSMBus():
+    ## Initialize the simulated bus with a healthy, fully charged UPS.
+    # @param self The object pointer.
+    # @param latency Fixed latency of every transaction in seconds.
+    # @param baudrate If set, every transaction additionally takes as long as transferring its
+    # bytes (9 bit times per byte, including the address and register bytes) at this bus speed.
+    def __init__(self, latency=0.0, baudrate=None):
+        self.latency = latency
+        self.baudrate = baudrate
+        self.registers = bytearray(256)
+        # number of transactions that were issued on the bus
+        self.transactions = 0
+        self.__faults = []
+        self.__script = None
+        self.set_string(SmartUPS.SMARTUPS_VERSION, "SIM 1.0 ")
+        self.set_string(SmartUPS.SMARTUPS_VENDOR, "Opnelctn")
+        self.set_string(SmartUPS.SMARTUPS_WHO_AM_I, "SmartUPS")
+        self.set_values(command=0, restart_option=1, button_click=0, restart_time=0,
+                        state=SmartUPS.BATTERY_STATES.index("CHARGED"), batt_current=0,
+                        batt_voltage=4150, batt_capacity=1980, time=3600, batt_temperature=30,
+                        batt_health=100, out_voltage=5100, out_current=450, max_capacity=2000,
+                        seconds=0)
 
-    ## Parse arguments and apply them, if they were passed (don't apply any of the defaults)
-    # @param self Pointer to object.
-    def parse_args(self):
-        parser = argparse.ArgumentParser(description="Monitor for SmartUPS from OpenElectrons")
-        parser.add_argument("-c", "--config",
-                            help="Sets the path to the config. Defaults to /etc/upsmon.yml.",
-                            default="/etc/upsmon.yml")
+    ## Set telemetry registers by their name in SmartUPS.REGISTER_LAYOUT
+    # @param self The object pointer.
+    # @param values The raw register values by name.
+    def set_values(self, **values):
+        for name, reg, width, signed, scale in SmartUPS.REGISTER_LAYOUT:
+            if name in values:
+                self.registers[reg:reg+width] = values.pop(name).to_bytes(width, "little",
+                                                                          signed=signed)
+        if values:
+            raise KeyError("Unknown registers: %s" % ", ".join(values))
 
-        parser.add_argument("-v", "--verbose",
-                            help="Enable verbose mode, prints out INFO level messages.",
-                            action="store_true",
-                            default=False)
+    ## Get a telemetry register by its name in SmartUPS.REGISTER_LAYOUT
+    # @param self The object pointer.
+    # @param name The name of the register.
+    def get_value(self, name):
+        for entry_name, reg, width, signed, scale in SmartUPS.REGISTER_LAYOUT:
+            if entry_name == name:
+                return int.from_bytes(self.registers[reg:reg+width], "little", signed=signed)
+        raise KeyError("Unknown register: %s" % name)
 
-        parser.add_argument("--debug",
-                            help="Enable debug mode. Overwrites verbose mode. "
-                            "Prints out DEBUG level messages.",
-                            action="store_true",
-                            default=False)
+    ## Write an 8 byte string register
+    # @param self The object pointer.
+    # @param reg The register at which the string starts.
+    # @param text The string. It is padded or cut to 8 bytes.
+    def set_string(self, reg, text):
+        self.registers[reg:reg+8] = text.encode("ascii")[:8].ljust(8, b"\0")
 
-        parser.add_argument("--test",
-                            help="Enable test mode. Disables upsmon from taking any action "
-                            "except monitoring the UPS",
-                            action="store_true",
-                            default=False)
+    ## Make the next transactions fail
+    # @param self The object pointer.
+    # @param count The number of transactions that fail.
+    # @param register Only fail transactions that touch this register. None matches all.
+    # @param error The exception to raise. Defaults to OSError(EIO), like a NACK on a real bus.
+    def inject_fault(self, count=1, register=None, error=None):
+        if error is None:
+            error = OSError(errno.EIO, os.strerror(errno.EIO))
+        self.__faults.append([register, count, error])
 
-        parser.add_argument("--bus",
-                            help="The bus number that the device is on. Defaults to 0 (/dev/i2c-0)",
-                            default=0,
-                            type=int)
+    ## Set a callable that is called before every transaction as script(bus, operation, register,
+    # length). It can change the registers, for example to simulate a draining battery, and may
+    # raise an exception to fail the transaction.
+    # @param self The object pointer.
+    # @param script The callable or None to remove it.
+    def set_script(self, script):
+        self.__script = script
 
-        parser.add_argument("--address",
-                            help="The address of the UPS. Defaults to 0x12",
-                            default=0x12,
-                            type=int)
+    def __transaction(self, operation, reg, length):
+        self.transactions += 1
+        delay = self.latency
+        if self.baudrate:
+            # address + register (+ repeated start and address on reads) + payload
+            delay += (length + 3) * 9 / self.baudrate
+        if delay > 0:
+            time.sleep(delay)
+        if self.__script is not None:
+            self.__script(self, operation, reg, length)
+        for fault in self.__faults:
+            register, count, error = fault
+            if register is None or reg <= register < reg + length:
+                fault[1] -= 1
+                if fault[1] <= 0:
+                    self.__faults.remove(fault)
+                raise error
 
-        parser.add_argument("--print-values",
-                            help="Print out all settings of the UPS",
-                            default=False,
-                            action="store_true")
+    def read_byte_data(self, address, reg):
+        self.__transaction("read", reg, 1)
+        return self.registers[reg]
 
-        args = parser.parse_args()
+    def write_byte_data(self, address, reg, value):
+        self.__transaction("write", reg, 1)
+        self.registers[reg] = value
 
-        if "-c" or "--config" in sys.argv:
-            self.__config = args.config
-        if "-v" or "--verbose" in sys.argv:
-            self.__verbose = args.verbose
-        if "--debug" in sys.argv:
-            self.__debug = args.debug
-        if "--test" in sys.argv:
-            self.__test = args.test
-        if "--bus" in sys.argv:
-            self.__bus = args.bus
-        if "--address" in sys.argv:
-            self.__address = args.address
-        if "--print-values" in sys.argv:
-            self.__print_values = args.print_values
+    def read_i2c_block_data(self, address, reg, length):
+        self.__transaction("read", reg, length)
+        return list(self.registers[reg:reg+length])
 
-        level = logging.WARNING
-        if self.__debug:
-            level = logging.DEBUG
-        elif self.__verbose:
-            level = logging.INFO
+    def write_i2c_block_data(self, address, reg, data):
+        self.__transaction("write", reg, len(data))
+        self.registers[reg:reg+len(data)] = bytes(data)
 
-        logging.root.setLevel(level)
+## Records the register reads of SmartUPS devices with their time into a compact file, so that
+# outages can be analysed and replayed with ReplaySMBus later. The file starts with MAGIC,
+# followed by a RECORD and the read bytes for every read.
+class BlockRecorder():
+    MAGIC = b"SUPSREC1"
+    # time.time(), bus, address, first register and number of bytes of a read
+    RECORD = struct.Struct("<dBBBB")
 
-    def __print_all_values(self):
-        print("battery voltage: %s" % self.__ups.read_batt_voltage())
-        print("battery amperage: %s" % self.__ups.read_batt_current())
-        print("battery temperature: %s" % self.__ups.read_batt_temperature())
-        print("battery capacity: %s" % self.__ups.read_batt_capacity())
-        print("battery estimated run time: %s" % self.__ups.read_batt_estimated_time())
-        print("battery health: %s" % self.__ups.read_batt_health())
-        print("battery state: %s" % self.__ups.read_batt_state())
-        print("battery button click: %s" % self.__ups.read_button_click())
-        print("battery output voltage: %s" % self.__ups.read_output_voltage())
-        print("battery output amperage: %s" % self.__ups.read_output_current())
-        print("battery max capacity: %s" % self.__ups.read_max_capacity())
-        print("battery seconds: %s" % self.__ups.read_seconds())
-        print("battery charge: %s" % self.__ups.read_charge())
-        print("battery version: %s" % self.__ups.read_version())
-        print("battery vendor: %s" % self.__ups.read_vendor())
-        print("battery device id: %s" % self.__ups.read_device_id())
-        print("battery command: %s" % self.__ups.read_byte(self.__ups.SMARTUPS_COMMAND))
-        print("battery restart option: %s" % self.__ups.read_byte(self.__ups.SMARTUPS_RESTART_OPTION))
-        print("battery restart time: %s" % self.__ups.read_byte(self.__ups.SMARTUPS_RESTART_TIME))
-
-    def __check_ups(self):
-        ups = self.__ups
-        # read the battery voltage
-        battery_voltage = float(ups.read_output_voltage())
-        if battery_voltage < self.__battery_threshold:
-            logging.warning("Battery voltage %s is below threshold %s",
-                            battery_voltage/1000, self.__battery_threshold)
-        else:
-            logging.info("Battery voltage is %s V", battery_voltage/1000)
+    ## Open the file. An existing recording is appended to.
+    # @param self The object pointer.
+    # @param path The path of the file.
+    def __init__(self, path):
+        self.path = path
+        self.__file = open(path, "ab")
+        if self.__file.tell() == 0:
+            self.__file.write(self.MAGIC)
+        self.__lock = threading.Lock()
+        self.records = 0
 
-        # read the battery temperature
-        battery_temperature = ups.read_batt_temperature()
-        if battery_temperature > self.__battery_temperature_threshold:
-            logging.warning("Battery (%s) is over the temperature threshold (%s)!",
-                            battery_temperature, self.__battery_temperature_threshold)
-        else:
-            logging.info("Battery temperature is %s °C", battery_temperature)
+    ## Record a read
+    # @param self The object pointer.
+    # @param bus The number of the bus.
+    # @param address The address of the device.
+    # @param reg The first register that was read.
+    # @param data The bytes that were read.
+    def record(self, bus, address, reg, data):
+        with self.__lock:
+            self.__file.write(self.RECORD.pack(time.time(), bus & 0xff, address, reg, len(data)))
+            self.__file.write(data)
+            self.records += 1
 
-        # read the input voltage
-        input_voltage = float(ups.read_batt_voltage())
-        if input_voltage/1000 < self.__input_voltage_threshold:
-            logging.warning("Input voltage %s V is below threshold %s", input_voltage/1000,
-                            self.__input_voltage_threshold)
-        else:
-            logging.info("Input voltage is %s V", input_voltage/1000)
-
-        # check the charge as percentage.
-        # If the PSU is draining and below 25% or the runtime is below a minute, # issue a warning.
-        battery_state = ups.read_batt_state()
-        battery_charge = ups.read_charge()
-        if battery_state in ["DISCHARGING", "CRITICAL", "DISCHARGED", "FAULT"] and battery_charge < 0.25:
-            logging.error("Battery is %s and below 25%% charge at %s.", battery_state, battery_charge)
-            self.__shut_down()
-        else:
-            logging.info("Battery state is %s and charge is at %s", battery_state, battery_charge)
-
-        # Then if the estimated runtime is below a minute, issue an error and shut down.
-        # Tell it to start the system again
-        # when the PSU has power again
-        battery_estimated_runtime = ups.read_batt_estimated_time()
-        if battery_estimated_runtime < 60:
-            logging.error("battery runtime %s is below a minute", battery_estimated_runtime)
-            self.__shut_down()
+    ## Write the buffered records to the file
+    # @param self The object pointer.
+    def flush(self):
+        with self.__lock:
+            self.__file.flush()
+
+    ## Close the file
+    # @param self The object pointer.
+    def close(self):
+        with self.__lock:
+            self.__file.close()
+
+    ## Read a recording
+    # @param path The path of the file.
+    # @return A list of (timestamp, bus, address, reg, data), ordered by time. A truncated last
+    # record is ignored.
+    @classmethod
+    def read(cls, path):
+        with open(path, "rb") as recording:
+            data = recording.read()
+        if not data.startswith(cls.MAGIC):
+            raise ValueError("%s is no SmartUPS recording" % path)
+        records = []
+        offset = len(cls.MAGIC)
+        while offset + cls.RECORD.size <= len(data):
+            timestamp, bus, address, reg, length = cls.RECORD.unpack_from(data, offset)
+            offset += cls.RECORD.size
+            if offset + length > len(data):
+                break
+            records.append((timestamp, bus, address, reg, data[offset:offset+length]))
+            offset += length
+        records.sort(key=lambda record: record[0])
+        return records
+
+## Bus backend that replays the reads of a recording of BlockRecorder. A read returns the
+# registers as they were last read at the current time of the Clock. Writes are ignored.
+class ReplaySMBus():
+    # Reads that were recorded up to this many seconds after the current time count as current,
+    # they belong to the same cycle
+    LOOKAHEAD = 0.01
+
+    ## Initialize the bus
+    # @param self The object pointer.
+    # @param records The records of BlockRecorder.read().
+    # @param bus The number of the bus whose records are replayed.
+    # @param clock The Clock of the replay.
+    def __init__(self, records, bus, clock):
+        self.__records = [record for record in records if record[1] == bus & 0xff]
+        self.__clock = clock
+        self.__next = 0
+        self.__images = {}
+        self.transactions = 0
+        # the time of the first record
+        self.start = self.__records[0][0] if self.__records else clock.time()
+
+    ## Whether all records were replayed
+    # @param self The object pointer.
+    @property
+    def finished(self):
+        return self.__next >= len(self.__records)
+
+    def __image(self, address):
+        now = self.__clock.time() + self.LOOKAHEAD
+        records = self.__records
+        while self.__next < len(records) and records[self.__next][0] <= now:
+            timestamp, bus, record_address, reg, data = records[self.__next]
+            self.__images.setdefault(record_address, bytearray(256))[reg:reg+len(data)] = data
+            self.__next += 1
+        self.transactions += 1
+        return self.__images.setdefault(address, bytearray(256))
+
+    def read_byte_data(self, address, reg):
+        return self.__image(address)[reg]
+
+    def write_byte_data(self, address, reg, value):
+        pass
+
+    def read_i2c_block_data(self, address, reg, length):
+        return list(self.__image(address)[reg:reg+length])
+
+    def write_i2c_block_data(self, address, reg, data):
+        pass
+
+## A group of registers that the RegisterSampler samples at its own interval
+class SamplingGroup():
+    __slots__ = ("name", "start", "length", "interval", "callback", "deadline")
+
+    def __init__(self, name, start, length, interval, callback, deadline):
+        self.name = name
+        self.start = start
+        self.length = length
+        self.interval = interval
+        self.callback = callback
+        self.deadline = deadline
+
+## Multi-rate register sampler on top of SmartUPS. Every group of registers has its own sampling
+# interval. The groups that are due at the same time are merged into as few block transactions
+# as possible, and the registers read are kept in an image of the register map.
+class RegisterSampler():
+    # Maximum length of an SMBus block transaction
+    MAX_BLOCK_LENGTH = 32
+
+    ## Initialize the sampler
+    # @param self The object pointer.
+    # @param ups The SmartUPS to sample.
+    # @param max_gap Due groups that are at most this many bytes apart are read in one
+    # transaction, including the registers between them.
+    def __init__(self, ups, max_gap=4):
+        self.__ups = ups
+        self.__groups = []
+        self.max_gap = max_gap
+        # the last values read from the registers of the UPS
+        self.image = bytearray(256)
+
+    ## Add a group of registers
+    # @param self The object pointer.
+    # @param name The name of the group.
+    # @param start The first register of the group.
+    # @param length The number of registers in the group.
+    # @param interval The sampling interval in seconds. None samples the group only once, which
+    # is meant for static registers like the version.
+    # @param callback Called as callback(group) after the group was sampled. The registers are
+    # in image[group.start:group.start + group.length].
+    # @param first The first deadline on the time.monotonic() clock. Defaults to now.
+    # @return The SamplingGroup.
+    def add(self, name, start, length, interval, callback=None, first=None):
+        if length > self.MAX_BLOCK_LENGTH:
+            raise ValueError("Group %s is longer than %s bytes" % (name, self.MAX_BLOCK_LENGTH))
+        if first is None:
+            first = time.monotonic()
+        group = SamplingGroup(name, start, length, interval, callback, first)
+        self.__groups.append(group)
+        return group
+
+    ## Change the sampling interval of a group. The next deadline moves accordingly.
+    # @param self The object pointer.
+    # @param group The SamplingGroup.
+    # @param interval The new interval in seconds.
+    def set_interval(self, group, interval):
+        if group.deadline is not None and group.interval is not None:
+            group.deadline += interval - group.interval
+        group.interval = interval
+
+    ## The earliest deadline of all groups or None if no group needs to be sampled again
+    # @param self The object pointer.
+    def next_deadline(self):
+        deadlines = [group.deadline for group in self.__groups if group.deadline is not None]
+        return min(deadlines) if deadlines else None
+
+    ## Merge groups into spans of registers that can be read in one transaction each
+    # @param self The object pointer.
+    # @param groups The groups to merge.
+    # @return A list of [start, end] spans, end being exclusive.
+    def merge(self, groups):
+        spans = []
+        for group in sorted(groups, key=lambda group: group.start):
+            end = group.start + group.length
+            if (spans and group.start <= spans[-1][1] + self.max_gap and
+                    max(end, spans[-1][1]) - spans[-1][0] <= self.MAX_BLOCK_LENGTH):
+                spans[-1][1] = max(end, spans[-1][1])
+            else:
+                spans.append([group.start, end])
+        return spans
+
+    ## Sample all groups that are due and run their callbacks
+    # @param self The object pointer.
+    # @param now The current time on the time.monotonic() clock. Defaults to now.
+    # @return The groups that were sampled successfully.
+    def sample(self, now=None):
+        sampled = self.read_due(now)
+        self.dispatch(sampled)
+        return sampled
+
+    ## Run the callbacks of sampled groups
+    # @param self The object pointer.
+    # @param groups The groups returned by read_due().
+    def dispatch(self, groups):
+        for group in groups:
+            if group.callback is None:
+                continue
+            try:
+                group.callback(group)
+            except Exception:
+                logging.exception("The callback of the register group %s failed", group.name)
+
+    ## Read all groups that are due without running their callbacks. This only does I/O, so it
+    # can run in a bus worker thread while the callbacks run in the main thread.
+    # @param self The object pointer.
+    # @param now The current time on the time.monotonic() clock. Defaults to now.
+    # @return The groups that were sampled successfully.
+    def read_due(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        due = [group for group in self.__groups
+               if group.deadline is not None and group.deadline <= now]
+        failed = []
+        for start, end in self.merge(due):
+            try:
+                data = self.__ups.read_array(start, end - start)
+                if len(data) != end - start:
+                    raise IOError("Short read of %s of %s bytes" % (len(data), end - start))
+                self.image[start:end] = bytes(data)
+            except CircuitOpenError:
+                failed.append((start, end))
+            except Exception as exception:
+                logging.error("Could not read registers 0x%x - 0x%x: %s", start, end - 1, exception)
+                failed.append((start, end))
+
+        sampled = []
+        for group in due:
+            if group.interval is None:
+                group.deadline = None
+            else:
+                # keep the deadlines on the boundaries of the interval, skip missed ones
+                missed = math.floor((now - group.deadline) / group.interval)
+                group.deadline += (missed + 1) * group.interval
+            if any(start <= group.start < end for start, end in failed):
+                if group.interval is None:
+                    # static registers have to be read at least once, retry them with the others
+                    group.deadline = self.next_deadline()
+                continue
+            sampled.append(group)
+        return sampled
+
+## Adaptive polling policy. It polls fast while the UPS runs on battery or charge and runtime
+# change quickly, and backs off exponentially while the battery is idle or fully charged.
+class PollingPolicy():
+    # states in which the UPS is polled at the minimum interval
+    FAST_STATES = ("DISCHARGING", "CRITICAL", "DISCHARGED", "FAULT", "SHUTDOWN")
+    # states in which the interval backs off up to the maximum interval
+    IDLE_STATES = ("CHARGED", "IDLE")
+
+    ## Initialize the policy
+    # @param self The object pointer.
+    # @param interval The base interval in seconds, used while charging.
+    # @param minimum The minimum interval in seconds, used while running on battery.
+    # @param maximum The maximum interval in seconds the backoff can reach.
+    # @param backoff The factor by which the interval grows per poll while idle.
+    # @param charge_rate Charge change in % per minute above which the base interval is used.
+    # @param runtime_rate Runtime change in seconds per second above which the base interval is
+    # used.
+    def __init__(self, interval, minimum, maximum, backoff=2.0, charge_rate=1.0, runtime_rate=1.0):
+        self.interval = None
+        self.configure(interval, minimum, maximum, backoff, charge_rate, runtime_rate)
+        self.interval = self.base
+        self.__previous = None
+
+    ## Change the parameters of the policy. The current interval is kept within the new limits.
+    # The parameters are the ones of the constructor.
+    # @param self The object pointer.
+    def configure(self, interval, minimum, maximum, backoff=2.0, charge_rate=1.0,
+                  runtime_rate=1.0):
+        self.base = min(max(interval, minimum), maximum)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.charge_rate = charge_rate
+        self.runtime_rate = runtime_rate
+        if self.interval is not None:
+            self.interval = min(max(self.interval, minimum), maximum)
+
+    ## Compute the next polling interval from a new snapshot
+    # @param self The object pointer.
+    # @param snapshot The SmartUPSSnapshot that was just read.
+    # @return The interval in seconds until the next poll.
+    def update(self, snapshot):
+        states = SmartUPS.BATTERY_STATES
+        state = states[snapshot.state] if snapshot.state < len(states) else "FAULT"
+        charge = snapshot.batt_capacity*100/(1+snapshot.max_capacity)
+        changing = False
+        previous = self.__previous
+        if previous is not None and snapshot.timestamp > previous[0]:
+            elapsed = snapshot.timestamp - previous[0]
+            changing = (abs(charge - previous[1])*60/elapsed > self.charge_rate or
+                        abs(snapshot.time - previous[2])/elapsed > self.runtime_rate)
+        self.__previous = (snapshot.timestamp, charge, snapshot.time)
+
+        if state in self.FAST_STATES:
+            self.interval = self.minimum
+        elif changing:
+            self.interval = self.base
+        elif state in self.IDLE_STATES:
+            self.interval = min(max(self.interval, self.base)*self.backoff, self.maximum)
         else:
-            logging.info("Battery runtime is at %s", battery_estimated_runtime)
+            self.interval = self.base
+        return self.interval
+
+## A prediction of RuntimePredictor. estimate, lower and upper are the smoothed time to empty and
+# its confidence band in seconds, upper is math.inf while the capacity doesn't fall faster than
+# its noise. confident is set once enough samples of the discharge were fitted.
+RuntimePrediction = collections.namedtuple("RuntimePrediction",
+                                           ["estimate", "lower", "upper", "samples", "confident"])
 
-        restart_time = ups.read_restart_time()
-        if restart_time > 0 and not self.__inhibited:
-            logging.critical("UPS indicated restart time %s. Shutting down.", restart_time)
-            self.__shut_down()
-        logging.debug("End of __check_ups.")
+## Predicts the time until the battery is empty while the UPS runs on battery. It fits a line to
+# the remaining capacity over time with exponentially decaying weights, so that bursts of load
+# move the prediction gradually instead of making it jump like the estimate of the firmware.
+# The weighted sums are updated in O(1) per sample. Until the fit has enough samples, the
+# prediction is derived from the smoothed battery current.
+class RuntimePredictor():
+    # states in which the battery is discharged
+    DISCHARGE_STATES = ("DISCHARGING", "CRITICAL", "DISCHARGED")
 
-    ## Shut down the system
+    ## Initialize the predictor
     # @param self The object pointer.
-    # @param ups Whether to shut down the UPS as well.
-    def __shut_down(self, ups=False):
-        # issue shut down
-        logging.critical("Received shutdown signal")
-        if not self.__inhibited and not self.__test:
-            if ups:
-                self.__ups.write_command(0x53)
-            self.__inhibited = True
-            # issue shutdown command
-            os.system("shutdown now")
+    # @param half_life Age in seconds after which a sample has half of the weight of a new one.
+    # @param min_samples The number of samples of a discharge after which the fit is trusted.
+    # @param confidence The width of the confidence band in standard errors of the slope.
+    # @param smoothing Weight of a new prediction in the exponential smoothing, in ]0, 1].
+    # @param reserve Capacity in mAh that counts as empty.
+    def __init__(self, half_life=120.0, min_samples=5, confidence=2.0, smoothing=0.3, reserve=0):
+        self.half_life = half_life
+        self.min_samples = min_samples
+        self.confidence = confidence
+        self.smoothing = smoothing
+        self.reserve = reserve
+        self.prediction = None
+        self.reset()
 
+    ## Forget the current discharge
+    # @param self The object pointer.
+    def reset(self):
+        self.prediction = None
+        self.__start = None
+        self.__origin = 0
+        self.__last = None
+        self.__samples = 0
+        self.__current = None
+        # decayed sums of the weights, t, c, t², t*c and c² with the time t and the capacity c
+        # relative to the start of the discharge, which keeps the sums free of cancellation
+        self.__sums = [0.0]*6
 
-    def __main(self):
-        try:
-            self.__ups = SmartUPS(self.__address, self.__bus)
-        except Exception as exception:
-            logging.error("Failed to create I2C object to monitor PSU: %s", exception)
-            sys.exit(1)
+    ## Add a snapshot and update the prediction
+    # @param self The object pointer.
+    # @param snapshot The SmartUPSSnapshot that was just read.
+    # @return The RuntimePrediction, or None while the battery isn't discharged.
+    def update(self, snapshot):
+        states = SmartUPS.BATTERY_STATES
+        state = states[snapshot.state] if snapshot.state < len(states) else "FAULT"
+        if state not in self.DISCHARGE_STATES:
+            if self.__start is not None:
+                self.reset()
+            return None
+        if self.__start is None:
+            self.__start = snapshot.timestamp
+            self.__origin = snapshot.batt_capacity
+        t = snapshot.timestamp - self.__start
+        if self.__last is not None and t <= self.__last:
+            return self.prediction
+        capacity = float(snapshot.batt_capacity - self.__origin)
+        sums = self.__sums
+        if self.__last is not None:
+            decay = 0.5**((t - self.__last)/self.half_life)
+            for index in range(6):
+                sums[index] *= decay
+        self.__last = t
+        self.__samples += 1
+        sums[0] += 1.0
+        sums[1] += t
+        sums[2] += capacity
+        sums[3] += t*t
+        sums[4] += t*capacity
+        sums[5] += capacity*capacity
 
-        if self.__print_values:
-            self.__print_all_values()
+        # the current is unsigned here, the sign convention of the firmware doesn't matter
+        current = abs(snapshot.batt_current)
+        if self.__current is None:
+            self.__current = float(current)
         else:
-            # write the restart option
-            self.__ups.write_restart_option(self.__restart_option)
-
-            event = threading.Event()
-            local_signal_handler_sock, remote_signal_hander_sock = socket.socketpair(type=socket.SOCK_DGRAM)
-
-            handler = SignalHandler(event, remote_signal_hander_sock)
-            handler_fd = local_signal_handler_sock.fileno()
-
-            local_waiter_sock, remote_waiter_sock = socket.socketpair(type=socket.SOCK_DGRAM)  
-            waiter_fd = local_waiter_sock.fileno()
-            waiter = WaiterThread(self.__sleep, event, remote_waiter_sock)
-            waiter_thread = threading.Thread(target=waiter.run)
-            waiter_thread.start()
-            polling_object = select.poll()
-            polling_object.register(local_waiter_sock, select.POLLIN | select.POLLHUP)
-            polling_object.register(local_signal_handler_sock, select.POLLIN | select.POLLHUP)
-            break_out = False
-            while not event.is_set():
-                logging.debug("Beginning of main loop")
-                fds_and_flags = polling_object.poll()
-                for fd, flag_set in fds_and_flags:
-                    if fd == handler_fd:
-                        if select.POLLIN == flag_set or select.POLLIN in flag_set:
-                            logging.warning("Received shutdown signal. Shutting down.")
-                            logging.debug("local_signal_handler_sock.recv(9000): %s",
-                                          local_signal_handler_sock.recv(9000))
-                            local_signal_handler_sock.sendall(b'a')
-                        if select.POLLIN != flag_set:
-                            logging.debug("Got flag set %s with other flags than POLLIN", flag_set)
-                    elif fd == waiter_fd:
-                        if select.POLLIN == flag_set or select.POLLIN in flag_set:
-                            logging.debug("Received wake up signal from waiter thread")
-                            self.__check_ups()
-                            logging.debug("local_waiter_sock.recv(9000): %s",
-                                          local_waiter_sock.recv(9000))
-                        if select.POLLIN != flag_set:
-                            logging.debug("Got flag set %s with other flags than POLLIN", flag_set)
-                    else:
-                        logging.warning("Received socket from unknown fd %s", fd)
-                logging.debug("Reached end of loop. Waiting for new wake up via poll")
+            self.__current += self.smoothing*(current - self.__current)
+
+        remaining = max(snapshot.batt_capacity - self.reserve, 0.0)
+        fit = self.__fit(t)
+        confident = fit is not None and self.__samples >= self.min_samples
+        if confident:
+            estimate, lower, upper = fit
+        elif self.__current > 0:
+            estimate = lower = upper = remaining*3600/self.__current
+        else:
+            estimate = lower = upper = math.inf
+        previous = self.prediction
+        if previous is not None and previous.confident == confident:
+            estimate = self.__smooth(previous.estimate, estimate)
+            lower = self.__smooth(previous.lower, lower)
+            upper = self.__smooth(previous.upper, upper)
+        self.prediction = RuntimePrediction(estimate, lower, upper, self.__samples, confident)
+        return self.prediction
+
+    def __smooth(self, previous, value):
+        if math.isinf(previous) or math.isinf(value):
+            return value
+        return previous + self.smoothing*(value - previous)
+
+    ## Fit the capacity over time
+    # @return (estimate, lower, upper) or None if there is no fit yet.
+    def __fit(self, t):
+        weight, sum_t, sum_c, sum_tt, sum_tc, sum_cc = self.__sums
+        if weight <= 2.0:
+            return None
+        mean_t = sum_t/weight
+        mean_c = sum_c/weight
+        var_t = sum_tt - weight*mean_t*mean_t
+        if var_t <= 0.0:
+            return None
+        cov = sum_tc - weight*mean_t*mean_c
+        slope = cov/var_t
+        residuals = max(sum_cc - weight*mean_c*mean_c - slope*cov, 0.0)/(weight - 2.0)
+        error = math.sqrt(residuals/var_t)*self.confidence
+        # the fitted capacity now, so that the noise of the last sample doesn't move the estimate
+        fitted = max(self.__origin + mean_c + slope*(t - mean_t) - self.reserve, 0.0)
+
+        # slopes this flat are rounding errors of a constant capacity
+        def time_to_empty(rate):
+            return fitted/-rate if rate < -1e-9 else math.inf
+
+        return time_to_empty(slope), time_to_empty(slope - error), time_to_empty(slope + error)
+
+## Charge and energy that flowed in and out of the battery and to the output over a period
+class EnergyTotals():
+    __slots__ = ("start", "end", "charge_in", "charge_out", "energy_in", "energy_out",
+                 "output_charge", "output_energy")
+
+    ## Initialize empty totals
+    # @param self The object pointer.
+    # @param start The time at which the period starts.
+    def __init__(self, start):
+        self.start = start
+        self.end = start
+        # charges in mAh and energies in Wh
+        self.charge_in = 0.0
+        self.charge_out = 0.0
+        self.energy_in = 0.0
+        self.energy_out = 0.0
+        self.output_charge = 0.0
+        self.output_energy = 0.0
+
+    ## Add the charge and energy of an interval
+    # @param self The object pointer.
+    # @param end The time at which the interval ends.
+    # @param discharging Whether the battery was discharged.
+    # @param charge The battery charge in mAh.
+    # @param energy The battery energy in Wh.
+    # @param output_charge The output charge in mAh.
+    # @param output_energy The output energy in Wh.
+    def add(self, end, discharging, charge, energy, output_charge, output_energy):
+        self.end = end
+        if discharging:
+            self.charge_out += charge
+            self.energy_out += energy
+        else:
+            self.charge_in += charge
+            self.energy_in += energy
+        self.output_charge += output_charge
+        self.output_energy += output_energy
+
+## Integrates the battery and output current and power over the samples with the trapezoidal
+# rule. The totals are kept per discharge event and per day, every sample costs O(1).
+# Intervals longer than max_gap aren't integrated, because nothing is known about the load in
+# them.
+class EnergyAccountant():
+    ## Initialize the accountant
+    # @param self The object pointer.
+    # @param max_gap The longest interval in seconds between two samples that is integrated.
+    # @param events The number of finished discharge events that are kept.
+    # @param days The number of finished days that are kept.
+    def __init__(self, max_gap=60.0, events=100, days=31):
+        self.max_gap = max_gap
+        self.total = None
+        # the running discharge event, None while the battery isn't discharged
+        self.event = None
+        self.events = collections.deque(maxlen=events)
+        self.day = None
+        self.days = collections.deque(maxlen=days)
+        # intervals that weren't integrated because they exceeded max_gap
+        self.gaps = 0
+        self.__day_key = None
+        self.__previous = None
+
+    ## Add a snapshot
+    # @param self The object pointer.
+    # @param snapshot The SmartUPSSnapshot that was just read.
+    # @return The EnergyTotals of the discharge event that ended with this snapshot, or None.
+    def update(self, snapshot):
+        timestamp = snapshot.timestamp
+        states = SmartUPS.BATTERY_STATES
+        state = states[snapshot.state] if snapshot.state < len(states) else "FAULT"
+        discharging = state in RuntimePredictor.DISCHARGE_STATES
+        # the current is unsigned here, the state tells the direction
+        current = abs(snapshot.batt_current)
+        power = current*snapshot.batt_voltage/1e6
+        output_power = snapshot.out_current*snapshot.out_voltage/1e6
+        sample = (timestamp, current, power, snapshot.out_current, output_power)
+
+        if self.total is None:
+            self.total = EnergyTotals(timestamp)
+        day_key = time.localtime(timestamp)[:3]
+        if day_key != self.__day_key:
+            if self.day is not None:
+                self.days.append(self.day)
+            self.day = EnergyTotals(timestamp)
+            self.__day_key = day_key
+        finished = None
+        if discharging and self.event is None:
+            self.event = EnergyTotals(timestamp)
+        elif not discharging and self.event is not None:
+            finished = self.event
+            self.events.append(finished)
+            self.event = None
+
+        previous = self.__previous
+        self.__previous = sample
+        if previous is None or timestamp <= previous[0]:
+            return finished
+        elapsed = timestamp - previous[0]
+        if elapsed > self.max_gap:
+            self.gaps += 1
+            return finished
+        hours = elapsed/7200
+        values = (discharging, (previous[1] + current)*hours, (previous[2] + power)*hours,
+                  (previous[3] + snapshot.out_current)*hours,
+                  (previous[4] + output_power)*hours)
+        self.total.add(timestamp, *values)
+        self.day.add(timestamp, *values)
+        if self.event is not None:
+            self.event.add(timestamp, *values)
+        return finished
+
+## An event of the EventEngine. kind is one of the kinds of EventEngine, detail a tuple of words
+# for machine consumers (e.g. the old and the new state) and message a description for humans.
+UpsEvent = collections.namedtuple("UpsEvent", ["timestamp", "device", "kind", "detail",
+                                               "message"])
+
+## A threshold with hysteresis and debounce. It becomes active once the value stayed beyond the
+# level for debounce seconds and inactive once it stayed back by at least hysteresis for
+# debounce seconds.
+class Threshold():
+    __slots__ = ("name", "level", "above", "hysteresis", "debounce", "critical", "active",
+                 "value", "__since")
+
+    ## Initialize the threshold
+    # @param self The object pointer.
+    # @param name The name of the threshold in events and in the config.
+    # @param level The level.
+    # @param above Whether values above the level cross it, otherwise values below it do.
+    # @param hysteresis How far the value has to be back from the level to clear it.
+    # @param debounce How long in seconds a crossing or clearing has to persist.
+    # @param critical Whether the threshold requests a shutdown while it is active.
+    def __init__(self, name, level, above, hysteresis=0.0, debounce=0.0, critical=False):
+        self.name = name
+        self.level = level
+        self.above = above
+        self.hysteresis = hysteresis
+        self.debounce = debounce
+        self.critical = critical
+        self.active = False
+        # the last value passed to update()
+        self.value = None
+        self.__since = None
+
+    ## Update the threshold with a new value
+    # @param self The object pointer.
+    # @param value The value. None means that the threshold doesn't apply right now, which
+    # clears it after the debounce.
+    # @param timestamp The time of the value.
+    # @return True if the threshold was crossed, False if it was cleared, None otherwise.
+    def update(self, value, timestamp):
+        self.value = value
+        if value is None:
+            changing = self.active
+        elif self.active:
+            changing = (value <= self.level - self.hysteresis if self.above
+                        else value >= self.level + self.hysteresis)
+        else:
+            changing = value > self.level if self.above else value < self.level
+        if not changing:
+            self.__since = None
+            return None
+        if self.__since is None:
+            self.__since = timestamp
+        if timestamp - self.__since < self.debounce:
+            return None
+        self.__since = None
+        self.active = not self.active
+        return self.active
+
+## Compares every snapshot of a UPS with the previous one and emits UpsEvents only on
+# transitions, so that nothing is logged or pushed while nothing changes.
+class EventEngine():
+    # the kinds of events
+    STATE = "STATE"
+    POWER_LOST = "POWER_LOST"
+    POWER_RESTORED = "POWER_RESTORED"
+    THRESHOLD_CROSSED = "THRESHOLD_CROSSED"
+    THRESHOLD_CLEARED = "THRESHOLD_CLEARED"
+    BUTTON = "BUTTON"
+    STALE = "STALE"
+    FRESH = "FRESH"
+    DISCHARGE_END = "DISCHARGE_END"
+    SHUTDOWN = "SHUTDOWN"
+    # the log level of every kind of event
+    LEVELS = {STATE: logging.INFO, POWER_LOST: logging.WARNING, POWER_RESTORED: logging.WARNING,
+              THRESHOLD_CROSSED: logging.WARNING, THRESHOLD_CLEARED: logging.WARNING,
+              BUTTON: logging.INFO, STALE: logging.ERROR, FRESH: logging.WARNING,
+              DISCHARGE_END: logging.WARNING, SHUTDOWN: logging.CRITICAL}
+
+    ## Initialize the engine
+    # @param self The object pointer.
+    # @param device The name of the device the events are emitted for.
+    # @param thresholds The Thresholds of the device.
+    def __init__(self, device, thresholds):
+        self.device = device
+        self.thresholds = {threshold.name: threshold for threshold in thresholds}
+        self.__state = None
+        self.__button = 0
+
+    ## Create an event of the device
+    # @param self The object pointer.
+    # @param kind The kind of the event.
+    # @param detail The words of the detail.
+    # @param message The description of the event.
+    # @param timestamp The time of the event. Defaults to now.
+    # @return The UpsEvent.
+    def event(self, kind, detail, message, timestamp=None):
+        return UpsEvent(time.time() if timestamp is None else timestamp, self.device, kind,
+                        tuple(str(word) for word in detail), message)
+
+    ## Compare a snapshot with the previous one
+    # @param self The object pointer.
+    # @param snapshot The SmartUPSSnapshot.
+    # @param values The values of the thresholds by their name, see Threshold.update().
+    # @return The list of UpsEvents.
+    def update(self, snapshot, values):
+        events = []
+        timestamp = snapshot.timestamp
+        states = SmartUPS.BATTERY_STATES
+        state = states[snapshot.state] if snapshot.state < len(states) else "FAULT"
+        previous = self.__state
+        self.__state = state
+        if previous is not None and previous != state:
+            events.append(self.event(self.STATE, (previous, state),
+                                     "Battery state changed from %s to %s" % (previous, state),
+                                     timestamp))
+            discharging = RuntimePredictor.DISCHARGE_STATES
+            if state in discharging and previous not in discharging:
+                events.append(self.event(self.POWER_LOST, (state,),
+                                         "Lost input power, running on battery", timestamp))
+            elif previous in discharging and state not in discharging:
+                events.append(self.event(self.POWER_RESTORED, (state,),
+                                         "Input power restored", timestamp))
+        for name, value in values.items():
+            threshold = self.thresholds[name]
+            crossed = threshold.update(value, timestamp)
+            if crossed:
+                events.append(self.event(
+                    self.THRESHOLD_CROSSED, (name, "%.10g" % value),
+                    "%s is %s %s at %.10g" % (name, "above" if threshold.above else "below",
+                                              threshold.level, value), timestamp))
+            elif crossed is not None:
+                events.append(self.event(
+                    self.THRESHOLD_CLEARED,
+                    (name, "-" if value is None else "%.10g" % value),
+                    "%s is back at %s" % (name, "-" if value is None else "%.10g" % value),
+                    timestamp))
+        return events
+
+    ## Compare the button register with its previous value
+    # @param self The object pointer.
+    # @param click The value of the button register.
+    # @param timestamp The time of the value. Defaults to now.
+    # @return The list of UpsEvents.
+    def button(self, click, timestamp=None):
+        previous = self.__button
+        self.__button = click
+        if click == previous or not click:
+            return []
+        kind = "long" if click >= 10 else "short"
+        return [self.event(self.BUTTON, (kind,), "Button was clicked (%s)" % kind, timestamp)]
+
+    ## The descriptions of the active critical thresholds
+    # @param self The object pointer.
+    # @return A list of strings, empty while no shutdown is requested.
+    def critical(self):
+        return ["%s is %.10g" % (threshold.name, threshold.value)
+                for threshold in self.thresholds.values()
+                if threshold.critical and threshold.active and threshold.value is not None]
+
+## An asyncio counterpart of SmartUPS. The blocking calls of the wrapped SmartUPS run on a
+# single worker thread per I2C bus, so they are serialized without blocking the event loop.
+# Concurrent read_snapshot() calls share one bus read: a coroutine that asks for a snapshot while
+# a read is in flight waits for that read instead of issuing another one.
+#
+# Usage:
+#     ups = await AsyncSmartUPS.connect(bus=1)
+#     snapshot = await ups.read_snapshot(timeout=0.5)
+#     async for event in ups.events(1.0):
+#         ...
+class AsyncSmartUPS():
+    ## Wrap a SmartUPS
+    # @param self The object pointer.
+    # @param ups The SmartUPS. It must only be used through this object from now on.
+    # @param timeout The default timeout of the calls in seconds, None waits forever.
+    # @param name The name of the device in the events.
+    def __init__(self, ups, timeout=None, name="ups"):
+        self.ups = ups
+        self.timeout = timeout
+        self.name = name
+        # the last snapshot that was read, the number of bus reads and of the calls that were
+        # coalesced with a read in flight
+        self.snapshot = None
+        self.reads = 0
+        self.coalesced = 0
+        self.__executor = self.executor(ups.bus_key)
+        self.__pending = None
+
+    ## Connect to a SmartUPS without blocking the event loop
+    # @param cls The class.
+    # @param address The I2C address of the SmartUPS.
+    # @param bus The number of the bus or a bus backend, see OpenElectronsI2cFixed.
+    # @param timeout The default timeout of the calls in seconds, None waits forever.
+    # @param name The name of the device in the events.
+    # @return The AsyncSmartUPS.
+    @classmethod
+    async def connect(cls, address=SmartUPS.I2C_ADDRESS, bus=1, timeout=None, name="ups"):
+        import asyncio
+        executor = cls.executor(bus if isinstance(bus, int) else id(bus))
+        future = asyncio.get_running_loop().run_in_executor(executor, SmartUPS, address, bus)
+        return cls(await asyncio.wait_for(future, timeout), timeout, name)
+
+    ## Get the worker thread of a bus
+    # @param key The bus_key of the bus.
+    # @return The concurrent.futures.ThreadPoolExecutor.
+    @staticmethod
+    def executor(key):
+        import concurrent.futures
+        with _BUS_EXECUTORS_LOCK:
+            executor = _BUS_EXECUTORS.get(key)
+            if executor is None:
+                executor = _BUS_EXECUTORS[key] = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="i2c-%s" % key)
+            return executor
+
+    def __timeout(self, timeout):
+        return self.timeout if timeout is None else timeout
+
+    ## Call a method of the SmartUPS on the worker of its bus. If the call is cancelled or times
+    # out before the worker picked it up, it is not made at all. A call that already runs can't
+    # be interrupted, its result is discarded.
+    # @param self The object pointer.
+    # @param method The name of the method, e.g. "read_version" or "write_command".
+    # @param args The arguments of the method.
+    # @param timeout The timeout in seconds. Defaults to the timeout of the object.
+    # @return The result of the method.
+    async def call(self, method, *args, timeout=None):
+        import asyncio
+        future = asyncio.get_running_loop().run_in_executor(
+            self.__executor, functools.partial(getattr(self.ups, method), *args))
+        return await asyncio.wait_for(future, self.__timeout(timeout))
+
+    ## Read all telemetry registers with a single block transaction, see SmartUPS.read_snapshot().
+    # While a read is in flight, the call waits for it instead of reading again. Cancelling the
+    # call or a timeout only stop the wait of this caller, the read finishes for the others.
+    # @param self The object pointer.
+    # @param timeout The timeout in seconds. Defaults to the timeout of the object.
+    # @return A SmartUPSSnapshot or None, if the registers could not be read.
+    async def read_snapshot(self, timeout=None):
+        import asyncio
+        pending = self.__pending
+        if pending is None:
+            pending = asyncio.get_running_loop().run_in_executor(self.__executor,
+                                                                 self.ups.read_snapshot)
+            pending.add_done_callback(self.__read_done)
+            self.__pending = pending
+            self.reads += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.wait_for(asyncio.shield(pending), self.__timeout(timeout))
+
+    def __read_done(self, future):
+        self.__pending = None
+        if not future.cancelled() and future.exception() is None and future.result() is not None:
+            self.snapshot = future.result()
+
+    ## Read a snapshot every interval seconds. Reads that are late skip the intervals they
+    # missed instead of catching up.
+    # @param self The object pointer.
+    # @param interval The interval in seconds.
+    # @param timeout The timeout of a read in seconds. Defaults to the timeout of the object.
+    # @return An async iterator of SmartUPSSnapshots, or None for reads that failed or timed out.
+    async def __samples(self, interval, timeout):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        while True:
+            try:
+                yield await self.read_snapshot(timeout)
+            except asyncio.TimeoutError:
+                logging.warning("%s: Reading the register snapshot timed out", self.name)
+                yield None
+            deadline += interval
+            now = loop.time()
+            if deadline < now:
+                deadline = now
+            await asyncio.sleep(deadline - now)
+
+    ## Iterate over the snapshots read every interval seconds. Reads that fail or time out
+    # are skipped.
+    # @param self The object pointer.
+    # @param interval The interval in seconds.
+    # @param timeout The timeout of a read in seconds. Defaults to the timeout of the object.
+    # @return An async iterator of SmartUPSSnapshots.
+    async def snapshots(self, interval, timeout=None):
+        async for snapshot in self.__samples(interval, timeout):
+            if snapshot is not None:
+                yield snapshot
+
+    ## Iterate over the events of the device, read every interval seconds: the changes of the
+    # battery state, the loss and return of the input power, button clicks and the telemetry
+    # becoming stale and current again.
+    # @param self The object pointer.
+    # @param interval The interval in seconds.
+    # @param timeout The timeout of a read in seconds. Defaults to the timeout of the object.
+    # @param thresholds Thresholds on the fields of the snapshots, e.g. Threshold("out_voltage",
+    # 4.8, False). They are named after the field they watch.
+    # @return An async iterator of UpsEvents.
+    async def events(self, interval, timeout=None, thresholds=()):
+        engine = EventEngine(self.name, thresholds)
+        stale_since = None
+        async for snapshot in self.__samples(interval, timeout):
+            if snapshot is None:
+                if stale_since is None:
+                    stale_since = time.time()
+                    yield engine.event(EventEngine.STALE, (),
+                                       "Could not read the telemetry. Its data is stale until it "
+                                       "can be read again.", stale_since)
+                continue
+            if stale_since is not None:
+                yield engine.event(EventEngine.FRESH, (),
+                                   "The telemetry is current again after %.0f s" %
+                                   (snapshot.timestamp - stale_since), snapshot.timestamp)
+                stale_since = None
+            values = {name: getattr(snapshot, name) for name in engine.thresholds}
+            for event in engine.update(snapshot, values):
+                yield event
+            for event in engine.button(snapshot.button_click, snapshot.timestamp):
+                yield event
+
+## A tier of TelemetryHistory that aggregates the samples into buckets of a fixed duration.
+# Every bucket holds its start time, the number of samples and the minimum, maximum and mean of
+# every field.
+class HistoryTier():
+    __slots__ = ("bucket", "capacity", "width", "fields", "data", "head", "size", "start",
+                 "count", "accumulator")
+
+    ## Initialize the tier
+    # @param self The object pointer.
+    # @param bucket The duration of a bucket in seconds.
+    # @param capacity The number of buckets that are kept.
+    # @param fields The number of fields per sample.
+    def __init__(self, bucket, capacity, fields):
+        self.bucket = bucket
+        self.capacity = capacity
+        self.fields = fields
+        # start, count, fields * (min, max, mean)
+        self.width = 2 + 3*fields
+        self.data = array.array("d", [0.0]) * (self.width * capacity)
+        self.head = 0
+        self.size = 0
+        # the start of the bucket that is being filled and its number of samples
+        self.start = None
+        self.count = 0
+        # fields * (min, max, sum) of the bucket that is being filled
+        self.accumulator = array.array("d", [0.0]) * (3 * fields)
+
+    ## Add a sample
+    # @param self The object pointer.
+    # @param timestamp The timestamp of the sample.
+    # @param raw The array holding the sample.
+    # @param offset The offset of the first field of the sample in raw.
+    def add(self, timestamp, raw, offset):
+        start = timestamp - timestamp % self.bucket
+        if start != self.start:
+            if self.count:
+                self.flush()
+            self.start = start
+            self.count = 0
+        accumulator = self.accumulator
+        if self.count:
+            for field in range(self.fields):
+                value = raw[offset + field]
+                base = 3*field
+                if value < accumulator[base]:
+                    accumulator[base] = value
+                if value > accumulator[base + 1]:
+                    accumulator[base + 1] = value
+                accumulator[base + 2] += value
+        else:
+            for field in range(self.fields):
+                value = raw[offset + field]
+                base = 3*field
+                accumulator[base] = value
+                accumulator[base + 1] = value
+                accumulator[base + 2] = value
+        self.count += 1
+
+    ## Write the bucket that is being filled into the ring buffer
+    # @param self The object pointer.
+    def flush(self):
+        data = self.data
+        row = self.head * self.width
+        data[row] = self.start
+        data[row + 1] = self.count
+        accumulator = self.accumulator
+        for field in range(self.fields):
+            base = 3*field
+            column = row + 2 + base
+            data[column] = accumulator[base]
+            data[column + 1] = accumulator[base + 1]
+            data[column + 2] = accumulator[base + 2] / self.count
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.count = 0
+
+## Fixed-memory history of telemetry snapshots. The raw samples of the last window seconds are
+# kept in a ring buffer and aggregated into tiers of buckets with the minimum, maximum and mean,
+# for example one per minute for a day and one per hour for a month. All memory is allocated up
+# front and appending a sample doesn't allocate any objects.
+class TelemetryHistory():
+    # The snapshot fields that are recorded
+    FIELDS = ("state", "batt_current", "batt_voltage", "batt_capacity", "time",
+              "batt_temperature", "batt_health", "out_voltage", "out_current", "max_capacity")
+
+    __slots__ = ("capacity", "window", "width", "data", "head", "size", "tiers", "__columns")
+
+    ## Initialize the history
+    # @param self The object pointer.
+    # @param capacity The maximum number of raw samples that are kept. It has to cover the
+    # window at the shortest polling interval, see raw_capacity().
+    # @param tiers A list of (bucket duration in seconds, number of buckets) for the aggregated
+    # tiers.
+    # @param window The age in seconds after which raw samples are dropped. None keeps them
+    # until the ring buffer is full.
+    def __init__(self, capacity=3600, tiers=((60, 1440), (3600, 720)), window=None):
+        self.capacity = capacity
+        self.window = window
+        # timestamp and the fields
+        self.width = 1 + len(self.FIELDS)
+        self.data = array.array("d", [0.0]) * (self.width * capacity)
+        self.head = 0
+        self.size = 0
+        self.tiers = tuple(HistoryTier(bucket, buckets, len(self.FIELDS))
+                           for bucket, buckets in tiers)
+        # (column in a row, index in SmartUPSSnapshot) of every field
+        self.__columns = tuple((1 + column, SmartUPSSnapshot._fields.index(name))
+                               for column, name in enumerate(self.FIELDS))
+
+    ## The number of raw samples needed to hold a window at the shortest polling interval
+    # @param window The window in seconds.
+    # @param interval The shortest polling interval in seconds.
+    @staticmethod
+    def raw_capacity(window, interval):
+        return math.ceil(window / interval) + 1
+
+    ## The number of bytes used by all buffers
+    # @param self The object pointer.
+    def memory_size(self):
+        size = len(self.data) * self.data.itemsize
+        for tier in self.tiers:
+            size += (len(tier.data) + len(tier.accumulator)) * tier.data.itemsize
+        return size
+
+    def __len__(self):
+        return self.size
+
+    ## Append a snapshot in O(1)
+    # @param self The object pointer.
+    # @param snapshot The SmartUPSSnapshot.
+    def append(self, snapshot):
+        data = self.data
+        row = self.head * self.width
+        data[row] = snapshot.timestamp
+        for column, index in self.__columns:
+            data[row + column] = snapshot[index]
+        self.head = (self.head + 1) % self.capacity
+        if self.size < self.capacity:
+            self.size += 1
+        if self.window is not None:
+            # every row is dropped once, so this is O(1) amortized
+            oldest = snapshot.timestamp - self.window
+            while self.size > 1 and data[((self.head - self.size) % self.capacity) *
+                                         self.width] < oldest:
+                self.size -= 1
+        for tier in self.tiers:
+            tier.add(snapshot.timestamp, data, row + 1)
+
+    ## Get the raw samples of one field
+    # @param self The object pointer.
+    # @param name The name of the field, see FIELDS.
+    # @param since Only return samples with a timestamp at or after this time.
+    # @return A list of (timestamp, value), the oldest first.
+    def samples(self, name, since=None):
+        column = 1 + self.FIELDS.index(name)
+        return self.__rows(self.data, self.capacity, self.head, self.size, self.width,
+                           lambda row: (self.data[row], self.data[row + column]), since)
+
+    ## Get the most recent raw sample
+    # @param self The object pointer.
+    # @return A dict of the fields and "timestamp" or None, if there is no sample.
+    def latest(self):
+        if not self.size:
+            return None
+        row = ((self.head - 1) % self.capacity) * self.width
+        values = {"timestamp": self.data[row]}
+        for column, name in enumerate(self.FIELDS):
+            values[name] = self.data[row + 1 + column]
+        return values
+
+    ## Get the aggregated buckets of one field
+    # @param self The object pointer.
+    # @param tier The index of the tier.
+    # @param name The name of the field, see FIELDS.
+    # @param since Only return buckets starting at or after this time.
+    # @return A list of (start, count, minimum, maximum, mean), the oldest first. The bucket that
+    # is being filled is not included.
+    def aggregates(self, tier, name, since=None):
+        tier = self.tiers[tier]
+        column = 2 + 3*self.FIELDS.index(name)
+        data = tier.data
+        return self.__rows(data, tier.capacity, tier.head, tier.size, tier.width,
+                           lambda row: (data[row], int(data[row + 1]), data[row + column],
+                                        data[row + column + 1], data[row + column + 2]),
+                           since)
+
+    @staticmethod
+    def __rows(data, capacity, head, size, width, get, since):
+        rows = []
+        for position in range(head - size, head):
+            row = (position % capacity) * width
+            if since is None or data[row] >= since:
+                rows.append(get(row))
+        return rows
+
+## Append-only on-disk log of telemetry snapshots. The log is a directory of preallocated,
+# memory-mapped segment files holding fixed-size binary records of the raw register block.
+# Records carry a CRC, so a torn write at the tail is detected and overwritten after a crash.
+# Segments are rotated by size and age, only the newest ones are kept, and the mapping is
+# flushed to disk in batches to keep the writes to SD cards low.
+class TelemetryLog():
+    MAGIC = b"SUPSLOG1"
+    # magic, format version, record size, creation time
+    HEADER = struct.Struct("<8sHH4xd")
+    # timestamp, raw telemetry block
+    RECORD_DATA = struct.Struct("<d%ds" % SmartUPS.SNAPSHOT_LENGTH)
+    # timestamp, raw telemetry block, CRC32 of both
+    RECORD = struct.Struct("<d%dsI" % SmartUPS.SNAPSHOT_LENGTH)
+    VERSION = 1
+    SUFFIX = ".seg"
+
+    ## Open the log and recover its tail
+    # @param self The object pointer.
+    # @param directory The directory of the segment files. It is created if necessary.
+    # @param segment_size The size of a segment file in bytes.
+    # @param segments The number of segments that are kept.
+    # @param max_age The age in seconds after which a new segment is started.
+    # @param flush_records Flush to disk after this many records.
+    # @param flush_interval Flush to disk after this many seconds.
+    def __init__(self, directory, segment_size=1024*1024, segments=16, max_age=86400,
+                 flush_records=60, flush_interval=300):
+        self.directory = directory
+        self.segment_size = max(segment_size, self.HEADER.size + self.RECORD.size)
+        self.segments = max(segments, 1)
+        self.max_age = max_age
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
+        self.__file = None
+        self.__map = None
+        self.__sequence = 0
+        self.__created = 0
+        self.__offset = 0
+        self.__unflushed = 0
+        self.__flushed = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+        paths = self.segment_paths(directory)
+        if paths and not self.__open(paths[-1]):
+            self.__new_segment()
+        elif not paths:
+            self.__new_segment()
+
+    ## List the segment files of a log, the oldest first
+    # @param directory The directory of the log.
+    @classmethod
+    def segment_paths(cls, directory):
+        try:
+            names = sorted(name for name in os.listdir(directory) if name.endswith(cls.SUFFIX))
+        except FileNotFoundError:
+            return []
+        return [os.path.join(directory, name) for name in names]
+
+    ## Read the valid records of a segment
+    # @param path The path of the segment file.
+    # @return A list of (timestamp, raw block) and the offset after the last valid record, or
+    # None if the file is no valid segment.
+    @classmethod
+    def read_segment(cls, path):
+        with open(path, "rb") as segment:
+            data = segment.read()
+        if len(data) < cls.HEADER.size:
+            return None
+        magic, version, record_size, created = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION or record_size != cls.RECORD.size:
+            return None
+        records = []
+        offset = cls.HEADER.size
+        while offset + cls.RECORD.size <= len(data):
+            timestamp, raw, crc = cls.RECORD.unpack_from(data, offset)
+            if not timestamp or zlib.crc32(data[offset:offset+cls.RECORD_DATA.size]) != crc:
+                break
+            records.append((timestamp, raw))
+            offset += cls.RECORD.size
+        return records, offset
+
+    ## Iterate over all snapshots in a log, the oldest first
+    # @param directory The directory of the log.
+    # @param since Only return snapshots taken at or after this time.
+    @classmethod
+    def snapshots(cls, directory, since=None):
+        for path in cls.segment_paths(directory):
+            segment = cls.read_segment(path)
+            if segment is None:
+                logging.warning("Skipping invalid log segment %s", path)
+                continue
+            for timestamp, raw in segment[0]:
+                if since is None or timestamp >= since:
+                    yield SmartUPS.decode_snapshot(raw, timestamp)
+
+    def __open(self, path):
+        segment = self.read_segment(path)
+        if segment is None or os.path.getsize(path) != self.segment_size:
+            logging.warning("Not appending to log segment %s with a different format or size", path)
+            self.__sequence = int(os.path.basename(path)[:-len(self.SUFFIX)] or 0)
+            return False
+        self.__sequence = int(os.path.basename(path)[:-len(self.SUFFIX)])
+        self.__map_file(path)
+        self.__created = self.HEADER.unpack_from(self.__map)[3]
+        self.__offset = segment[1]
+        logging.debug("Recovered %s records from log segment %s", len(segment[0]), path)
+        return True
+
+    def __map_file(self, path):
+        self.__file = open(path, "r+b")
+        self.__map = mmap.mmap(self.__file.fileno(), self.segment_size)
+
+    def __close_segment(self):
+        if self.__map is not None:
+            self.__map.flush()
+            self.__map.close()
+            self.__file.close()
+            self.__map = None
+            self.__file = None
+
+    def __new_segment(self):
+        self.__close_segment()
+        self.__sequence += 1
+        path = os.path.join(self.directory, "%010d%s" % (self.__sequence, self.SUFFIX))
+        with open(path, "wb") as segment:
+            segment.truncate(self.segment_size)
+        self.__map_file(path)
+        self.__created = time.time()
+        self.HEADER.pack_into(self.__map, 0, self.MAGIC, self.VERSION, self.RECORD.size,
+                              self.__created)
+        self.__offset = self.HEADER.size
+        for old in self.segment_paths(self.directory)[:-self.segments]:
+            logging.debug("Removing old log segment %s", old)
+            os.remove(old)
+
+    ## Append a snapshot
+    # @param self The object pointer.
+    # @param snapshot The SmartUPSSnapshot.
+    def append(self, snapshot):
+        if (self.__offset + self.RECORD.size > self.segment_size or
+                snapshot.timestamp - self.__created > self.max_age):
+            self.__new_segment()
+        crc = zlib.crc32(self.RECORD_DATA.pack(snapshot.timestamp, snapshot.raw))
+        self.RECORD.pack_into(self.__map, self.__offset, snapshot.timestamp, snapshot.raw, crc)
+        self.__offset += self.RECORD.size
+        self.__unflushed += 1
+        if (self.__unflushed >= self.flush_records or
+                time.monotonic() - self.__flushed >= self.flush_interval):
+            self.flush()
+
+    ## Write the records that were appended since the last flush to disk
+    # @param self The object pointer.
+    def flush(self):
+        if self.__map is not None and self.__unflushed:
+            self.__map.flush()
+        self.__unflushed = 0
+        self.__flushed = time.monotonic()
+
+    ## Flush and close the log
+    # @param self The object pointer.
+    def close(self):
+        self.__close_segment()
+
+## A client connection of a StreamServer
+class StreamConnection():
+    __slots__ = ("socket", "fd", "incoming", "outgoing", "close_after_send", "subscriptions")
+
+    def __init__(self, sock):
+        self.socket = sock
+        self.fd = sock.fileno()
+        self.incoming = bytearray()
+        self.outgoing = bytearray()
+        self.close_after_send = False
+        self.subscriptions = None
+
+## Non-blocking stream socket server that runs in the EventLoop. Subclasses implement
+# data_received() and answer with send().
+class StreamServer():
+    # Connections that send more than this without getting an answer are closed
+    MAX_REQUEST_SIZE = 8192
+    # Connections that don't read their answers or pushes are closed when more than this is
+    # waiting to be sent to them
+    MAX_OUTGOING_SIZE = 256*1024
+
+    ## Start listening
+    # @param self The object pointer.
+    # @param loop The EventLoop.
+    # @param sock The bound socket.
+    # @param max_clients The maximum number of concurrent connections.
+    def __init__(self, loop, sock, max_clients=512):
+        self.loop = loop
+        self.socket = sock
+        self.max_clients = max_clients
+        self.connections = {}
+        sock.setblocking(False)
+        sock.listen(128)
+        loop.add_reader(sock, self.__accept)
+
+    ## Stop listening and close all connections
+    # @param self The object pointer.
+    def close(self):
+        for connection in list(self.connections.values()):
+            self.close_connection(connection)
+        self.loop.remove_reader(self.socket)
+        self.socket.close()
+
+    def __accept(self, fd, events):
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as exception:
+                logging.warning("Could not accept a connection: %s", exception)
+                return
+            if len(self.connections) >= self.max_clients:
+                logging.warning("Rejecting connection, %s clients are connected", self.max_clients)
+                sock.close()
+                continue
+            sock.setblocking(False)
+            connection = StreamConnection(sock)
+            self.connections[connection.fd] = connection
+            self.loop.add_reader(sock, self.__on_event, select.POLLIN)
+            self.connection_made(connection)
+
+    def __on_event(self, fd, events):
+        connection = self.connections.get(fd)
+        if connection is None:
+            return
+        if events & (select.POLLERR | select.POLLNVAL):
+            self.close_connection(connection)
+            return
+        if events & select.POLLOUT:
+            self.__flush(connection)
+        if events & (select.POLLIN | select.POLLHUP) and fd in self.connections:
+            try:
+                data = connection.socket.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                data = b""
+            if not data:
+                self.close_connection(connection)
+                return
+            connection.incoming += data
+            self.data_received(connection)
+            if len(connection.incoming) > self.MAX_REQUEST_SIZE:
+                self.close_connection(connection)
+
+    def __flush(self, connection):
+        try:
+            sent = connection.socket.send(connection.outgoing)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.close_connection(connection)
+            return
+        del connection.outgoing[:sent]
+        if connection.outgoing:
+            self.loop.modify_reader(connection.fd, select.POLLIN | select.POLLOUT)
+        elif connection.close_after_send:
+            self.close_connection(connection)
+        else:
+            self.loop.modify_reader(connection.fd, select.POLLIN)
+
+    ## Queue data to be sent to a client
+    # @param self The object pointer.
+    # @param connection The StreamConnection.
+    # @param data The bytes to send.
+    # @param close Close the connection once all data was sent.
+    def send(self, connection, data, close=False):
+        if connection.fd not in self.connections:
+            return
+        connection.close_after_send = connection.close_after_send or close
+        pending = bool(connection.outgoing)
+        connection.outgoing += data
+        if not pending:
+            self.__flush(connection)
+        if len(connection.outgoing) > self.MAX_OUTGOING_SIZE:
+            logging.warning("Closing a connection that doesn't read, %s bytes are waiting for it",
+                            len(connection.outgoing))
+            self.close_connection(connection)
+
+    ## Close a client connection
+    # @param self The object pointer.
+    # @param connection The StreamConnection.
+    def close_connection(self, connection):
+        if self.connections.pop(connection.fd, None) is None:
+            return
+        self.loop.remove_reader(connection.fd)
+        connection.socket.close()
+        self.connection_lost(connection)
+
+    ## Called after a client connected
+    # @param self The object pointer.
+    # @param connection The StreamConnection.
+    def connection_made(self, connection):
+        pass
+
+    ## Called when data was added to connection.incoming
+    # @param self The object pointer.
+    # @param connection The StreamConnection.
+    def data_received(self, connection):
+        pass
+
+    ## Called after a client connection was closed
+    # @param self The object pointer.
+    # @param connection The StreamConnection.
+    def connection_lost(self, connection):
+        pass
+
+## Prometheus/OpenMetrics exporter. It serves /metrics over HTTP from a body that is rendered
+# once per poll cycle by update(), so scrapes never touch the bus and cost the same no matter
+# how many scrapers there are. Only the scrape counter is appended per request.
+class MetricsExporter(StreamServer):
+    # (metric, help, snapshot field) of the gauges taken directly from the snapshot.
+    # The values are scaled with SmartUPS.REGISTER_LAYOUT.
+    GAUGES = (
+        ("smartups_battery_voltage_volts", "Battery voltage.", "batt_voltage"),
+        ("smartups_battery_current_amperes", "Battery current.", "batt_current"),
+        ("smartups_output_voltage_volts", "Output voltage.", "out_voltage"),
+        ("smartups_output_current_amperes", "Output current.", "out_current"),
+        ("smartups_battery_temperature_celsius", "Battery temperature.", "batt_temperature"),
+        ("smartups_battery_capacity_mah", "Remaining battery capacity.", "batt_capacity"),
+        ("smartups_battery_max_capacity_mah", "Maximum battery capacity.", "max_capacity"),
+        ("smartups_runtime_seconds", "Estimated runtime reported by the UPS.", "time"),
+        ("smartups_battery_health_percent", "Battery health.", "batt_health"),
+    )
+    # (metric, help, NotificationSink counter) of the counters of the notification sinks
+    NOTIFICATIONS = (
+        ("smartups_notifications_total", "Events queued for a sink.", "queued"),
+        ("smartups_notifications_delivered_total", "Notifications delivered by a sink.",
+         "delivered"),
+        ("smartups_notifications_coalesced_total", "Events coalesced into others.", "coalesced"),
+        ("smartups_notifications_dropped_total", "Events dropped because the queue was full.",
+         "dropped"),
+        ("smartups_notifications_failed_total", "Notifications whose delivery failed.",
+         "failed"),
+    )
+    # (metric, help, EnergyTotals field) of the counters of EnergyAccountant.total
+    ENERGY = (
+        ("smartups_battery_charged_mah_total", "Charge into the battery.", "charge_in"),
+        ("smartups_battery_discharged_mah_total", "Charge from the battery.", "charge_out"),
+        ("smartups_battery_charged_wh_total", "Energy into the battery.", "energy_in"),
+        ("smartups_battery_discharged_wh_total", "Energy from the battery.", "energy_out"),
+        ("smartups_output_mah_total", "Charge to the output.", "output_charge"),
+        ("smartups_output_wh_total", "Energy to the output.", "output_energy"),
+    )
+
+    ## Start listening
+    # @param self The object pointer.
+    # @param loop The EventLoop.
+    # @param address The address to listen on.
+    # @param port The TCP port to listen on.
+    def __init__(self, loop, address, port):
+        import socket
+        family = socket.AF_INET6 if ":" in address else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((address, port))
+        StreamServer.__init__(self, loop, sock)
+        self.__scales = {entry[0]: entry[4] for entry in SmartUPS.REGISTER_LAYOUT}
+        # the rendered metrics without the scrape counter, None until the first update()
+        self.__body = None
+        self.scrapes = 0
+
+    ## Escape a label value as the text format requires, so a name with a quote, a backslash or
+    # a line break can't break the exposition
+    # @param value The label value.
+    # @return The escaped value.
+    @staticmethod
+    def escape_label(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def __http(self, status, body, content_type=b"text/plain; charset=utf-8"):
+        reasons = {200: b"OK", 404: b"Not Found", 405: b"Method Not Allowed",
+                   503: b"Service Unavailable"}
+        return b"".join((b"HTTP/1.1 %d %s\r\n" % (status, reasons[status]),
+                         b"Content-Type: ", content_type, b"\r\n",
+                         b"Content-Length: %d\r\n" % len(body),
+                         b"Connection: close\r\n\r\n", body))
+
+    ## Render the metrics for the next scrapes
+    # @param self The object pointer.
+    # @param devices The UpsDevices.
+    # @param stats A dict of the monitor statistics: cycles, cycle_seconds_sum,
+    # cycle_seconds_last, the LatencyHistograms of the phases of the cycles by phase as phases and
+    # of the lateness of the poll loop as lateness, and the NotificationSinks as sinks.
+    def update(self, devices, stats):
+        lines = []
+        label = self.escape_label
+        def family(name, kind, text):
+            lines.append("# HELP %s %s" % (name, text))
+            lines.append("# TYPE %s %s" % (name, kind))
+
+        def histogram(name, labels, values):
+            total = 0
+            prefix = labels + "," if labels else ""
+            for bound, count in zip(LatencyHistogram.BOUNDS, values.counts):
+                total += count
+                lines.append('%s_bucket{%sle="%.6g"} %d' % (name, prefix, bound, total))
+            lines.append('%s_bucket{%sle="+Inf"} %d' % (name, prefix, values.count))
+            suffix = "{%s}" % labels if labels else ""
+            lines.append("%s_sum%s %.9g" % (name, suffix, values.sum))
+            lines.append("%s_count%s %d" % (name, suffix, values.count))
+
+        snapshots = [(device, device.snapshot) for device in devices
+                     if device.snapshot is not None]
+        family("smartups_up", "gauge", "Whether the last snapshot of the UPS is current.")
+        for device in devices:
+            lines.append('smartups_up{device="%s"} %d' %
+                         (label(device.name),
+                          device.snapshot is not None and device.stale_since is None))
+        for name, text, field in self.GAUGES:
+            family(name, "gauge", text)
+            scale = self.__scales[field]
+            for device, snapshot in snapshots:
+                lines.append('%s{device="%s"} %.10g' % (name, label(device.name),
+                                                        getattr(snapshot, field)*scale))
+        family("smartups_battery_charge_percent", "gauge", "Battery charge.")
+        for device, snapshot in snapshots:
+            lines.append('smartups_battery_charge_percent{device="%s"} %.10g' %
+                         (label(device.name), device.ups.read_charge(snapshot)))
+        family("smartups_state", "gauge", "Battery state of the UPS, 1 for the current state.")
+        for device, snapshot in snapshots:
+            for index, state in enumerate(SmartUPS.BATTERY_STATES):
+                lines.append('smartups_state{device="%s",state="%s"} %d' %
+                             (label(device.name), state, index == snapshot.state))
+        family("smartups_snapshot_timestamp_seconds", "gauge", "Time of the last snapshot.")
+        for device, snapshot in snapshots:
+            lines.append('smartups_snapshot_timestamp_seconds{device="%s"} %.3f' %
+                         (label(device.name), snapshot.timestamp))
+        for name, text, field in self.ENERGY:
+            family(name, "counter", text)
+            for device in devices:
+                if device.energy.total is not None:
+                    lines.append('%s{device="%s"} %.10g' % (name, label(device.name),
+                                                            getattr(device.energy.total, field)))
+        family("smartups_discharges_total", "counter", "Finished discharge events.")
+        for device in devices:
+            lines.append('smartups_discharges_total{device="%s"} %d' %
+                         (label(device.name), len(device.energy.events)))
+        family("smartups_i2c_transactions_total", "counter", "I2C transactions.")
+        for device in devices:
+            lines.append('smartups_i2c_transactions_total{device="%s"} %d' %
+                         (label(device.name), device.ups.transactions))
+        family("smartups_i2c_errors_total", "counter", "Failed I2C transactions.")
+        for device in devices:
+            lines.append('smartups_i2c_errors_total{device="%s"} %d' %
+                         (label(device.name), device.ups.errors))
+        family("smartups_i2c_retries_total", "counter", "Retried I2C transactions.")
+        for device in devices:
+            lines.append('smartups_i2c_retries_total{device="%s"} %d' %
+                         (label(device.name), device.ups.retries_total))
+        family("smartups_i2c_degraded", "gauge", "Whether the circuit breaker of the UPS is open.")
+        for device in devices:
+            lines.append('smartups_i2c_degraded{device="%s"} %d' %
+                         (label(device.name), device.ups.degraded))
+        family("smartups_i2c_errors_by_register_total", "counter",
+               "Failed I2C transaction attempts by register.")
+        for device in devices:
+            for register, count in sorted(device.ups.register_errors.items()):
+                lines.append('smartups_i2c_errors_by_register_total{device="%s",register="0x%02x"} '
+                             '%d' % (label(device.name), register, count))
+        family("smartups_i2c_transfer_seconds", "histogram",
+               "Duration of the I2C transfers in the driver and on the bus.")
+        for device in devices:
+            histogram("smartups_i2c_transfer_seconds", 'device="%s"' % label(device.name),
+                      device.ups.latency)
+        family("smartups_i2c_bus_wait_seconds", "histogram",
+               "Time the I2C transactions waited for the bus.")
+        for device in devices:
+            histogram("smartups_i2c_bus_wait_seconds", 'device="%s"' % label(device.name),
+                      device.ups.bus_wait)
+        family("smartups_cycle_phase_seconds", "histogram", "Duration of the phases of the cycles.")
+        for phase, values in stats["phases"].items():
+            histogram("smartups_cycle_phase_seconds", 'phase="%s"' % phase, values)
+        family("smartups_loop_lateness_seconds", "histogram",
+               "How late the poll loop woke up for a cycle.")
+        histogram("smartups_loop_lateness_seconds", "", stats["lateness"])
+        family("smartups_cycle_duration_seconds", "summary", "Duration of the poll cycles.")
+        lines.append("smartups_cycle_duration_seconds_sum %s" % stats["cycle_seconds_sum"])
+        lines.append("smartups_cycle_duration_seconds_count %d" % stats["cycles"])
+        family("smartups_cycle_last_duration_seconds", "gauge", "Duration of the last poll cycle.")
+        lines.append("smartups_cycle_last_duration_seconds %s" % stats["cycle_seconds_last"])
+        for name, text, field in self.NOTIFICATIONS:
+            family(name, "counter", text)
+            for sink in stats["sinks"]:
+                lines.append('%s{sink="%s"} %d' % (name, label(sink.name), getattr(sink, field)))
+        family("smartups_notifications_queued", "gauge", "Events waiting in the queue of a sink.")
+        for sink in stats["sinks"]:
+            lines.append('smartups_notifications_queued{sink="%s"} %d' %
+                         (label(sink.name), sink.queue.qsize()))
+        family("smartups_scrapes_total", "counter", "Scrapes served by this exporter.")
+        self.__body = ("\n".join(lines) + "\n").encode("utf-8")
+
+    def data_received(self, connection):
+        end = connection.incoming.find(b"\r\n\r\n")
+        if end < 0:
+            return
+        request = bytes(connection.incoming[:end]).split(b"\r\n", 1)[0].split()
+        del connection.incoming[:]
+        if len(request) < 2 or request[0] not in (b"GET", b"HEAD"):
+            self.send(connection, self.__http(405, b"Only GET is supported\n"), close=True)
+        elif request[1].split(b"?", 1)[0] not in (b"/metrics", b"/"):
+            self.send(connection, self.__http(404, b"Not found\n"), close=True)
+        else:
+            self.scrapes += 1
+            if self.__body is None:
+                response = self.__http(503, b"No data yet\n")
+            else:
+                response = self.__http(200, self.__body + b"smartups_scrapes_total %d\n" %
+                                       self.scrapes, b"text/plain; version=0.0.4; charset=utf-8")
+            if request[0] == b"HEAD":
+                response = response[:response.index(b"\r\n\r\n") + 4]
+            self.send(connection, response, close=True)
+
+## Local query server on a UNIX domain socket with a line based protocol modelled on NUT's upsd.
+# All answers come from the variables rendered once per poll cycle by update(), so requests
+# never touch the bus. Commands:
+#   LIST UPS                  the monitored devices
+#   LIST VAR <ups>            all variables of a device
+#   GET VAR <ups> <variable>  one variable
+#   SUBSCRIBE [<ups>]         push "EVENT <ups> <kind> <detail>" lines of the EventEngine, e.g.
+#                             "EVENT <ups> STATE <old> <new>" on state transitions
+#   UNSUBSCRIBE               stop the pushes
+class QueryServer(StreamServer):
+    # (variable, snapshot field) of the variables taken directly from the snapshot.
+    # The values are scaled with SmartUPS.REGISTER_LAYOUT.
+    VARIABLES = (
+        ("battery.voltage", "batt_voltage"),
+        ("battery.current", "batt_current"),
+        ("battery.temperature", "batt_temperature"),
+        ("battery.health", "batt_health"),
+        ("battery.capacity", "batt_capacity"),
+        ("battery.capacity.max", "max_capacity"),
+        ("battery.runtime", "time"),
+        ("output.voltage", "out_voltage"),
+        ("output.current", "out_current"),
+    )
+    # The NUT ups.status of the battery states
+    STATUS = {"IDLE": "OL", "PRECHARG": "OL CHRG", "CHARGING": "OL CHRG", "TOPUP": "OL CHRG",
+              "CHARGED": "OL", "DISCHARGING": "OB DISCHRG", "CRITICAL": "OB LB",
+              "DISCHARGED": "OB LB", "FAULT": "ALARM", "SHUTDOWN": "OB LB FSD"}
+    # Maximum length of a command line
+    MAX_LINE = 256
+
+    ## Start listening
+    # @param self The object pointer.
+    # @param loop The EventLoop.
+    # @param path The path of the socket. A stale socket at the path is replaced.
+    # @param max_clients The maximum number of concurrent clients.
+    # @throws OSError if the path is no socket or another server listens on it.
+    def __init__(self, loop, path, max_clients=1024):
+        import socket
+        self.__remove_stale(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        self.path = path
+        StreamServer.__init__(self, loop, sock, max_clients)
+        self.__variables = {}
+        self.__lists = {}
+        self.__ups_list = b"BEGIN LIST UPS\nEND LIST UPS\n"
+        self.__scales = {entry[0]: entry[4] for entry in SmartUPS.REGISTER_LAYOUT}
+
+    ## Remove a socket nobody listens on anymore, e.g. after a crash
+    # @param path The path of the socket.
+    # @throws OSError if the path is no socket or another server listens on it.
+    @staticmethod
+    def __remove_stale(path):
+        import socket
+        try:
+            mode = os.lstat(path).st_mode
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(mode):
+            raise FileExistsError(errno.EEXIST, "Exists and is no socket", path)
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+            return
+        finally:
+            probe.close()
+        raise OSError(errno.EADDRINUSE, "Another server listens on the socket", path)
+
+    ## Stop listening and remove the socket
+    # @param self The object pointer.
+    def close(self):
+        StreamServer.close(self)
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    ## Render the variables of all devices
+    # @param self The object pointer.
+    # @param devices The UpsDevices.
+    def update(self, devices):
+        self.__ups_list = ("BEGIN LIST UPS\n" +
+                           "".join('UPS %s "SmartUPS"\n' % device.name for device in devices) +
+                           "END LIST UPS\n").encode("utf-8")
+        for device in devices:
+            snapshot = device.snapshot
+            if snapshot is None:
+                continue
+            state = device.ups.read_batt_state(snapshot)
+            variables = {"ups.state": state, "ups.status": self.STATUS.get(state, "ALARM"),
+                         "ups.timestamp": "%.3f" % snapshot.timestamp,
+                         "ups.stale": "%d" % (device.stale_since is not None),
+                         "battery.charge": "%.1f" % device.ups.read_charge(snapshot)}
+            for name, field in self.VARIABLES:
+                variables[name] = "%.10g" % (getattr(snapshot, field)*self.__scales[field])
+            day = device.energy.day
+            if day is not None:
+                variables["battery.today.charged"] = "%.1f" % day.charge_in
+                variables["battery.today.discharged"] = "%.1f" % day.charge_out
+                variables["output.today.energy"] = "%.3f" % day.output_energy
+            if device.energy.events:
+                event = device.energy.events[-1]
+                variables["battery.discharge.last.duration"] = "%.0f" % (event.end - event.start)
+                variables["battery.discharge.last.charge"] = "%.1f" % event.charge_out
+                variables["battery.discharge.last.energy"] = "%.3f" % event.energy_out
+            self.__variables[device.name] = variables
+            self.__lists[device.name] = (
+                "BEGIN LIST VAR %s\n" % device.name +
+                "".join('VAR %s %s "%s"\n' % (device.name, name, value)
+                        for name, value in sorted(variables.items())) +
+                "END LIST VAR %s\n" % device.name).encode("utf-8")
+
+    ## Push an event to the subscribers of its device as "EVENT <ups> <kind> <detail>"
+    # @param self The object pointer.
+    # @param event The UpsEvent.
+    def push_event(self, event):
+        line = " ".join(("EVENT", event.device, event.kind) + event.detail) + "\n"
+        line = line.encode("utf-8")
+        for connection in list(self.connections.values()):
+            if connection.subscriptions is not None and (not connection.subscriptions or
+                                                         event.device in connection.subscriptions):
+                self.send(connection, line)
+
+    def data_received(self, connection):
+        while True:
+            end = connection.incoming.find(b"\n")
+            if end < 0:
+                if len(connection.incoming) > self.MAX_LINE:
+                    self.send(connection, b"ERR INVALID-ARGUMENT\n", close=True)
+                return
+            line = bytes(connection.incoming[:end]).decode("utf-8", "replace").split()
+            del connection.incoming[:end + 1]
+            if line:
+                self.send(connection, self.__answer(connection, line))
+
+    def __answer(self, connection, line):
+        command = [word.upper() for word in line[:2]]
+        if command == ["LIST", "UPS"]:
+            return self.__ups_list
+        if command == ["LIST", "VAR"] and len(line) == 3:
+            return self.__lists.get(line[2], b"ERR UNKNOWN-UPS\n")
+        if command == ["GET", "VAR"] and len(line) == 4:
+            variables = self.__variables.get(line[2])
+            if variables is None:
+                return b"ERR UNKNOWN-UPS\n"
+            if line[3] not in variables:
+                return b"ERR VAR-NOT-SUPPORTED\n"
+            return ('VAR %s %s "%s"\n' % (line[2], line[3], variables[line[3]])).encode("utf-8")
+        if command[0] == "SUBSCRIBE":
+            connection.subscriptions = set(line[1:])
+            return b"OK\n"
+        if command[0] == "UNSUBSCRIBE":
+            connection.subscriptions = None
+            return b"OK\n"
+        return b"ERR UNKNOWN-COMMAND\n"
+
+## A sink of the NotificationDispatcher. Every sink has its own bounded queue and worker threads,
+# so a slow or hanging sink only delays itself. The workers collect the queued events into
+# batches and coalesce repeated events of a batch before they deliver them.
+class NotificationSink():
+    ## Initialize the sink
+    # @param self The object pointer.
+    # @param name The name of the sink in log messages and metrics.
+    # @param timeout The timeout of a delivery in seconds.
+    # @param queue_size The number of events that can be queued. When the queue is full, the
+    # oldest event is dropped.
+    # @param batch_size The maximum number of events delivered at once.
+    # @param batch_delay How long in seconds a worker waits for more events to fill a batch.
+    # @param workers The number of worker threads.
+    # @param kinds The kinds of events the sink receives. None receives all kinds.
+    def __init__(self, name, timeout=10.0, queue_size=100, batch_size=20, batch_delay=1.0,
+                 workers=1, kinds=None):
+        self.name = name
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.workers = workers
+        self.kinds = None if kinds is None else frozenset(kinds)
+        import queue
+        self.queue = queue.Queue(queue_size)
+        # counters of the events that were queued, coalesced into others and dropped because
+        # the queue was full, and of the notifications that were delivered and that were lost
+        # because their delivery failed. Every queued event ends up in exactly one of them.
+        self.queued = 0
+        self.delivered = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+        self.__lock = threading.Lock()
+        self.__threads = []
+
+    ## Queue an event without blocking
+    # @param self The object pointer.
+    # @param event The UpsEvent. None stops a worker.
+    def put(self, event):
+        if event is not None and self.kinds is not None and event.kind not in self.kinds:
+            return
+        import queue
+        while True:
+            try:
+                self.queue.put_nowait(event)
+                break
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.__count("dropped", 1)
+                except queue.Empty:
+                    pass
+        if event is not None:
+            self.__count("queued", 1)
+
+    def __count(self, counter, value):
+        with self.__lock:
+            setattr(self, counter, getattr(self, counter) + value)
+
+    ## Start the worker threads
+    # @param self The object pointer.
+    def start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self.__work, name="notify-%s-%s" % (self.name, index),
+                                      daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+
+    ## Stop the worker threads after they delivered the queued events
+    # @param self The object pointer.
+    # @param timeout How long to wait for the workers in seconds.
+    def stop(self, timeout):
+        deadline = time.monotonic() + timeout
+        for thread in self.__threads:
+            self.put(None)
+        for thread in self.__threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+    def __work(self):
+        import queue
+        while True:
+            event = self.queue.get()
+            if event is None:
+                return
+            batch = [event]
+            stop = False
+            deadline = time.monotonic() + self.batch_delay
+            while len(batch) < self.batch_size:
+                try:
+                    event = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if event is None:
+                    stop = True
+                    break
+                batch.append(event)
+            notifications = self.coalesce(batch)
+            self.__count("coalesced", len(batch) - len(notifications))
+            try:
+                self.deliver(notifications)
+                self.__count("delivered", len(notifications))
+            except Exception as exception:
+                self.__count("failed", len(notifications))
+                logging.error("Notification sink %s failed to deliver %s notifications: %s",
+                              self.name, len(notifications), exception)
+            if stop:
+                return
+
+    ## Coalesce the events of a batch. Events of the same device, kind and first detail word are
+    # replaced by the last of them.
+    # @param batch The list of UpsEvents.
+    # @return A list of (UpsEvent, count) in the order of their last occurrence.
+    @staticmethod
+    def coalesce(batch):
+        latest = {}
+        for event in batch:
+            key = (event.device, event.kind, event.detail[:1])
+            count = latest.pop(key, (None, 0))[1]
+            latest[key] = (event, count + 1)
+        return list(latest.values())
+
+    ## Format notifications as text
+    # @param notifications A list of (UpsEvent, count).
+    # @return A list of lines.
+    @staticmethod
+    def to_lines(notifications):
+        return ["%s %s: %s%s" % (time.strftime("%Y-%m-%d %H:%M:%S",
+                                               time.localtime(event.timestamp)),
+                                 event.device, event.message,
+                                 " (%s times)" % count if count > 1 else "")
+                for event, count in notifications]
+
+    ## Format notifications as JSON
+    # @param notifications A list of (UpsEvent, count).
+    # @return The JSON document as bytes.
+    @staticmethod
+    def to_json(notifications):
+        import json
+        return json.dumps([dict(event._asdict(), detail=list(event.detail), count=count)
+                           for event, count in notifications]).encode("utf-8")
+
+    ## Deliver notifications. Implemented by the sinks, raises an exception on failure.
+    # @param self The object pointer.
+    # @param notifications A list of (UpsEvent, count).
+    def deliver(self, notifications):
+        raise NotImplementedError()
+
+## Sends the notifications to the local syslog. openlog() is global to the process, so it is
+# only called by the first sink and the facility is passed with every message instead.
+class SyslogSink(NotificationSink):
+    # the syslog priority of the log levels of the events
+    PRIORITIES = {logging.DEBUG: "LOG_DEBUG", logging.INFO: "LOG_INFO",
+                  logging.WARNING: "LOG_WARNING", logging.ERROR: "LOG_ERR",
+                  logging.CRITICAL: "LOG_CRIT"}
+    # the identifier passed to openlog(), None before the first sink was created
+    __ident = None
+
+    ## Initialize the sink
+    # @param self The object pointer.
+    # @param name The name of the sink.
+    # @param ident The syslog identifier. The first sink sets it for the whole process.
+    # @param facility The syslog facility, e.g. daemon or local0.
+    # @param options The options of NotificationSink.
+    # @throws ValueError if the facility is unknown.
+    def __init__(self, name, ident="smartups", facility="daemon", **options):
+        NotificationSink.__init__(self, name, **options)
+        import syslog
+        self.__syslog = syslog
+        self.__facility = getattr(syslog, "LOG_" + str(facility).upper(), None)
+        if not str(facility).isalnum() or not isinstance(self.__facility, int):
+            raise ValueError("Unknown syslog facility %s" % facility)
+        if SyslogSink.__ident is None:
+            syslog.openlog(ident, 0, self.__facility)
+            SyslogSink.__ident = ident
+        elif ident != SyslogSink.__ident:
+            logging.warning("Notification sink %s logs as %s, the syslog identifier is set once "
+                            "per process", name, SyslogSink.__ident)
+
+    def deliver(self, notifications):
+        for (event, count), line in zip(notifications, self.to_lines(notifications)):
+            priority = getattr(self.__syslog, self.PRIORITIES[EventEngine.LEVELS[event.kind]])
+            self.__syslog.syslog(priority | self.__facility, line)
+
+## Mails the notifications of a batch in one mail through an SMTP server, usually the local MTA
+class MailSink(NotificationSink):
+    ## Initialize the sink
+    # @param self The object pointer.
+    # @param name The name of the sink.
+    # @param to The recipient or a list of recipients.
+    # @param sender The sender address.
+    # @param host The SMTP server.
+    # @param port The port of the SMTP server.
+    # @param options The options of NotificationSink.
+    def __init__(self, name, to, sender="smartups@localhost", host="localhost", port=25,
+                 **options):
+        NotificationSink.__init__(self, name, **options)
+        self.to = [to] if isinstance(to, str) else list(to)
+        self.sender = sender
+        self.host = host
+        self.port = port
+
+    def deliver(self, notifications):
+        import email.message
+        import smtplib
+        message = email.message.EmailMessage()
+        devices = sorted(set(event.device for event, count in notifications))
+        message["Subject"] = "SmartUPS %s: %s" % (", ".join(devices), notifications[-1][0].message)
+        message["From"] = self.sender
+        message["To"] = ", ".join(self.to)
+        message.set_content("\n".join(self.to_lines(notifications)) + "\n")
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            smtp.send_message(message)
+
+## POSTs the notifications of a batch as a JSON array to a URL
+class WebhookSink(NotificationSink):
+    ## Initialize the sink
+    # @param self The object pointer.
+    # @param name The name of the sink.
+    # @param url The URL.
+    # @param headers Additional HTTP headers.
+    # @param options The options of NotificationSink.
+    def __init__(self, name, url, headers=None, **options):
+        NotificationSink.__init__(self, name, **options)
+        self.url = url
+        self.headers = dict(headers or {})
+
+    def deliver(self, notifications):
+        import urllib.request
+        headers = {"Content-Type": "application/json"}
+        headers.update(self.headers)
+        request = urllib.request.Request(self.url, self.to_json(notifications), headers)
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+## Runs a command for every batch with the notifications as a JSON array on its stdin
+class ScriptSink(NotificationSink):
+    ## Initialize the sink
+    # @param self The object pointer.
+    # @param name The name of the sink.
+    # @param command The command as a list of arguments or as a string that is run by the shell.
+    # @param options The options of NotificationSink.
+    def __init__(self, name, command, **options):
+        NotificationSink.__init__(self, name, **options)
+        self.command = command
+
+    def deliver(self, notifications):
+        import subprocess
+        subprocess.run(self.command, input=self.to_json(notifications), timeout=self.timeout,
+                       shell=isinstance(self.command, str), check=True,
+                       stdout=subprocess.DEVNULL)
+
+## Dispatches events to the notification sinks without blocking the caller
+class NotificationDispatcher():
+    # the sinks by their type in the config
+    SINKS = {"syslog": SyslogSink, "mail": MailSink, "webhook": WebhookSink,
+             "script": ScriptSink}
+    # the options of the sinks in the config and their parameters
+    OPTIONS = {"timeout": "timeout", "queueSize": "queue_size", "batchSize": "batch_size",
+               "batchDelay": "batch_delay", "workers": "workers", "kinds": "kinds",
+               "ident": "ident", "facility": "facility", "to": "to", "from": "sender",
+               "host": "host", "port": "port", "url": "url", "headers": "headers",
+               "command": "command"}
+
+    ## Create the sinks from the config and start their workers
+    # @param self The object pointer.
+    # @param configs The list of sink configs. Every config has a type, an optional name and the
+    # OPTIONS of the type.
+    def __init__(self, configs):
+        self.sinks = []
+        for index, config in enumerate(configs):
+            config = dict(config)
+            sink_type = config.pop("type", None)
+            if sink_type not in self.SINKS:
+                raise ValueError("Unknown notification type %s" % sink_type)
+            name = str(config.pop("name", "%s%s" % (sink_type, index)))
+            unknown = [key for key in config if key not in self.OPTIONS]
+            if unknown:
+                raise ValueError("Unknown options of notification %s: %s" %
+                                 (name, ", ".join(unknown)))
+            options = {self.OPTIONS[key]: value for key, value in config.items()}
+            self.sinks.append(self.SINKS[sink_type](name, **options))
+        for sink in self.sinks:
+            sink.start()
+
+    ## Queue events for all sinks. It never blocks.
+    # @param self The object pointer.
+    # @param events The UpsEvents.
+    def dispatch(self, events):
+        for event in events:
+            for sink in self.sinks:
+                sink.put(event)
+
+    ## Deliver the queued events and stop the workers
+    # @param self The object pointer.
+    # @param timeout How long to wait for the deliveries in seconds.
+    def close(self, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        for sink in self.sinks:
+            sink.stop(max(0, deadline - time.monotonic()))
+
+## Runs the shutdown of the host in a thread, so that the monitor keeps sampling meanwhile.
+# The pre-shutdown hooks run in parallel until a deadline derived from the remaining runtime,
+# then the shutdown command is run and the power off of the UPS is armed.
+class ShutdownOrchestrator():
+    # the phases of the shutdown
+    IDLE = "idle"
+    HOOKS = "hooks"
+    COMMAND = "command"
+    ARMING = "arming"
+    DONE = "done"
+
+    ## Initialize the orchestrator
+    # @param self The object pointer.
+    # @param hooks The list of hooks, dicts with a command (a list of arguments or a string for the
+    # shell), an optional name and an optional timeout in seconds.
+    # @param command The shutdown command, a list of arguments or a string for the shell.
+    # @param margin Seconds of the remaining runtime that are left for the shutdown command and
+    # the power off. The hooks get the rest of the runtime.
+    # @param hook_timeout The maximum time in seconds the hooks get, even if there is more runtime.
+    # @param command_timeout The timeout of the shutdown command in seconds.
+    # @param power_off Whether to arm the power off of the UPS.
+    # @param power_off_delay Seconds after the shutdown command after which the power off is armed.
+    # @param prepare A callable that is called before the shutdown command, e.g. to flush logs.
+    # @param arm A callable that arms the power off of the UPS.
+    def __init__(self, hooks, command, margin=15.0, hook_timeout=300.0, command_timeout=30.0,
+                 power_off=False, power_off_delay=0.0, prepare=None, arm=None):
+        self.hooks = []
+        for index, hook in enumerate(hooks):
+            if "command" not in hook:
+                raise ValueError("The shutdown hook %s has no command" % hook)
+            self.hooks.append((str(hook.get("name", "hook%s" % index)), hook["command"],
+                               hook.get("timeout")))
+        self.command = command
+        self.margin = margin
+        self.hook_timeout = hook_timeout
+        self.command_timeout = command_timeout
+        self.power_off = power_off
+        self.power_off_delay = power_off_delay
+        self.prepare = prepare
+        self.arm = arm
+        self.phase = self.IDLE
+        self.__thread = None
+
+    ## Whether the shutdown was started
+    # @param self The object pointer.
+    @property
+    def started(self):
+        return self.__thread is not None
+
+    ## Start the shutdown. Only the first call has an effect.
+    # @param self The object pointer.
+    # @param runtime The remaining runtime in seconds, None if it isn't known.
+    def start(self, runtime=None):
+        if self.__thread is not None:
+            return
+        budget = self.hook_timeout
+        if runtime is not None:
+            budget = min(budget, max(0.0, runtime - self.margin))
+            if self.hooks and budget <= 0:
+                logging.critical("Only %.0f s of runtime are left, which is within the shutdown "
+                                 "margin of %.0f s. The shutdown hooks get no time.", runtime,
+                                 self.margin)
+        self.__thread = threading.Thread(target=self.__run, args=(budget,), name="shutdown",
+                                         daemon=True)
+        self.__thread.start()
+
+    ## Wait for the shutdown to finish
+    # @param self The object pointer.
+    # @param timeout How long to wait in seconds.
+    def join(self, timeout=None):
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+
+    def __run(self, budget):
+        try:
+            self.phase = self.HOOKS
+            self.__run_hooks(budget)
+            if self.prepare is not None:
+                self.prepare()
+            self.phase = self.COMMAND
+            logging.critical("Running the shutdown command %s", self.command)
+            self.__run_command(self.command, self.command_timeout)
+            if self.power_off and self.arm is not None:
+                self.phase = self.ARMING
+                time.sleep(self.power_off_delay)
+                logging.critical("Arming the power off of the UPS")
+                self.arm()
+        except Exception:
+            logging.exception("The shutdown failed")
+        finally:
+            self.phase = self.DONE
+
+    def __run_hooks(self, budget):
+        if not self.hooks:
+            return
+        import subprocess
+        logging.warning("Running %s shutdown hooks with %.0f s left for them", len(self.hooks),
+                        budget)
+        start = time.monotonic()
+        processes = []
+        for name, command, timeout in self.hooks:
+            deadline = start + (budget if timeout is None else min(budget, float(timeout)))
+            try:
+                process = subprocess.Popen(command, shell=isinstance(command, str),
+                                           stdin=subprocess.DEVNULL)
+            except OSError as exception:
+                logging.error("Could not run the shutdown hook %s: %s", name, exception)
+                continue
+            processes.append((name, process, deadline))
+        for name, process, deadline in processes:
+            try:
+                code = process.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+                logging.error("The shutdown hook %s didn't finish within %.0f s and was killed",
+                              name, deadline - start)
+                continue
+            if code:
+                logging.error("The shutdown hook %s failed with %s", name, code)
+            else:
+                logging.info("The shutdown hook %s finished after %.1f s", name,
+                             time.monotonic() - start)
+
+    def __run_command(self, command, timeout):
+        import subprocess
+        try:
+            subprocess.run(command, shell=isinstance(command, str), timeout=timeout, check=True,
+                           stdin=subprocess.DEVNULL)
+        except (OSError, subprocess.SubprocessError) as exception:
+            logging.error("The shutdown command failed: %s", exception)
+
+## A UPS monitored by SmartUpsMonitor together with its monitoring state
+class UpsDevice():
+    ## Initialize the device
+    # @param self The object pointer.
+    # @param name The name of the device, used in log messages.
+    # @param ups The SmartUPS.
+    # @param polling The PollingPolicy of the device.
+    # @param history The TelemetryHistory of the device.
+    # @param predictor The RuntimePredictor of the device.
+    # @param events The EventEngine of the device.
+    def __init__(self, name, ups, polling, history, predictor, events):
+        self.name = name
+        self.ups = ups
+        self.polling = polling
+        self.history = history
+        self.predictor = predictor
+        self.events = events
+        self.energy = EnergyAccountant()
+        # the TelemetryLog of the device or None
+        self.log = None
+        self.sampler = RegisterSampler(ups)
+        # the SamplingGroup of the telemetry registers
+        self.telemetry = None
+        self.button_click = 0
+        # the last SmartUPSSnapshot that was checked
+        self.snapshot = None
+        # why this UPS requests a shutdown, None while it doesn't
+        self.critical = None
+        # since when the telemetry couldn't be read, None while snapshot is current
+        self.stale_since = None
+
+## A statistical profiler. ITIMER_PROF interrupts the process after every interval of CPU time
+# and the stack of the main thread, which runs the poll loop, is counted. It shows where the CPU
+# time of the monitor goes, while the LatencyHistograms show the time spent on the bus.
+class SamplingProfiler():
+    ## Initialize the profiler
+    # @param self The object pointer.
+    # @param interval The CPU time between two samples in seconds.
+    # @param depth The maximum number of frames of a sampled stack.
+    def __init__(self, interval=0.005, depth=48):
+        self.interval = interval
+        self.depth = depth
+        # the number of samples by stack, a stack is a tuple of (file, line, function) of its
+        # frames from the outermost to the innermost
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.running = False
+        self.__previous = None
+
+    ## Start sampling
+    # @param self The object pointer.
+    def start(self):
+        self.stacks.clear()
+        self.samples = 0
+        self.__previous = signal.signal(signal.SIGPROF, self.__sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.running = True
+
+    ## Stop sampling
+    # @param self The object pointer.
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self.__previous or signal.SIG_DFL)
+        self.running = False
+
+    def __sample(self, signum, frame):
+        stack = []
+        while frame is not None and len(stack) < self.depth:
+            code = frame.f_code
+            stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+            frame = frame.f_back
+        stack.reverse()
+        self.stacks[tuple(stack)] += 1
+        self.samples += 1
+
+    ## Describe the functions that took the most samples
+    # @param self The object pointer.
+    # @param limit The number of functions.
+    # @return A list of lines with the share of the samples in the function itself and in the
+    # function and what it called.
+    def report(self, limit=20):
+        own = collections.Counter()
+        total = collections.Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for function in set(stack):
+                total[function] += count
+        samples = max(self.samples, 1)
+        lines = ["%d samples every %.1f ms of CPU time" % (self.samples, self.interval*1000),
+                 "  own  total  function"]
+        for function, count in own.most_common(limit):
+            lines.append("%4.1f%% %5.1f%%  %s (%s:%s)" % (
+                100*count/samples, 100*total[function]/samples, function[2],
+                os.path.basename(function[0]), function[1]))
+        return lines
+
+    ## Write the stacks in the folded format of flamegraph.pl
+    # @param self The object pointer.
+    # @param path The path of the file.
+    def write_folded(self, path):
+        with open(path, "w") as output:
+            for stack, count in self.stacks.items():
+                output.write("%s %d\n" % (";".join("%s (%s:%s)" % (
+                    function[2], os.path.basename(function[0]), function[1])
+                    for function in stack), count))
+
+## Watches a file with inotify and calls back after it was written or replaced. The directory is
+# watched, because editors and config management often rename a new file over the old one.
+class FileWatcher():
+    # inotify_init1() flags and the events of inotify_add_watch()
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    # struct inotify_event without the name that follows it
+    EVENT = struct.Struct("iIII")
+
+    ## Start watching
+    # @param self The object pointer.
+    # @param loop The EventLoop.
+    # @param path The path of the file.
+    # @param callback The callable to run. It gets no arguments.
+    # @param delay Seconds to wait for further changes, so one save causes one callback.
+    # @throws OSError if inotify is not available.
+    def __init__(self, loop, path, callback, delay=0.5):
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.loop = loop
+        self.callback = callback
+        self.delay = delay
+        directory, name = os.path.split(os.path.abspath(path))
+        self.name = os.fsencode(name)
+        self.__timer = None
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory),
+                                  self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, os.strerror(error), directory)
+        loop.add_reader(self.fd, self.__on_events)
+
+    def __on_events(self, fd, events):
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        changed = False
+        while offset + self.EVENT.size <= len(data):
+            length = self.EVENT.unpack_from(data, offset)[3]
+            start = offset + self.EVENT.size
+            changed = changed or data[start:start + length].rstrip(b"\0") == self.name
+            offset = start + length
+        if changed:
+            if self.__timer is not None:
+                self.__timer.cancel()
+            self.__timer = self.loop.call_at(self.loop.clock.monotonic() + self.delay, self.__fire)
+
+    def __fire(self):
+        self.__timer = None
+        self.callback()
+
+    ## Stop watching
+    # @param self The object pointer.
+    def close(self):
+        if self.__timer is not None:
+            self.__timer.cancel()
+        self.loop.remove_reader(self.fd)
+        os.close(self.fd)
+
+## The validated config of SmartUpsMonitor. It is frozen: a reload builds a new object and swaps
+# it in with one assignment, so a cycle sees the values of one config, and reading a value costs
+# an attribute load.
+class MonitorConfig():
+    NUMBER = (int, float)
+    # the keys whose values must be greater than 0 and the keys whose values must not be negative
+    POSITIVE = ("sleep", "pollMinInterval", "pollMaxInterval", "cycleTimeout", "i2cTimeout",
+                "energyMaxGap", "profileInterval", "historyWindow", "historySamples")
+    NON_NEGATIVE = ("buttonSampleInterval", "statusSampleInterval", "i2cRetries", "i2cBackoff",
+                    "i2cBreakerThreshold", "i2cBreakerCooldown", "profileSeconds")
+    # the names of the thresholds that can be overridden, see SmartUpsMonitor.__create_thresholds()
+    THRESHOLDS = ("battery_voltage", "battery_temperature", "input_voltage", "charge", "runtime",
+                  "restart_time")
+    # key in the config file, attribute, default, accepted types, whether a reload applies the
+    # value while running. The other values keep their running value until a restart.
+    FIELDS = (
+        ("sleep", "sleep", 5, NUMBER, True),
+        ("bus", "bus", 0, (int,), False),
+        ("address", "address", 0x12, (int,), False),
+        ("debug", "debug", False, (bool,), True),
+        ("verbose", "verbose", False, (bool,), True),
+        ("test", "test", False, (bool,), True),
+        # broken in the FW
+        ("batteryThreshold", "battery_threshold", 0, NUMBER, True),
+        ("battery_temperatureThreshold", "battery_temperature_threshold", 60, NUMBER, True),
+        ("input_voltageThreshold", "input_voltage_threshold", 3.3, NUMBER, True),
+        ("restartOption", "restart_option", 1, (int,), True),
+        # adaptive polling, see PollingPolicy
+        ("pollMinInterval", "poll_min_interval", 1, NUMBER, True),
+        ("pollMaxInterval", "poll_max_interval", 60, NUMBER, True),
+        ("pollBackoffFactor", "poll_backoff_factor", 2.0, NUMBER, True),
+        ("pollChargeRate", "poll_charge_rate", 1.0, NUMBER, True),
+        ("pollRuntimeRate", "poll_runtime_rate", 1.0, NUMBER, True),
+        # the longest interval between two samples that is counted in the energy totals, see
+        # EnergyAccountant. None allows twice the longest polling interval.
+        ("energyMaxGap", "energy_max_gap", None, NUMBER + (type(None),), True),
+        # sample the button between the telemetry reads, 0 disables it
+        ("buttonSampleInterval", "button_sample_interval", 0, NUMBER, False),
+        # sample the state register between the telemetry reads, so the loss of the input power is
+        # noticed while the polling is backed off. None samples it every sleep seconds, 0
+        # disables it.
+        ("statusSampleInterval", "status_sample_interval", None, NUMBER + (type(None),), False),
+        # the devices, None monitors the UPS at bus and address
+        ("devices", "device_configs", None, (list, type(None)), False),
+        # "any" shuts down when any UPS is critical, "all" only when all of them are
+        ("shutdownPolicy", "shutdown_policy", "any", (str,), True),
+        # the history kept per device, see TelemetryHistory
+        # the raw samples of the last historyWindow seconds are kept. historySamples limits
+        # their number, None sizes the buffer for the window at pollMinInterval.
+        ("historyWindow", "history_window", 3600, NUMBER, False),
+        ("historySamples", "history_samples", None, (int, type(None)), False),
+        ("historyTiers", "history_tiers", ((60, 1440), (3600, 720)), (list, tuple), False),
+        # the binary telemetry log, see TelemetryLog. Every device logs into a subdirectory.
+        ("logDirectory", "log_directory", None, (str, type(None)), False),
+        ("logSegmentSize", "log_segment_size", 1024*1024, (int,), False),
+        ("logSegments", "log_segments", 16, (int,), False),
+        ("logSegmentAge", "log_segment_age", 86400, NUMBER, False),
+        ("logFlushRecords", "log_flush_records", 60, (int,), False),
+        ("logFlushInterval", "log_flush_interval", 300, NUMBER, False),
+        # the Prometheus exporter, see MetricsExporter. It is disabled without a port.
+        ("metricsAddress", "metrics_address", "0.0.0.0", (str,), False),
+        ("metricsPort", "metrics_port", None, (int, type(None)), False),
+        # the local query server, see QueryServer. It is disabled without a socket path.
+        ("querySocket", "query_socket", None, (str, type(None)), False),
+        # the shared memory file the snapshots are published in, see smartups_shm
+        ("sharedMemory", "shared_memory", None, (str, type(None)), False),
+        # shut down when the battery runs out within this many seconds, see RuntimePredictor
+        ("runtimeThreshold", "runtime_threshold", 60, NUMBER, True),
+        ("predictionHalfLife", "prediction_half_life", 120.0, NUMBER, True),
+        ("predictionSamples", "prediction_samples", 5, (int,), True),
+        ("predictionConfidence", "prediction_confidence", 2.0, NUMBER, True),
+        ("predictionReserve", "prediction_reserve", 0, NUMBER, True),
+        # the I2C transaction layer, see OpenElectronsI2cFixed.configure_transactions(). The reads
+        # of a cycle are abandoned after cycle_timeout seconds.
+        ("i2cTimeout", "i2c_timeout", 0.1, NUMBER, True),
+        ("i2cRetries", "i2c_retries", 2, (int,), True),
+        ("i2cBackoff", "i2c_backoff", 0.01, NUMBER, True),
+        ("i2cBreakerThreshold", "i2c_breaker_threshold", 5, (int,), True),
+        ("i2cBreakerCooldown", "i2c_breaker_cooldown", 30.0, NUMBER, True),
+        # set the timeout and the retries of the whole I2C adapter, which affects all devices on it
+        ("i2cAdapterTuning", "i2c_adapter_tuning", False, (bool,), False),
+        ("cycleTimeout", "cycle_timeout", 1.0, NUMBER, True),
+        # overrides of the level, hysteresis and debounce of the thresholds by their name, see
+        # SmartUpsMonitor.__create_thresholds()
+        ("thresholds", "thresholds", {}, (dict, type(None)), True),
+        # the notification sinks, see NotificationDispatcher
+        ("notifications", "notification_configs", (), (list, tuple, type(None)), True),
+        # the shutdown, see ShutdownOrchestrator
+        ("shutdownHooks", "shutdown_hooks", (), (list, tuple, type(None)), True),
+        ("shutdownCommand", "shutdown_command", "shutdown now", (str, list), True),
+        # the runtime kept for the shutdown command, the hooks get the rest of runtimeThreshold
+        ("shutdownMargin", "shutdown_margin", 15.0, NUMBER, True),
+        ("shutdownHookTimeout", "shutdown_hook_timeout", 300.0, NUMBER, True),
+        ("shutdownCommandTimeout", "shutdown_command_timeout", 30.0, NUMBER, True),
+        ("upsPowerOff", "ups_power_off", False, (bool,), True),
+        ("upsPowerOffDelay", "ups_power_off_delay", 0.0, NUMBER, True),
+        # the sampling profiler started with SIGUSR2 or --profile, see SamplingProfiler. The
+        # stacks are written to profile_output in the folded format, if it is set.
+        ("profileSeconds", "profile_seconds", 10, NUMBER, True),
+        ("profileInterval", "profile_interval", 0.005, NUMBER, True),
+        ("profileOutput", "profile_output", None, (str, type(None)), True),
+        # the batches of --watch: records are flushed after watch_batch records or
+        # watch_flush_interval seconds
+        ("watchBatch", "watch_batch", 256, (int,), False),
+        ("watchFlushInterval", "watch_flush_interval", 1.0, NUMBER, False),
+    )
+    KEYS = {field[0]: field for field in FIELDS}
+    __slots__ = tuple(field[1] for field in FIELDS)
+
+    ## Create the config
+    # @param self The object pointer.
+    # @param values The values by their attribute, as returned by validate(). Missing values
+    # get their default.
+    def __init__(self, values=None):
+        values = values or {}
+        for field in self.FIELDS:
+            object.__setattr__(self, field[1], values.get(field[1], field[2]))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("The config is frozen, use replace() to change %s" % name)
+
+    ## Validate the contents of a config file
+    # @param cls The class.
+    # @param config_file The mapping read from the config file.
+    # @return A dict of the values by their attribute.
+    # @throws ValueError listing every problem of the config.
+    @classmethod
+    def validate(cls, config_file):
+        if config_file is None:
+            config_file = {}
+        if not isinstance(config_file, dict):
+            raise ValueError("The config is not a mapping")
+        values = {}
+        errors = []
+        for key, value in config_file.items():
+            field = cls.KEYS.get(key)
+            if field is None:
+                errors.append("Unknown key %s found" % key)
+                continue
+            types = field[3]
+            if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+                errors.append("%s must be %s, not %r" %
+                              (key, " or ".join(kind.__name__ for kind in types), value))
+                continue
+            values[field[1]] = value
+        if values.get("shutdown_policy", "any") not in ("any", "all"):
+            errors.append("shutdownPolicy must be any or all")
+        for key in cls.POSITIVE:
+            value = values.get(cls.KEYS[key][1])
+            if value is not None and value <= 0:
+                errors.append("%s must be positive, not %r" % (key, value))
+        for key in cls.NON_NEGATIVE:
+            value = values.get(cls.KEYS[key][1])
+            if value is not None and value < 0:
+                errors.append("%s must not be negative, not %r" % (key, value))
+        if values.get("poll_backoff_factor", 1) < 1:
+            errors.append("pollBackoffFactor must be at least 1, not %r" %
+                          values["poll_backoff_factor"])
+        low = values.get("poll_min_interval", cls.KEYS["pollMinInterval"][2])
+        high = values.get("poll_max_interval", cls.KEYS["pollMaxInterval"][2])
+        if low > high:
+            errors.append("pollMinInterval (%s s) must not be greater than pollMaxInterval (%s s)"
+                          % (low, high))
+        margin = values.get("shutdown_margin", cls.KEYS["shutdownMargin"][2])
+        runtime = values.get("runtime_threshold", cls.KEYS["runtimeThreshold"][2])
+        if margin >= runtime:
+            errors.append("shutdownMargin (%s s) must be less than runtimeThreshold (%s s), or "
+                          "no time is left for the shutdown hooks" % (margin, runtime))
+        for name, overrides in (values.get("thresholds") or {}).items():
+            if name not in cls.THRESHOLDS:
+                errors.append("Unknown threshold %s found" % name)
+                continue
+            if not isinstance(overrides, dict):
+                errors.append("The threshold %s must be a mapping" % name)
+                continue
+            for key in overrides:
+                if key not in ("level", "hysteresis", "debounce"):
+                    errors.append("Unknown key %s of threshold %s found" % (key, name))
+            for key in ("level", "hysteresis", "debounce"):
+                value = overrides.get(key, 0)
+                if not isinstance(value, cls.NUMBER) or isinstance(value, bool):
+                    errors.append("Invalid %s %r of threshold %s" % (key, value, name))
+        if errors:
+            raise ValueError("; ".join(errors))
+        return values
+
+    ## Create a copy with some values replaced
+    # @param self The object pointer.
+    # @param values The new values by their attribute.
+    # @return The new MonitorConfig.
+    def replace(self, **values):
+        merged = {field[1]: getattr(self, field[1]) for field in self.FIELDS}
+        merged.update(values)
+        return MonitorConfig(merged)
+
+## SmartUpsMonitor implements a monitor class for FreeElectron's smart UPS
+class SmartUpsMonitor():
+    # the phases of a poll cycle whose durations are measured, see __lap()
+    PHASES = ("read", "history", "energy", "predict", "events", "polling", "shutdown", "publish")
+    # The version of the format of the config cache, see __parse_config()
+    __CONFIG_CACHE_VERSION = 2
+    # The minimum time in seconds before a poll cycle that failed is retried
+    ERROR_RETRY_DELAY = 0.1
+    # The budget of --benchmark-startup for the time from starting --once to its first reading
+    STARTUP_BUDGET = 0.05
+
+    def __init__(self):
+        self.__config_path = "/etc/upsmon.yml"
+        # the validated config is cached here, see __parse_config(). Empty disables the cache.
+        self.__config_cache = "/var/cache/smartups_monitor.cache"
+        # the config, see MonitorConfig, and the values passed as arguments, which override it
+        self.__config = MonitorConfig()
+        self.__overrides = {}
+        # watches the config file for changes, see FileWatcher
+        self.__config_watcher = None
+        # the monitored UPS, see UpsDevice
+        self.__devices = []
+        # the devices by the key of their bus and one worker per bus if there are several buses
+        self.__buses = {}
+        self.__executors = {}
+        self.__loop = None
+        self.__inhibited = False
+        # whether a shutdown was requested and the critical devices when that was last evaluated
+        self.__shutdown_requested = False
+        self.__critical_names = []
+        # the shutdown, see ShutdownOrchestrator. The UPS cuts the power 50 s after it was armed.
+        self.__shutdown = None
+        # the notification sinks, see NotificationDispatcher
+        self.__notifications = None
+        self.__dump_log = None
+        # the Prometheus exporter, see MetricsExporter. It is disabled without a port.
+        self.__exporter = None
+        # the local query server, see QueryServer. It is disabled without a socket path.
+        self.__query_server = None
+        # the writer of the shared memory file the snapshots are published in, see smartups_shm
+        self.__shared_writer = None
+        # statistics of the poll cycles, the durations of their phases and how late the poll
+        # loop woke up for them
+        self.__cycles = 0
+        self.__cycle_seconds_sum = 0.0
+        self.__cycle_seconds_last = 0.0
+        self.__phases = {phase: LatencyHistogram() for phase in self.PHASES}
+        self.__lateness = LatencyHistogram()
+        # the sampling profiler and the timer that stops it, see __start_profile()
+        self.__profiler = None
+        self.__profile_timer = None
+        self.__profile = 0.0
+        # sampling of the registers, see RegisterSampler
+        self.__sample_timer = None
+        self.__print_values = False
+        self.__simulate = False
+        self.__simulated_latency = 0.0
+        self.__simulated_baudrate = None
+        self.__benchmark = 0
+        self.__benchmark_startup = 0
+        self.__once = False
+        # the streaming mode, see __run_watch()
+        self.__watch = 0.0
+        self.__watch_format = "ndjson"
+        self.__watch_count = 0
+        # recording and replay of the register reads, see BlockRecorder and ReplaySMBus
+        self.__record = None
+        self.__recorder = None
+        self.__replay = None
+        self.__replay_speed = 0.0
+        self.__replay_buses = []
+        # the clock of the main loop and the snapshots, a virtual one for replays
+        self.__clock = Clock()
+
+    ## Read the config file and apply it. Exits if the config is invalid.
+    # @param self The object pointer.
+    # @return True, if the config was applied or doesn't exist.
+    def __parse_config(self):
+        try:
+            config = self.__read_config()
+        except ValueError as exception:
+            logging.error("Invalid config %s: %s", self.__config_path, exception)
+            sys.exit(1)
+        except Exception as exception:
+            logging.critical("Exception occured while trying to read config: %s", exception)
+            return False
+        if config is None:
+            logging.warning("No config file found at %s. Continuing without reading configuration.", self.__config_path)
+            return True
+        self.__config = config
+        return True
+
+    ## Read the config file into a MonitorConfig. The validated values are cached in
+    # config_cache, together with the identity of the config file and of this script. While
+    # neither of them changed, the cache is used and the YAML is neither imported nor parsed.
+    # @param self The object pointer.
+    # @return The MonitorConfig, None if there is no config file.
+    # @throws ValueError if the config is invalid, other exceptions if it can't be read.
+    def __read_config(self):
+        try:
+            stat = os.stat(self.__config_path)
+        except FileNotFoundError:
+            return None
+        key = (self.__CONFIG_CACHE_VERSION, os.path.abspath(self.__config_path), stat.st_ino,
+               stat.st_size, stat.st_mtime_ns, os.stat(__file__).st_mtime_ns)
+        values = self.__load_config_cache(key)
+        if values is None:
+            values = self.__compile_config()
+            self.__store_config_cache(key, values, stat.st_mode & 0o777)
+        return MonitorConfig(values)
+
+    ## Parse the config file and validate it
+    # @param self The object pointer.
+    # @return A dict of the values by their attribute, see MonitorConfig.validate().
+    def __compile_config(self):
+        import yaml
+        with open(self.__config_path, "r") as f:
+            return MonitorConfig.validate(yaml.safe_load(f))
+
+    ## Load the compiled config from the cache. The cache is only trusted if it belongs to this
+    # user or root and nobody else can write it.
+    # @param self The object pointer.
+    # @param key The identity of the config file and of this script.
+    # @return The dict of __compile_config(), None if the cache is missing or outdated.
+    def __load_config_cache(self, key):
+        if not self.__config_cache:
+            return None
+        try:
+            with open(self.__config_cache, "rb") as cache:
+                stat = os.fstat(cache.fileno())
+                if stat.st_uid not in (0, os.getuid()) or stat.st_mode & 0o022:
+                    return None
+                cached_key, values = marshal.load(cache)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if cached_key != key:
+            return None
+        return values
+
+    ## Replace the cache with the compiled config
+    # @param self The object pointer.
+    # @param key The identity of the config file and of this script.
+    # @param values The dict of __compile_config().
+    # @param mode The permissions of the config file. The cache gets the same, because it holds
+    # the same secrets.
+    def __store_config_cache(self, key, values, mode):
+        if not self.__config_cache:
+            return
+        temporary = "%s.%s" % (self.__config_cache, os.getpid())
+        try:
+            data = marshal.dumps((key, values))
+            fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode & ~0o022)
+            with os.fdopen(fd, "wb") as cache:
+                cache.write(data)
+            os.replace(temporary, self.__config_cache)
+        except (OSError, ValueError) as exception:
+            # values marshal can't store (e.g. dates) or no permission for the cache
+            logging.debug("Could not cache the config in %s: %s", self.__config_cache, exception)
+            try:
+                os.unlink(temporary)
+            except OSError:
+                pass
+
+    ## Parse the arguments of a plain --once without argparse, which takes a noticeable part of
+    # the start of a one-shot query. Any other argument falls back to parse_args().
+    # @param self Pointer to object.
+    # @return True, if the arguments were parsed and applied.
+    def __parse_once_args(self):
+        arguments = sys.argv[1:]
+        if "--once" not in arguments:
+            return False
+        options = {}
+        flags = set()
+        values = {"-c": "config", "--config": "config", "--config-cache": "config_cache",
+                  "--bus": "bus", "--address": "address"}
+        index = 0
+        while index < len(arguments):
+            argument = arguments[index]
+            if argument in ("--once", "--simulate", "-v", "--verbose", "--debug"):
+                flags.add(argument)
+            elif argument in values and index + 1 < len(arguments):
+                index += 1
+                options[values[argument]] = arguments[index]
+            else:
+                return False
+            index += 1
+        try:
+            bus = int(options["bus"]) if "bus" in options else None
+            address = int(options["address"]) if "address" in options else None
+        except ValueError:
+            return False
+        self.__config_path = options.get("config", self.__config_path)
+        self.__config_cache = options.get("config_cache", self.__config_cache)
+        self.__parse_config()
+        self.__once = True
+        if "--simulate" in flags:
+            self.__simulate = True
+        if "-v" in flags or "--verbose" in flags:
+            self.__overrides["verbose"] = True
+        if "--debug" in flags:
+            self.__overrides["debug"] = True
+        if bus is not None:
+            self.__overrides["bus"] = bus
+        if address is not None:
+            self.__overrides["address"] = address
+        self.__config = self.__config.replace(**self.__overrides)
+        self.__set_log_level()
+        return True
+
+    ## Parse arguments and apply them, if they were passed (don't apply any of the defaults)
+    # @param self Pointer to object.
+    def parse_args(self):
+        import argparse
+        parser = argparse.ArgumentParser(description="Monitor for SmartUPS from OpenElectrons")
+        parser.add_argument("-c", "--config",
+                            help="Sets the path to the config. Defaults to /etc/upsmon.yml.",
+                            default="/etc/upsmon.yml")
+
+        parser.add_argument("--config-cache",
+                            help="Cache the validated config in FILE and reuse it while the config "
+                            "is unchanged. An empty FILE disables the cache. Defaults to "
+                            "/var/cache/smartups_monitor.cache",
+                            default="/var/cache/smartups_monitor.cache",
+                            metavar="FILE")
+
+        parser.add_argument("-v", "--verbose",
+                            help="Enable verbose mode, prints out INFO level messages.",
+                            action="store_true",
+                            default=False)
+
+        parser.add_argument("--debug",
+                            help="Enable debug mode. Overwrites verbose mode. "
+                            "Prints out DEBUG level messages.",
+                            action="store_true",
+                            default=False)
+
+        parser.add_argument("--test",
+                            help="Enable test mode. Disables upsmon from taking any action "
+                            "except monitoring the UPS",
+                            action="store_true",
+                            default=False)
+
+        parser.add_argument("--bus",
+                            help="The bus number that the device is on. Defaults to 0 (/dev/i2c-0)",
+                            default=0,
+                            type=int)
+
+        parser.add_argument("--address",
+                            help="The address of the UPS. Defaults to 0x12",
+                            default=0x12,
+                            type=int)
+
+        parser.add_argument("--print-values",
+                            help="Print out all settings of the UPS",
+                            default=False,
+                            action="store_true")
+
+        parser.add_argument("--once",
+                            help="Print the telemetry of every UPS as one JSON record per line and "
+                            "exit. Exits with 1 if a UPS could not be read. Run as "
+                            "python3 -m smartups_monitor for the fastest start",
+                            default=False,
+                            action="store_true")
+
+        parser.add_argument("--simulate",
+                            help="Use an in-process simulated SmartUPS instead of the I2C bus",
+                            default=False,
+                            action="store_true")
+
+        parser.add_argument("--simulated-latency",
+                            help="Latency of every transaction of the simulated bus in seconds. "
+                            "Defaults to 0",
+                            default=0.0,
+                            type=float)
+
+        parser.add_argument("--simulated-baudrate",
+                            help="Model the transfer time of the simulated bus at this speed in "
+                            "bit/s, e.g. 50000",
+                            default=None,
+                            type=int)
+
+        parser.add_argument("--benchmark",
+                            help="Run the given number of check cycles and --print-values runs, "
+                            "report the I2C transactions, latency and CPU usage and exit. "
+                            "Enables test mode",
+                            default=0,
+                            metavar="CYCLES",
+                            type=int)
+
+        parser.add_argument("--benchmark-startup",
+                            help="Start --once RUNS times and report the time to its first "
+                            "reading. Exits with 1 if the median exceeds %.0f ms" %
+                            (self.STARTUP_BUDGET*1000),
+                            default=0,
+                            metavar="RUNS",
+                            type=int)
+
+        parser.add_argument("--profile",
+                            help="Run the sampling profiler for the first SECONDS of the monitor "
+                            "and log where the CPU time went. SIGUSR2 starts it while running",
+                            default=0.0,
+                            metavar="SECONDS",
+                            type=float)
+
+        parser.add_argument("--dump-log",
+                            help="Print all snapshots of the telemetry log in the given "
+                            "directory and exit",
+                            default=None,
+                            metavar="DIRECTORY")
+
+        parser.add_argument("--watch",
+                            help="Stream a record of every UPS every INTERVAL seconds to stdout "
+                            "and report the dropped samples and the jitter at the end",
+                            default=0.0,
+                            metavar="INTERVAL",
+                            type=float)
+
+        parser.add_argument("--watch-format",
+                            help="The format of the records of --watch. Defaults to ndjson",
+                            default="ndjson",
+                            choices=["ndjson", "csv"])
+
+        parser.add_argument("--watch-count",
+                            help="Stop --watch after N samples. Defaults to 0, which runs until "
+                            "interrupted",
+                            default=0,
+                            metavar="N",
+                            type=int)
+
+        parser.add_argument("--record",
+                            help="Record every register read with its time to the given file",
+                            default=None,
+                            metavar="FILE")
+
+        parser.add_argument("--replay",
+                            help="Read the registers from a recording of --record instead of the "
+                            "I2C bus. Enables test mode and exits at the end of the recording",
+                            default=None,
+                            metavar="FILE")
+
+        parser.add_argument("--replay-speed",
+                            help="Replay N times faster than the recording was made. Defaults to "
+                            "0, which replays as fast as possible and deterministically",
+                            default=0.0,
+                            metavar="N",
+                            type=float)
+
+        parser.add_argument("--log-directory",
+                            help="Write the telemetry log to DIRECTORY instead of logDirectory. "
+                            "--simulate and --replay only write it if this is given",
+                            default=None,
+                            metavar="DIRECTORY")
+
+        parser.add_argument("--metrics-port",
+                            help="Serve the metrics on PORT instead of metricsPort. "
+                            "--simulate and --replay only serve them if this is given",
+                            default=None,
+                            metavar="PORT",
+                            type=int)
+
+        parser.add_argument("--query-socket",
+                            help="Serve queries on the UNIX socket PATH instead of querySocket. "
+                            "--simulate and --replay only serve them if this is given",
+                            default=None,
+                            metavar="PATH")
+
+        parser.add_argument("--shared-memory",
+                            help="Publish the snapshots in the file PATH instead of sharedMemory. "
+                            "--simulate and --replay only publish them if this is given",
+                            default=None,
+                            metavar="PATH")
+
+        args = parser.parse_args()
+
+        # the config is read first, so the arguments that were passed override it
+        self.__config_path = args.config
+        self.__config_cache = args.config_cache
+        self.__parse_config()
+        if "-v" in sys.argv or "--verbose" in sys.argv:
+            self.__overrides["verbose"] = args.verbose
+        if "--debug" in sys.argv:
+            self.__overrides["debug"] = args.debug
+        if "--test" in sys.argv:
+            self.__overrides["test"] = args.test
+        if "--bus" in sys.argv:
+            self.__overrides["bus"] = args.bus
+        if "--address" in sys.argv:
+            self.__overrides["address"] = args.address
+        if "--print-values" in sys.argv:
+            self.__print_values = args.print_values
+        if "--once" in sys.argv:
+            self.__once = args.once
+        if "--simulate" in sys.argv:
+            self.__simulate = args.simulate
+        if "--simulated-latency" in sys.argv:
+            self.__simulated_latency = args.simulated_latency
+        if "--simulated-baudrate" in sys.argv:
+            self.__simulated_baudrate = args.simulated_baudrate
+        if "--dump-log" in sys.argv:
+            self.__dump_log = args.dump_log
+        if "--profile" in sys.argv:
+            self.__profile = args.profile
+        if "--benchmark" in sys.argv:
+            self.__benchmark = args.benchmark
+            self.__overrides["test"] = True
+        if "--benchmark-startup" in sys.argv:
+            self.__benchmark_startup = args.benchmark_startup
+        if "--watch" in sys.argv:
+            self.__watch = args.watch
+        if "--watch-format" in sys.argv:
+            self.__watch_format = args.watch_format
+        if "--watch-count" in sys.argv:
+            self.__watch_count = args.watch_count
+        if "--record" in sys.argv:
+            self.__record = args.record
+        if "--replay" in sys.argv:
+            self.__replay = args.replay
+            self.__overrides["test"] = True
+        if "--replay-speed" in sys.argv:
+            self.__replay_speed = args.replay_speed
+        # simulations and replays must not write into the log, the socket or the shared memory
+        # of the monitor of the real UPS, which usually runs with the same config
+        for option, attribute in (("--log-directory", "log_directory"),
+                                  ("--metrics-port", "metrics_port"),
+                                  ("--query-socket", "query_socket"),
+                                  ("--shared-memory", "shared_memory")):
+            if option in sys.argv or self.__simulate or self.__replay:
+                self.__overrides[attribute] = getattr(args, attribute)
+        self.__config = self.__config.replace(**self.__overrides)
+        self.__set_log_level()
+
+    def __set_log_level(self):
+        level = logging.WARNING
+        if self.__config.debug:
+            level = logging.DEBUG
+        elif self.__config.verbose:
+            level = logging.INFO
+
+        logging.root.setLevel(level)
+
+    def __print_all_values(self):
+        for device in self.__devices:
+            if len(self.__devices) > 1:
+                print("%s:" % device.name)
+            ups = device.ups
+            ups.begin_cycle()
+            try:
+                self.__print_snapshot(ups)
+            finally:
+                ups.end_cycle()
+
+    def __print_snapshot(self, ups):
+        snapshot = ups.read_snapshot()
+        if snapshot is None:
+            logging.error("Could not read the registers of the UPS")
+            return
+        print("battery voltage: %s" % ups.read_batt_voltage(snapshot))
+        print("battery amperage: %s" % ups.read_batt_current(snapshot))
+        print("battery temperature: %s" % ups.read_batt_temperature(snapshot))
+        print("battery capacity: %s" % ups.read_batt_capacity(snapshot))
+        print("battery estimated run time: %s" % ups.read_batt_estimated_time(snapshot))
+        print("battery health: %s" % ups.read_batt_health(snapshot))
+        print("battery state: %s" % ups.read_batt_state(snapshot))
+        print("battery button click: %s" % ups.read_button_click(snapshot))
+        print("battery output voltage: %s" % ups.read_output_voltage(snapshot))
+        print("battery output amperage: %s" % ups.read_output_current(snapshot))
+        print("battery max capacity: %s" % ups.read_max_capacity(snapshot))
+        print("battery seconds: %s" % ups.read_seconds(snapshot))
+        print("battery charge: %s" % ups.read_charge(snapshot))
+        print("battery version: %s" % ups.read_version())
+        print("battery vendor: %s" % ups.read_vendor())
+        print("battery device id: %s" % ups.read_device_id())
+        print("battery command: %s" % ups.read_command(snapshot))
+        print("battery restart option: %s" % ups.read_restart_option(snapshot))
+        print("battery restart time: %s" % ups.read_restart_time(snapshot))
+
+    ## Check the state of a UPS and decide whether it requests a shut down. The requests of all
+    # devices are combined by __evaluate_shutdown().
+    # @param self The object pointer.
+    # @param device The UpsDevice to check.
+    # @param snapshot The SmartUPSSnapshot to check. If it is None, it is read from the UPS.
+    def __check_ups(self, device, snapshot=None):
+        ups = device.ups
+        lap = time.perf_counter()
+        # read all registers in one transaction and evaluate them from the snapshot
+        if snapshot is None:
+            ups.begin_cycle()
+            try:
+                snapshot = ups.read_snapshot()
+            finally:
+                ups.end_cycle()
+            lap = self.__lap("read", lap)
+        if snapshot is None:
+            logging.error("%s: Could not read the registers of the UPS. Skipping this check.",
+                          device.name)
+            return
+        device.snapshot = snapshot
+        device.history.append(snapshot)
+        if device.log is not None:
+            try:
+                device.log.append(snapshot)
+            except Exception as exception:
+                logging.error("%s: Could not write the telemetry log: %s", device.name, exception)
+        lap = self.__lap("history", lap)
+        events = []
+        discharge = device.energy.update(snapshot)
+        if discharge is not None:
+            outages = (snapshot.max_capacity/discharge.charge_out if discharge.charge_out > 0
+                       else math.inf)
+            events.append(device.events.event(
+                EventEngine.DISCHARGE_END,
+                ("%.0f" % (discharge.end - discharge.start), "%.0f" % discharge.charge_out,
+                 "%.2f" % discharge.energy_out),
+                "The discharge of %.0f s took %.0f mAh (%.2f Wh) from the battery. A full "
+                "battery lasts %.1f outages like it." % (discharge.end - discharge.start,
+                                                         discharge.charge_out,
+                                                         discharge.energy_out, outages),
+                snapshot.timestamp))
+        lap = self.__lap("energy", lap)
+
+        # The estimate of the firmware swings with the load, so the lower bound of the prediction
+        # is used once it fitted enough samples of the discharge.
+        battery_state = ups.read_batt_state(snapshot)
+        battery_estimated_runtime = ups.read_batt_estimated_time(snapshot)
+        prediction = device.predictor.update(snapshot)
+        runtime = battery_estimated_runtime
+        if prediction is not None and prediction.confident:
+            runtime = prediction.lower
+        lap = self.__lap("predict", lap)
+        # The thresholds only emit events when they are crossed or cleared. The charge only
+        # counts while the battery is drained and the restart time only while the restart isn't
+        # inhibited. Tell it to start the system again when the PSU has power again.
+        values = {
+            "battery_voltage": ups.read_output_voltage(snapshot)/1000,
+            "battery_temperature": ups.read_batt_temperature(snapshot),
+            "input_voltage": ups.read_batt_voltage(snapshot)/1000,
+            "charge": (ups.read_charge(snapshot) if battery_state in
+                       ["DISCHARGING", "CRITICAL", "DISCHARGED", "FAULT"] else None),
+            "runtime": runtime,
+            "restart_time": None if self.__inhibited else ups.read_restart_time(snapshot),
+        }
+        events.extend(device.events.update(snapshot, values))
+        self.__emit(events)
+        device.critical = "; ".join(device.events.critical()) or None
+        if prediction is not None and prediction.confident:
+            logging.debug("%s: %s, predicted runtime %.0f s (%.0f s to %.0f s), firmware "
+                          "estimate %s s", device.name, battery_state, prediction.estimate,
+                          prediction.lower, prediction.upper, battery_estimated_runtime)
+        else:
+            logging.debug("%s: %s, runtime %s s", device.name, battery_state,
+                          battery_estimated_runtime)
+        lap = self.__lap("events", lap)
+
+        self.__adapt_polling(device, snapshot)
+        self.__lap("polling", lap)
+        logging.debug("%s: End of __check_ups.", device.name)
+
+    ## Add the time since start to the durations of a phase of the poll cycle
+    # @param self The object pointer.
+    # @param phase The phase, see PHASES.
+    # @param start The time the phase started at, from time.perf_counter().
+    # @return The time the phase ended at, the start of the next phase.
+    def __lap(self, phase, start):
+        now = time.perf_counter()
+        self.__phases[phase].add(now - start)
+        return now
+
+    ## Log the statistics of the poll cycles and of the I2C transactions
+    # @param self The object pointer.
+    # @param signum The signal number, if the dump was triggered by a signal.
+    def __dump_stats(self, signum=None):
+        lines = ["%s cycles, last %.3f ms, mean %.3f ms" % (
+            self.__cycles, self.__cycle_seconds_last*1000,
+            self.__cycle_seconds_sum*1000/max(self.__cycles, 1)),
+                 "Lateness of the poll loop: %s" % self.__lateness.summary()]
+        for phase in self.PHASES:
+            lines.append("Phase %s: %s" % (phase, self.__phases[phase].summary()))
+        for device in self.__devices:
+            ups = device.ups
+            lines.append("%s: %s I2C transactions, %s errors, %s retries%s" % (
+                device.name, ups.transactions, ups.errors, ups.retries_total,
+                ", circuit breaker open" if ups.degraded else ""))
+            lines.append("%s: I2C transfer: %s" % (device.name, ups.latency.summary()))
+            lines.append("%s: I2C bus wait: %s" % (device.name, ups.bus_wait.summary()))
+            if ups.register_errors:
+                lines.append("%s: I2C errors by register: %s" % (device.name, ", ".join(
+                    "0x%02x: %s" % item for item in sorted(ups.register_errors.items()))))
+        for line in lines:
+            logging.warning("Stats: %s", line)
+
+    ## Run the SamplingProfiler for profile_seconds, or the given time
+    # @param self The object pointer.
+    # @param signum The signal number, if the profile was triggered by a signal.
+    # @param seconds How long to profile. Defaults to profile_seconds.
+    def __start_profile(self, signum=None, seconds=None):
+        if self.__profiler is not None and self.__profiler.running:
+            logging.warning("The profiler is already running")
+            return
+        seconds = self.__config.profile_seconds if seconds is None else seconds
+        self.__profiler = SamplingProfiler(self.__config.profile_interval)
+        self.__profiler.start()
+        self.__profile_timer = self.__loop.call_at(self.__clock.monotonic() + seconds,
+                                                   self.__stop_profile)
+        logging.warning("Profiling for %s s", seconds)
+
+    ## Stop the SamplingProfiler and log its report
+    # @param self The object pointer.
+    def __stop_profile(self):
+        if self.__profiler is None or not self.__profiler.running:
+            return
+        self.__profiler.stop()
+        self.__profile_timer.cancel()
+        for line in self.__profiler.report():
+            logging.warning("Profile: %s", line)
+        if self.__config.profile_output:
+            try:
+                self.__profiler.write_folded(self.__config.profile_output)
+            except OSError as exception:
+                logging.error("Could not write the profile to %s: %s",
+                              self.__config.profile_output, exception)
+
+    ## Shut down if the critical devices satisfy the shutdown policy
+    # @param self The object pointer.
+    def __evaluate_shutdown(self):
+        critical = [device for device in self.__devices if device.critical]
+        names = [device.name for device in critical]
+        # only act when the set of critical devices changes and shut down only once
+        if not critical or self.__shutdown_requested or names == self.__critical_names:
+            self.__critical_names = names
+            return
+        self.__critical_names = names
+        if self.__config.shutdown_policy == "all" and len(critical) < len(self.__devices):
+            logging.warning("%s of %s UPS are critical (%s). Waiting for all of them.",
+                            len(critical), len(self.__devices), ", ".join(names))
+            return
+        self.__shutdown_requested = True
+        self.__emit([device.events.event(EventEngine.SHUTDOWN, (),
+                                         "Requests a shutdown: %s" % device.critical)
+                     for device in critical])
+        self.__shut_down()
+
+    ## Log events and pass them to the consumers of the event stream
+    # @param self The object pointer.
+    # @param events The UpsEvents.
+    def __emit(self, events):
+        for event in events:
+            logging.log(EventEngine.LEVELS[event.kind], "%s: %s", event.device, event.message)
+            if self.__query_server is not None:
+                try:
+                    self.__query_server.push_event(event)
+                except Exception:
+                    logging.exception("Could not pass the event to the subscribers")
+        if self.__notifications is not None and events:
+            try:
+                self.__notifications.dispatch(events)
+            except Exception:
+                logging.exception("Could not dispatch the notifications")
+
+    ## Apply the polling interval the policy computed for the snapshot to the telemetry sampling
+    # @param self The object pointer.
+    # @param device The UpsDevice the snapshot belongs to.
+    # @param snapshot The SmartUPSSnapshot of this check.
+    def __adapt_polling(self, device, snapshot):
+        interval = device.polling.update(snapshot)
+        group = device.telemetry
+        if group is None or group.interval == interval:
+            return
+        logging.debug("%s: Changing the polling interval from %s s to %s s", device.name,
+                      group.interval, interval)
+        device.sampler.set_interval(group, interval)
+
+    ## Run function(devices) for the devices of every bus, in parallel on the bus workers if the
+    # devices are on several buses
+    # @param self The object pointer.
+    # @param function The callable to run. It returns a list.
+    # @return The concatenated lists returned by function.
+    def __on_buses(self, function):
+        if not self.__executors:
+            return function(self.__devices)
+        futures = [self.__executors[key].submit(function, devices)
+                   for key, devices in self.__buses.items()]
+        results = []
+        for future in futures:
+            results.extend(future.result())
+        return results
+
+    ## Sample the registers that are due and schedule the next sampling. The timer is re-armed
+    # even if the cycle fails, so one bad cycle doesn't stop polling and the shutdown decisions.
+    # @param self The object pointer.
+    def __sample(self):
+        start = time.perf_counter()
+        now = self.__clock.monotonic()
+        if not self.__clock.virtual:
+            self.__lateness.add(max(0.0, now - self.__sample_timer.deadline))
+        if self.__replay_buses and all(bus.finished for bus in self.__replay_buses):
+            self.__loop.stop()
+            return
+        earliest = None
+        try:
+            self.__sample_cycle(start, now)
+        except Exception:
+            logging.exception("The poll cycle failed")
+            # don't spin on deadlines the failed cycle didn't advance
+            earliest = self.__clock.monotonic() + max(self.__config.poll_min_interval,
+                                                      self.ERROR_RETRY_DELAY)
+        finally:
+            deadlines = [device.sampler.next_deadline() for device in self.__devices]
+            deadlines = [deadline for deadline in deadlines if deadline is not None]
+            if deadlines:
+                deadline = min(deadlines)
+                if earliest is not None:
+                    deadline = max(deadline, earliest)
+                self.__loop.reschedule(self.__sample_timer, deadline)
+
+    ## Run one poll cycle: read the due registers, check the snapshots and publish them
+    # @param self The object pointer.
+    # @param start The time.perf_counter() when the cycle started.
+    # @param now The time of the cycle on the clock of the EventLoop.
+    def __sample_cycle(self, start, now):
+        # the I2C transactions run on the system clock, even in replays
+        deadline = time.monotonic() + self.__config.cycle_timeout
+
+        def read(devices):
+            results = []
+            for device in devices:
+                telemetry = device.telemetry
+                due = (telemetry is not None and telemetry.deadline is not None and
+                       telemetry.deadline <= now)
+                device.ups.deadline = deadline
+                try:
+                    results.append((device, device.sampler.read_due(now), due))
+                finally:
+                    device.ups.deadline = None
+            return results
+
+        checked = stale = False
+        results = self.__on_buses(read)
+        self.__lap("read", start)
+        for device, groups, due in results:
+            device.sampler.dispatch(groups)
+            if device.telemetry in groups:
+                checked = True
+                if device.stale_since is not None:
+                    self.__emit([device.events.event(
+                        EventEngine.FRESH, (),
+                        "The telemetry is current again after %.0f s" %
+                        (self.__clock.time() - device.stale_since), self.__clock.time())])
+                    device.stale_since = None
+            elif due:
+                # keep the last snapshot and the decision made on it, but decide nothing new
+                stale = True
+                if device.stale_since is None:
+                    device.stale_since = self.__clock.time()
+                    self.__emit([device.events.event(
+                        EventEngine.STALE, (),
+                        "Could not read the telemetry. Its data is stale until it can be read "
+                        "again.", device.stale_since)])
+        if checked:
+            lap = time.perf_counter()
+            self.__evaluate_shutdown()
+            self.__lap("shutdown", lap)
+            self.__cycle_seconds_last = time.perf_counter() - start
+            self.__cycle_seconds_sum += self.__cycle_seconds_last
+            self.__cycles += 1
+        if checked or stale:
+            lap = time.perf_counter()
+            self.__publish()
+            self.__lap("publish", lap)
+
+    ## Publish the results of a poll cycle to the exporter and the query server. A consumer that
+    # fails is logged and skipped, it must not stop the poll loop.
+    # @param self The object pointer.
+    def __publish(self):
+        if self.__query_server is not None:
+            try:
+                self.__query_server.update(self.__devices)
+            except Exception:
+                logging.exception("Could not update the query server")
+        if self.__shared_writer is not None:
+            for index, device in enumerate(self.__devices):
+                snapshot = device.snapshot
+                if snapshot is None:
+                    continue
+                ups = device.ups
+                try:
+                    self.__shared_writer.publish(index, (
+                        snapshot.timestamp, ups.read_batt_state(snapshot).encode("ascii"),
+                        snapshot.state, snapshot.batt_health, snapshot.batt_temperature,
+                        snapshot.batt_voltage, snapshot.batt_current, snapshot.out_voltage,
+                        snapshot.out_current, snapshot.batt_capacity, snapshot.max_capacity,
+                        snapshot.time, ups.read_charge(snapshot)))
+                except Exception:
+                    logging.exception("%s: Could not publish the snapshot in the shared memory",
+                                      device.name)
+        if self.__exporter is not None:
+            try:
+                self.__exporter.update(self.__devices, {
+                    "cycles": self.__cycles,
+                    "cycle_seconds_sum": self.__cycle_seconds_sum,
+                    "cycle_seconds_last": self.__cycle_seconds_last,
+                    "phases": self.__phases,
+                    "lateness": self.__lateness,
+                    "sinks": self.__notifications.sinks if self.__notifications else []})
+            except Exception:
+                logging.exception("Could not update the metrics")
+
+    ## Read a snapshot of every device and check them
+    # @param self The object pointer.
+    def __check_all(self):
+        def read(devices):
+            snapshots = []
+            for device in devices:
+                device.ups.begin_cycle()
+                try:
+                    snapshots.append((device, device.ups.read_snapshot()))
+                finally:
+                    device.ups.end_cycle()
+            return snapshots
+
+        for device, snapshot in self.__on_buses(read):
+            if snapshot is None:
+                logging.error("%s: Could not read the registers of the UPS. Skipping this check.",
+                              device.name)
+            else:
+                self.__check_ups(device, snapshot)
+        self.__evaluate_shutdown()
+
+    ## Log the identity of the UPS after its static registers were sampled
+    # @param self The object pointer.
+    # @param device The UpsDevice.
+    # @param group The SamplingGroup of the identity registers.
+    def __on_identity(self, device, group):
+        image = device.sampler.image
+        def string(reg):
+            return image[reg:reg+8].decode("ascii", "replace")
+        logging.info("%s: Monitoring %s %s, firmware %s", device.name,
+                     string(SmartUPS.SMARTUPS_VENDOR), string(SmartUPS.SMARTUPS_WHO_AM_I),
+                     string(SmartUPS.SMARTUPS_VERSION))
+
+    ## Check the UPS after the telemetry registers were sampled
+    # @param self The object pointer.
+    # @param device The UpsDevice.
+    # @param group The SamplingGroup of the telemetry registers.
+    def __on_telemetry(self, device, group):
+        self.__check_ups(device, SmartUPS.decode_snapshot(device.sampler.image, self.__clock.time(),
+                                                          group.start))
+
+    ## Log button clicks after the button register was sampled
+    # @param self The object pointer.
+    # @param device The UpsDevice.
+    # @param group The SamplingGroup of the button register.
+    def __on_button(self, device, group):
+        click = device.sampler.image[group.start]
+        self.__emit(device.events.button(click, self.__clock.time()))
+        device.button_click = click
+
+    ## Check the state register between the telemetry reads. A changed battery state makes the
+    # telemetry due right away, so the loss of the input power is noticed within the status
+    # interval even while the telemetry polling is backed off.
+    # @param self The object pointer.
+    # @param device The UpsDevice.
+    # @param group The SamplingGroup of the state register.
+    def __on_status(self, device, group):
+        telemetry = device.telemetry
+        if (device.snapshot is not None and telemetry is not None and
+                telemetry.deadline is not None and
+                device.sampler.image[group.start] != device.snapshot.state):
+            telemetry.deadline = min(telemetry.deadline, self.__clock.monotonic())
+
+    ## Shut down the system with the ShutdownOrchestrator. It runs in its own thread, so the
+    # devices are sampled further.
+    # @param self The object pointer.
+    def __shut_down(self):
+        # issue shut down
+        logging.critical("Received shutdown signal")
+        if not self.__inhibited and not self.__config.test:
+            self.__inhibited = True
+            if self.__shutdown is None:
+                self.__shutdown = self.__create_shutdown()
+            self.__shutdown.start(self.__remaining_runtime())
+
+    ## Create the ShutdownOrchestrator from the config
+    # @param self The object pointer.
+    # @param config The MonitorConfig. Defaults to the current one.
+    def __create_shutdown(self, config=None):
+        config = config or self.__config
+        return ShutdownOrchestrator(config.shutdown_hooks or [], config.shutdown_command,
+                                    config.shutdown_margin, config.shutdown_hook_timeout,
+                                    config.shutdown_command_timeout, config.ups_power_off,
+                                    config.ups_power_off_delay, self.__flush_logs,
+                                    self.__arm_power_off)
+
+    ## The remaining runtime of the critical devices
+    # @param self The object pointer.
+    # @return The runtime in seconds or None, if it isn't known.
+    def __remaining_runtime(self):
+        runtimes = []
+        for device in self.__devices:
+            if not device.critical or device.snapshot is None:
+                continue
+            prediction = device.predictor.prediction
+            if prediction is not None and prediction.confident:
+                runtimes.append(prediction.lower)
+            else:
+                runtimes.append(device.snapshot.time)
+        return min(runtimes) if runtimes else None
+
+    ## Tell every UPS to cut the power in 50 seconds
+    # @param self The object pointer.
+    def __arm_power_off(self):
+        for device in self.__devices:
+            device.ups.write_command(0x53)
+
+
+    ## Write the telemetry logs of all devices to disk
+    # @param self The object pointer.
+    def __flush_logs(self):
+        if self.__recorder is not None:
+            self.__recorder.flush()
+        for device in self.__devices:
+            if device.log is not None:
+                try:
+                    device.log.flush()
+                except Exception as exception:
+                    logging.error("%s: Could not flush the telemetry log: %s", device.name,
+                                  exception)
+
+    ## Print all snapshots of a telemetry log
+    # @param self The object pointer.
+    def __print_log(self):
+        for snapshot in TelemetryLog.snapshots(self.__dump_log):
+            values = snapshot._asdict()
+            del values["raw"]
+            values["timestamp"] = time.strftime("%Y-%m-%dT%H:%M:%S",
+                                                time.localtime(snapshot.timestamp))
+            print(" ".join("%s=%s" % item for item in values.items()))
+
+    ## Measure one callable over the given number of runs
+    # @param self The object pointer.
+    # @param function The callable to measure.
+    # @param runs The number of runs.
+    # @return A tuple of transactions per run, mean, min and max wall-clock latency and the CPU
+    # time per run, all in seconds.
+    def __measure(self, function, runs):
+        latencies = []
+        transactions = sum(device.ups.transactions for device in self.__devices)
+        cpu = time.process_time()
+        for _ in range(runs):
+            start = time.perf_counter()
+            function()
+            latencies.append(time.perf_counter() - start)
+        cpu = time.process_time() - cpu
+        transactions = sum(device.ups.transactions for device in self.__devices) - transactions
+        return (transactions/runs, sum(latencies)/runs, min(latencies), max(latencies), cpu/runs)
+
+    ## Benchmark the check cycle and --print-values and print the results
+    # @param self The object pointer.
+    def __run_benchmark(self):
+        cycles = self.__benchmark
+        print("Benchmarking %s cycles of %s UPS on %s bus(es)" %
+              (cycles, len(self.__devices), len(self.__buses)))
+        check = self.__measure(self.__check_all, cycles)
+        with open(os.devnull, "w") as devnull:
+            stdout = sys.stdout
+            sys.stdout = devnull
+            try:
+                print_values = self.__measure(self.__print_all_values, cycles)
+            finally:
+                sys.stdout = stdout
+        for name, result in (("check cycle", check), ("print values", print_values)):
+            print("%s: %.1f transactions, latency mean %.3f ms, min %.3f ms, max %.3f ms, "
+                  "CPU %.3f ms" % (name, result[0], result[1]*1000, result[2]*1000,
+                                   result[3]*1000, result[4]*1000))
+        print("CPU time per hour of monitoring with a %s s interval: %.3f s" %
+              (self.__config.sleep, check[4]*3600/self.__config.sleep))
+        for device in self.__devices:
+            print("%s register cache: %s hits, %s misses, %s registers" %
+                  ((device.name,) + tuple(device.ups.cache_stats().values())))
+
+    ## The record of a snapshot in the output of --once and --watch
+    # @param device The UpsDevice.
+    # @param snapshot The SmartUPSSnapshot.
+    # @param sample The index of the sample, None to leave it out.
+    # @return A dict with the device, the sample, the fields of the snapshot and the state name.
+    @staticmethod
+    def __snapshot_record(device, snapshot, sample=None):
+        record = {"device": device.name}
+        if sample is not None:
+            record["sample"] = sample
+        record.update(zip(SmartUPSSnapshot._fields[:-1], snapshot[:-1]))
+        record["state_name"] = device.ups.read_batt_state(snapshot)
+        return record
+
+    ## Print one JSON record per UPS with a single block read each and exit with 1 if a UPS could
+    # not be read
+    # @param self The object pointer.
+    def __run_once(self):
+        import json
+
+        def read(devices):
+            return [(device, device.ups.read_snapshot()) for device in devices]
+
+        failed = False
+        for device, snapshot in self.__on_buses(read):
+            if snapshot is None:
+                failed = True
+                continue
+            print(json.dumps(self.__snapshot_record(device, snapshot)))
+        sys.stdout.flush()
+        if failed:
+            sys.exit(1)
+
+    ## Start --once as a new process benchmark_startup times and report the time from the start
+    # of the process to its first reading. The first run is reported on its own, it compiles the
+    # bytecode and fills the config cache. Exits with 1 if the median exceeds STARTUP_BUDGET.
+    # @param self The object pointer.
+    def __run_startup_benchmark(self):
+        import statistics
+        import subprocess
+        command = [sys.executable, "-m", "smartups_monitor", "--once", "-c", self.__config_path,
+                   "--config-cache", self.__config_cache]
+        if self.__simulate:
+            command.append("--simulate")
+        if "--bus" in sys.argv:
+            command += ["--bus", str(self.__config.bus)]
+        if "--address" in sys.argv:
+            command += ["--address", str(self.__config.address)]
+        directory = os.path.dirname(os.path.abspath(__file__))
+        times = []
+        for _ in range(self.__benchmark_startup + 1):
+            start = time.perf_counter()
+            process = subprocess.Popen(command, cwd=directory, stdout=subprocess.PIPE,
+                                       stderr=subprocess.DEVNULL)
+            line = process.stdout.readline()
+            times.append(time.perf_counter() - start)
+            process.communicate()
+            if not line:
+                print("%s did not read the UPS (exit code %s)" %
+                      (" ".join(command), process.returncode), file=sys.stderr)
+                sys.exit(1)
+        median = statistics.median(times[1:])
+        print("Startup to the first reading: first run %.1f ms, then min %.1f ms, median %.1f ms, "
+              "max %.1f ms over %s runs (budget %.0f ms)" %
+              (times[0]*1000, min(times[1:])*1000, median*1000, max(times[1:])*1000,
+               len(times) - 1, self.STARTUP_BUDGET*1000))
+        if median > self.STARTUP_BUDGET:
+            sys.exit(1)
+
+    ## Stream one record per sample and device to stdout, as NDJSON or CSV, until interrupted or
+    # --watch-count samples were taken. The records are written in batches. The dropped samples
+    # and the jitter of the sampling are reported on stderr at the end.
+    # @param self The object pointer.
+    def __run_watch(self):
+        import json
+        interval = self.__watch
+        fields = [field for field in SmartUPSSnapshot._fields if field != "raw"]
+        output = open(sys.stdout.fileno(), "wb", buffering=1 << 16, closefd=False)
+        pending = []
+        if self.__watch_format == "csv":
+            output.write(("device,sample," + ",".join(fields) + ",state_name\n").encode("ascii"))
+        loop = EventLoop(self.__clock)
+        start = self.__clock.monotonic()
+        # the last sample index, the samples taken and dropped, and the statistics of the
+        # lateness of the samples
+        stats = {"index": -1, "samples": 0, "dropped": 0, "late_sum": 0.0, "late_squares": 0.0,
+                 "late_max": 0.0, "flushed": start}
+
+        def read(devices):
+            return [(device, device.ups.read_snapshot()) for device in devices]
+
+        def flush():
+            try:
+                output.write(b"".join(pending))
+                output.flush()
+            except BrokenPipeError:
+                # the reader went away, e.g. head. Point stdout at /dev/null so that flushing
+                # the rest of the buffer at exit doesn't fail again.
+                devnull = os.open(os.devnull, os.O_WRONLY)
+                os.dup2(devnull, sys.stdout.fileno())
+                os.close(devnull)
+                loop.stop()
+            del pending[:]
+            stats["flushed"] = self.__clock.monotonic()
+
+        def sample():
+            now = self.__clock.monotonic()
+            index = int((now - start)//interval)
+            late = now - (start + index*interval)
+            if index <= stats["index"]:
+                return
+            stats["dropped"] += index - stats["index"] - 1
+            stats["index"] = index
+            stats["samples"] += 1
+            stats["late_sum"] += late
+            stats["late_squares"] += late*late
+            stats["late_max"] = max(stats["late_max"], late)
+            for device, snapshot in self.__on_buses(read):
+                if snapshot is None:
+                    continue
+                state = device.ups.read_batt_state(snapshot)
+                if self.__watch_format == "csv":
+                    values = [repr(getattr(snapshot, field)) for field in fields]
+                    pending.append(("%s,%d,%s,%s\n" % (device.name, index, ",".join(values),
+                                                       state)).encode("utf-8"))
+                else:
+                    pending.append(json.dumps(self.__snapshot_record(device, snapshot, index))
+                                   .encode("utf-8") + b"\n")
+            if (len(pending) >= self.__config.watch_batch or
+                    now - stats["flushed"] >= self.__config.watch_flush_interval):
+                flush()
+            if self.__watch_count and stats["samples"] >= self.__watch_count:
+                loop.stop()
+
+        def stop(signum):
+            loop.stop()
+
+        loop.add_signal_handler(signal.SIGINT, stop)
+        loop.add_signal_handler(signal.SIGTERM, stop)
+        loop.call_periodic(interval, sample, start)
+        try:
+            loop.run()
+            flush()
+        finally:
+            loop.close()
+        samples = max(stats["samples"], 1)
+        mean = stats["late_sum"]/samples
+        deviation = math.sqrt(max(stats["late_squares"]/samples - mean*mean, 0.0))
+        print("%s samples at %s s, %s dropped, jitter mean %.3f ms, stddev %.3f ms, max %.3f ms" %
+              (stats["samples"], interval, stats["dropped"], mean*1000, deviation*1000,
+               stats["late_max"]*1000), file=sys.stderr)
+
+    ## Create the thresholds of a device with the overrides from the config
+    # @param self The object pointer.
+    # @param config The MonitorConfig. Defaults to the current one.
+    # @return A list of Thresholds.
+    def __create_thresholds(self, config=None):
+        config = config or self.__config
+        thresholds = [
+            Threshold("battery_voltage", config.battery_threshold, False, 0.1, 2.0),
+            Threshold("battery_temperature", config.battery_temperature_threshold, True, 2.0, 5.0),
+            Threshold("input_voltage", config.input_voltage_threshold, False, 0.1, 2.0),
+            Threshold("charge", 0.25, False, critical=True),
+            Threshold("runtime", config.runtime_threshold, False, 30.0, critical=True),
+            Threshold("restart_time", 0, True, critical=True),
+        ]
+        for threshold in thresholds:
+            overrides = (config.thresholds or {}).get(threshold.name) or {}
+            for key in ("level", "hysteresis", "debounce"):
+                if key in overrides:
+                    setattr(threshold, key, float(overrides[key]))
+        return thresholds
+
+    ## Reload the config file on SIGHUP or when it changed and swap it in. The values that can
+    # change while running are applied to the devices in place, so their state (active
+    # thresholds, the predictions, the polling interval) is kept. An invalid config is rejected
+    # as a whole and the running config stays in place.
+    # @param self The object pointer.
+    # @param signum The signal number, if the reload was triggered by a signal.
+    def __reload_config(self, signum=None):
+        old = self.__config
+        try:
+            config = self.__read_config()
+        except Exception as exception:
+            logging.error("Not reloading the config %s: %s", self.__config_path, exception)
+            return
+        if config is None:
+            logging.error("Not reloading the config: %s doesn't exist", self.__config_path)
+            return
+        config = config.replace(**self.__overrides)
+        kept = {}
+        for key, attribute, default, types, reloadable in MonitorConfig.FIELDS:
+            if not reloadable and getattr(config, attribute) != getattr(old, attribute):
+                logging.warning("%s changes after a restart of the monitor", key)
+                kept[attribute] = getattr(old, attribute)
+        config = config.replace(**kept)
+        changed = [field for field in MonitorConfig.FIELDS
+                   if getattr(config, field[1]) != getattr(old, field[1])]
+        if not changed:
+            logging.info("Reloaded the config %s, nothing changed", self.__config_path)
+            return
+        changed = set(field[1] for field in changed)
+
+        # create everything that can fail before anything is swapped
+        notifications = self.__notifications
+        shutdown = self.__shutdown
+        try:
+            if "notification_configs" in changed:
+                notifications = None
+                if config.notification_configs:
+                    notifications = NotificationDispatcher(config.notification_configs)
+            if shutdown is None or not shutdown.started:
+                shutdown = self.__create_shutdown(config)
+        except (AttributeError, TypeError, ValueError) as exception:
+            if notifications is not self.__notifications and notifications is not None:
+                notifications.close(0)
+            logging.error("Not reloading the config %s: %s", self.__config_path, exception)
+            return
+
+        self.__config = config
+        if notifications is not self.__notifications:
+            if self.__notifications is not None:
+                # deliver what is queued without blocking the poll loop
+                threading.Thread(target=self.__notifications.close, args=(5.0,),
+                                 name="notify-close", daemon=True).start()
+            self.__notifications = notifications
+        self.__shutdown = shutdown
+        self.__set_log_level()
+        thresholds = self.__create_thresholds(config)
+        for device in self.__devices:
+            for threshold in thresholds:
+                current = device.events.thresholds[threshold.name]
+                current.level = threshold.level
+                current.hysteresis = threshold.hysteresis
+                current.debounce = threshold.debounce
+            device.polling.configure(config.sleep, config.poll_min_interval,
+                                     config.poll_max_interval, config.poll_backoff_factor,
+                                     config.poll_charge_rate, config.poll_runtime_rate)
+            device.energy.max_gap = self.__energy_max_gap(config)
+            predictor = device.predictor
+            predictor.half_life = config.prediction_half_life
+            predictor.min_samples = config.prediction_samples
+            predictor.confidence = config.prediction_confidence
+            predictor.reserve = config.prediction_reserve
+            device.ups.configure_transactions(config.i2c_timeout, config.i2c_retries,
+                                              config.i2c_backoff, config.i2c_breaker_threshold,
+                                              config.i2c_breaker_cooldown,
+                                              config.i2c_adapter_tuning)
+            if "restart_option" in changed:
+                device.ups.write_restart_option(config.restart_option)
+        logging.warning("Reloaded the config %s, changed: %s", self.__config_path,
+                        ", ".join(field[0] for field in MonitorConfig.FIELDS
+                                  if field[1] in changed))
+
+    ## The longest interval between two samples that the EnergyAccountant integrates. The
+    # polling settles at the longest interval while the UPS is idle and the timers fire a little
+    # late, so the default leaves twice that.
+    # @param config The MonitorConfig.
+    @staticmethod
+    def __energy_max_gap(config):
+        if config.energy_max_gap is not None:
+            return config.energy_max_gap
+        return 2*max(config.sleep, config.poll_max_interval)
+
+    ## Create the monitored devices from the devices in the config or from bus and address
+    # @param self The object pointer.
+    def __create_devices(self):
+        configs = self.__config.device_configs
+        if configs is None:
+            configs = [{"name": "ups", "bus": self.__config.bus, "address": self.__config.address}]
+        simulated_buses = {}
+        replay_buses = {}
+        if self.__replay:
+            try:
+                records = BlockRecorder.read(self.__replay)
+            except (OSError, ValueError) as exception:
+                logging.error("Could not read the recording: %s", exception)
+                sys.exit(1)
+            if not records:
+                logging.error("The recording %s is empty", self.__replay)
+                sys.exit(1)
+            self.__clock = Clock(self.__replay_speed, records[0][0])
+        if self.__record:
+            try:
+                self.__recorder = BlockRecorder(self.__record)
+            except OSError as exception:
+                logging.error("Could not open the recording: %s", exception)
+                sys.exit(1)
+        for index, config in enumerate(configs):
+            try:
+                name = str(config.get("name", "ups%s" % index))
+                bus = int(config["bus"])
+                address = int(config["address"])
+            except (AttributeError, KeyError, TypeError, ValueError):
+                logging.error("Invalid device %s in config. Devices need a bus and an address.",
+                              config)
+                sys.exit(1)
+            bus_number = bus
+            if self.__replay:
+                if bus not in replay_buses:
+                    replay_buses[bus] = ReplaySMBus(records, bus, self.__clock)
+                    self.__replay_buses.append(replay_buses[bus])
+                bus = replay_buses[bus]
+            elif self.__simulate:
+                if bus not in simulated_buses:
+                    simulated_buses[bus] = SimulatedSMBus(latency=self.__simulated_latency,
+                                                          baudrate=self.__simulated_baudrate)
+                bus = simulated_buses[bus]
+            try:
+                ups = SmartUPS(address, bus)
+            except Exception as exception:
+                logging.error("Failed to create I2C object to monitor PSU %s: %s", name, exception)
+                sys.exit(1)
+            ups.configure_transactions(self.__config.i2c_timeout, self.__config.i2c_retries,
+                                       self.__config.i2c_backoff,
+                                       self.__config.i2c_breaker_threshold,
+                                       self.__config.i2c_breaker_cooldown,
+                                       self.__config.i2c_adapter_tuning)
+            ups.recorder = self.__recorder
+            ups.recorder_bus = bus_number
+            logging.debug("%s: A transaction takes at most %.3f s, a cycle at most %s s", name,
+                          ups.worst_case_latency(), self.__config.cycle_timeout)
+            polling = PollingPolicy(self.__config.sleep, self.__config.poll_min_interval,
+                                    self.__config.poll_max_interval,
+                                    self.__config.poll_backoff_factor,
+                                    self.__config.poll_charge_rate,
+                                    self.__config.poll_runtime_rate)
+            capacity = self.__config.history_samples
+            if capacity is None:
+                capacity = TelemetryHistory.raw_capacity(self.__config.history_window,
+                                                         self.__config.poll_min_interval)
+            history = TelemetryHistory(capacity, self.__config.history_tiers,
+                                       self.__config.history_window)
+            logging.debug("%s: The history uses %s bytes", name, history.memory_size())
+            predictor = RuntimePredictor(self.__config.prediction_half_life,
+                                         self.__config.prediction_samples,
+                                         self.__config.prediction_confidence,
+                                         reserve=self.__config.prediction_reserve)
+            events = EventEngine(name, self.__create_thresholds())
+            device = UpsDevice(name, ups, polling, history, predictor, events)
+            device.energy.max_gap = self.__energy_max_gap(self.__config)
+            if (self.__config.log_directory and not self.__print_values and
+                    not self.__benchmark and not self.__watch and not self.__once):
+                try:
+                    device.log = TelemetryLog(os.path.join(self.__config.log_directory, name),
+                                              self.__config.log_segment_size,
+                                              self.__config.log_segments,
+                                              self.__config.log_segment_age,
+                                              self.__config.log_flush_records,
+                                              self.__config.log_flush_interval)
+                except Exception as exception:
+                    logging.error("%s: Could not open the telemetry log: %s", name, exception)
+            self.__devices.append(device)
+
+        for device in self.__devices:
+            self.__buses.setdefault(device.ups.bus_key, []).append(device)
+        if len(self.__buses) > 1:
+            import concurrent.futures
+            for key in self.__buses:
+                self.__executors[key] = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="i2c-%s" % key)
+
+    def __main(self):
+        if self.__dump_log:
+            self.__print_log()
+            return
+        if self.__benchmark_startup:
+            self.__run_startup_benchmark()
+            return
+        self.__create_devices()
+        try:
+            self.__run_mode()
+        finally:
+            if self.__shutdown is not None and self.__shutdown.started:
+                # the shutdown of the host stops the monitor, but the power off has to be armed
+                self.__shutdown.join(self.__config.ups_power_off_delay +
+                                     self.__config.shutdown_command_timeout)
+            for executor in self.__executors.values():
+                executor.shutdown()
+            for device in self.__devices:
+                if device.log is not None:
+                    device.log.close()
+            if self.__recorder is not None:
+                self.__recorder.close()
+
+    def __run_mode(self):
+        if self.__benchmark:
+            self.__run_benchmark()
+        elif self.__print_values:
+            self.__print_all_values()
+        elif self.__once:
+            self.__run_once()
+        elif self.__watch:
+            self.__run_watch()
+        else:
+            loop = EventLoop(self.__clock)
+            loop.add_signal_handler(signal.SIGINT, self.__exit_gracefully)
+            loop.add_signal_handler(signal.SIGTERM, self.__exit_gracefully)
+            loop.add_signal_handler(signal.SIGHUP, self.__reload_config)
+            loop.add_signal_handler(signal.SIGUSR1, self.__dump_stats)
+            loop.add_signal_handler(signal.SIGUSR2, self.__start_profile)
+            try:
+                self.__config_watcher = FileWatcher(loop, self.__config_path,
+                                                    self.__reload_config)
+            except OSError as exception:
+                logging.info("Not watching %s for changes, reload it with SIGHUP: %s",
+                             self.__config_path, exception)
+            for device in self.__devices:
+                # write the restart option
+                device.ups.write_restart_option(self.__config.restart_option)
+
+                sampler = device.sampler
+                now = self.__clock.monotonic()
+                # the version, vendor and device id are static and read only once
+                sampler.add("identity", SmartUPS.SMARTUPS_VERSION, 24, None,
+                            functools.partial(self.__on_identity, device), now)
+                device.telemetry = sampler.add("telemetry", SmartUPS.SNAPSHOT_START,
+                                               SmartUPS.SNAPSHOT_LENGTH, device.polling.interval,
+                                               functools.partial(self.__on_telemetry, device), now)
+                if self.__config.button_sample_interval:
+                    sampler.add("button", SmartUPS.SMARTUPS_BUTTON_CLICK, 1,
+                                self.__config.button_sample_interval,
+                                functools.partial(self.__on_button, device), now)
+                status_interval = self.__config.status_sample_interval
+                if status_interval is None:
+                    status_interval = self.__config.sleep
+                if status_interval:
+                    # read together with the telemetry whenever both are due
+                    sampler.add("status", SmartUPS.SMARTUPS_STATE, 1, status_interval,
+                                functools.partial(self.__on_status, device), now)
+            if self.__config.metrics_port:
+                try:
+                    self.__exporter = MetricsExporter(loop, self.__config.metrics_address,
+                                                      self.__config.metrics_port)
+                except OSError as exception:
+                    logging.error("Could not start the metrics exporter on %s:%s: %s",
+                                  self.__config.metrics_address, self.__config.metrics_port,
+                                  exception)
+                    sys.exit(1)
+            if self.__config.query_socket:
+                try:
+                    self.__query_server = QueryServer(loop, self.__config.query_socket)
+                except OSError as exception:
+                    logging.error("Could not start the query server on %s: %s",
+                                  self.__config.query_socket, exception)
+                    sys.exit(1)
+            if self.__config.notification_configs:
+                try:
+                    self.__notifications = NotificationDispatcher(
+                        self.__config.notification_configs)
+                except (TypeError, ValueError) as exception:
+                    logging.error("Invalid notifications in config: %s", exception)
+                    sys.exit(1)
+            try:
+                self.__shutdown = self.__create_shutdown()
+            except (AttributeError, TypeError, ValueError) as exception:
+                logging.error("Invalid shutdown hooks in config: %s", exception)
+                sys.exit(1)
+            if self.__config.shared_memory:
+                import smartups_shm
+                try:
+                    self.__shared_writer = smartups_shm.SnapshotWriter(
+                        self.__config.shared_memory, [device.name for device in self.__devices])
+                except (OSError, ValueError) as exception:
+                    logging.error("Could not create the shared memory file %s: %s",
+                                  self.__config.shared_memory, exception)
+                    sys.exit(1)
+            self.__sample_timer = loop.call_at(self.__clock.monotonic(), self.__sample)
+            replay_start = time.perf_counter()
+            self.__loop = loop
+            if self.__profile:
+                self.__start_profile(seconds=self.__profile)
+            try:
+                loop.run()
+            finally:
+                self.__stop_profile()
+                if self.__config_watcher is not None:
+                    self.__config_watcher.close()
+                if self.__shared_writer is not None:
+                    self.__shared_writer.close()
+                if self.__exporter is not None:
+                    self.__exporter.close()
+                if self.__query_server is not None:
+                    self.__query_server.close()
+                if self.__notifications is not None:
+                    self.__notifications.close()
+                loop.close()
+            if self.__replay:
+                logging.warning("Replayed %.0f s of the recording in %.2f s", self.__clock.time() -
+                                self.__replay_buses[0].start, time.perf_counter() - replay_start)
             logging.debug("Exited main loop")
 
+    ## Stop the main loop when SIGINT or SIGTERM is received.
+    # @param self The object pointer.
+    # @param signum The signal number.
+    def __exit_gracefully(self, signum):
+        logging.warning("Received shutdown signal. Shutting down.")
+        self.__loop.stop()
+
     ## Initialize the loggin system
     # @param self The object pointer.
     def __logging_config(self):
@@ -681,7 +5245,8 @@ class SmartUpsMonitor():
 
     def run(self):
         self.__logging_config()
-        self.parse_args()
+        if not self.__parse_once_args():
+            self.parse_args()
         self.__main()
 
 if __name__ == '__main__':
@@ -0,0 +1,207 @@
+## smartups shared memory snapshots
+# Publication of the SmartUPS snapshots of smartups_monitor in a shared memory file and a reader
+# for it that needs no syscalls after opening the file and no locks against the writer.
+# Rest of the code and all changes are under the GPLv3
+# Author Noel Kuntze <noel.kuntze+github@thermi.consulting>
+#
+# The file starts with a header, followed by one fixed-size slot per UPS. Every slot starts with
+# a sequence counter that the writer makes odd before and even after it changes the slot
+# (a sequence lock). A reader copies the slot and retries if the counter was odd or changed
+# in the meantime.
+#
+# The counter has 32 bits and is loaded and stored through an aligned memoryview, so it is
+# accessed with one instruction and can't tear, also on 32 bit ARM. Python has no memory
+# barriers, so on weakly ordered CPUs a reader may see the new counter before the new payload
+# or the other way round. The payload is therefore followed by its CRC32 and a copy is only
+# accepted if its CRC matches, which catches copies that mix old and new bytes.
+#
+# The monitor replaces the file when it starts, so readers that run longer than the monitor
+# have to open it again after a restart of the monitor.
+#
+# Usage:
+#     reader = SnapshotReader("/dev/shm/smartups")
+#     snapshot = reader.read("ups")
+#     if snapshot.state == "DISCHARGING" and snapshot.runtime < 300:
+#         ...
+
+import collections
+import mmap
+import os
+import struct
+import zlib
+
+MAGIC = b"SUPSSHM1"
+VERSION = 2
+# magic, version, number of slots, size of a slot
+HEADER = struct.Struct("<8sHHI")
+HEADER_SIZE = 64
+# the sequence counter in native byte order, it is accessed as one aligned word
+SEQUENCE_SIZE = 4
+# the CRC32 of the payload
+CHECKSUM = struct.Struct("<I")
+# name, timestamp, state, state index, health, temperature in °C, battery voltage in mV,
+# battery current in mA, output voltage in mV, output current in mA, capacity in mAh,
+# maximum capacity in mAh, estimated runtime in s, charge in %
+PAYLOAD = struct.Struct("<16sd12sBBBxiiiiIIId")
+# the length of the name field
+NAME_SIZE = 16
+SLOT_SIZE = 128
+
+## A snapshot read from the shared memory
+SharedSnapshot = collections.namedtuple("SharedSnapshot", [
+    "name", "timestamp", "state", "state_index", "health", "temperature", "batt_voltage",
+    "batt_current", "out_voltage", "out_current", "capacity", "max_capacity", "runtime",
+    "charge"])
+
+## Writes the snapshots of the monitored UPS into the shared memory file
+class SnapshotWriter():
+    ## Create the file and map it. The file is created under a new random name in the same
+    # directory and renamed into place once it is initialized, so a symlink or file planted at
+    # the path in the world-writable /dev/shm is never followed or truncated and readers never
+    # map a half-initialized file.
+    # @param self The object pointer.
+    # @param path The path of the file, e.g. /dev/shm/smartups.
+    # @param names The names of the UPS, one slot is allocated for each.
+    # @throws ValueError if a name is longer than NAME_SIZE bytes.
+    # @throws OSError if the file can't be created or replaced.
+    def __init__(self, path, names):
+        self.path = path
+        self.__names = [name.encode("utf-8") for name in names]
+        for name in self.__names:
+            if len(name) > NAME_SIZE:
+                raise ValueError("The name %s is longer than %s bytes" %
+                                 (name.decode("utf-8"), NAME_SIZE))
+        size = HEADER_SIZE + SLOT_SIZE * len(self.__names)
+        fd, temporary = self.__create_temporary(path)
+        try:
+            try:
+                os.ftruncate(fd, size)
+                self.__map = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+            self.__sequences = memoryview(self.__map).cast("I")
+            for index, name in enumerate(self.__names):
+                self.__write(index, PAYLOAD.pack(name, 0.0, b"", 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+                                                 0.0))
+            HEADER.pack_into(self.__map, 0, MAGIC, VERSION, len(self.__names), SLOT_SIZE)
+            os.rename(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    @staticmethod
+    def __create_temporary(path):
+        for _ in range(100):
+            temporary = "%s.%s.tmp" % (path, os.urandom(6).hex())
+            try:
+                fd = os.open(temporary, os.O_RDWR | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW |
+                             os.O_CLOEXEC, 0o644)
+            except FileExistsError:
+                continue
+            return fd, temporary
+        raise FileExistsError("Could not create a temporary file next to %s" % path)
+
+    @staticmethod
+    def __offset(index):
+        return HEADER_SIZE + SLOT_SIZE * index
+
+    ## Publish a snapshot
+    # @param self The object pointer.
+    # @param index The index of the UPS in the names passed to the constructor.
+    # @param values The values of the PAYLOAD after the name, in the order of SharedSnapshot.
+    # @throws struct.error if a value doesn't fit its field. The slot keeps the last snapshot.
+    def publish(self, index, values):
+        # pack first, so invalid values never leave the slot half written
+        self.__write(index, PAYLOAD.pack(self.__names[index], *values))
+
+    def __write(self, index, payload):
+        offset = self.__offset(index)
+        word = offset // SEQUENCE_SIZE
+        sequence = self.__sequences[word]
+        self.__sequences[word] = (sequence + 1) & 0xffffffff
+        try:
+            start = offset + SEQUENCE_SIZE
+            CHECKSUM.pack_into(self.__map, start, zlib.crc32(payload))
+            start += CHECKSUM.size
+            self.__map[start:start + PAYLOAD.size] = payload
+        finally:
+            # readers spin while the sequence is odd
+            self.__sequences[word] = (sequence + 2) & 0xffffffff
+
+    ## Unmap and remove the file
+    # @param self The object pointer.
+    def close(self):
+        self.__sequences.release()
+        self.__map.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+## Reads consistent snapshots from the shared memory file without syscalls or locks
+class SnapshotReader():
+    ## Map the file
+    # @param self The object pointer.
+    # @param path The path of the file, e.g. /dev/shm/smartups.
+    def __init__(self, path):
+        with open(path, "rb") as shared:
+            self.__map = mmap.mmap(shared.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, slots, slot_size = HEADER.unpack_from(self.__map)
+        if magic != MAGIC or version != VERSION or slot_size != SLOT_SIZE:
+            raise ValueError("%s is no SmartUPS shared memory file" % path)
+        self.__slots = slots
+        self.__sequences = memoryview(self.__map).cast("I")
+        self.__indices = {}
+        for index in range(slots):
+            name = self.read_slot(index).name
+            self.__indices[name] = index
+
+    ## The names of the UPS in the file
+    # @param self The object pointer.
+    def names(self):
+        return list(self.__indices)
+
+    ## Read the snapshot of a UPS by its name
+    # @param self The object pointer.
+    # @param name The name of the UPS. Defaults to the first UPS.
+    # @return A SharedSnapshot. Its timestamp is 0 while the monitor hasn't published one yet.
+    def read(self, name=None):
+        return self.read_slot(0 if name is None else self.__indices[name])
+
+    ## Read the snapshot in a slot
+    # @param self The object pointer.
+    # @param index The index of the slot.
+    # @param retries How often to retry while the writer changes the slot.
+    # @return A SharedSnapshot.
+    def read_slot(self, index, retries=10000):
+        if not 0 <= index < self.__slots:
+            raise IndexError("No slot %s" % index)
+        shared = self.__map
+        sequences = self.__sequences
+        offset = HEADER_SIZE + SLOT_SIZE * index
+        word = offset // SEQUENCE_SIZE
+        start = offset + SEQUENCE_SIZE
+        end = start + CHECKSUM.size + PAYLOAD.size
+        for _ in range(retries):
+            before = sequences[word]
+            if before & 1:
+                # the writer is in the middle of an update, let it finish
+                os.sched_yield()
+                continue
+            data = shared[start:end]
+            if sequences[word] != before:
+                continue
+            if CHECKSUM.unpack_from(data)[0] != zlib.crc32(data[CHECKSUM.size:]):
+                # the stores of the writer became visible out of order
+                os.sched_yield()
+                continue
+            values = PAYLOAD.unpack_from(data, CHECKSUM.size)
+            return SharedSnapshot(values[0].rstrip(b"\0").decode("utf-8"), values[1],
+                                  values[2].rstrip(b"\0").decode("ascii"), *values[3:])
+        raise TimeoutError("The writer kept changing slot %s" % index)
+
+    ## Unmap the file
+    # @param self The object pointer.
+    def close(self):
+        self.__sequences.release()
+        self.__map.close()